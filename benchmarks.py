@@ -0,0 +1,536 @@
+#!/usr/bin/env python
+
+# Client-side benchmarks for sk8s. These run against local stand-ins (see
+# sk8s/testing.py), so they measure sk8s overhead, not cluster behaviour.
+#
+#   python benchmarks.py submit -n 2000
+#   python benchmarks.py ship -n 1000 -size 10000
+#   python benchmarks.py session -n 200
+#   python benchmarks.py results -n 500 -latency 0.05
+#   python benchmarks.py encoding -sizes 1e6,1e8,1e9
+#   python benchmarks.py imports -budget_ms 100
+#   python benchmarks.py pool -n 2000 -workers 8
+#   python benchmarks.py local -n 1000 -workers 8
+#   python benchmarks.py throttle -n 2000 -server_qps 200
+#   python benchmarks.py cleanup -n 10000
+#   python benchmarks.py futures -n 200
+#   python benchmarks.py aio -n 10000
+#   python benchmarks.py dag -n 4 -seconds 0.5
+#   python benchmarks.py refs -n 20 -size 10000000
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from kubernetes import client, config
+
+import sk8s
+import sk8s.encoding
+import sk8s.kube
+import sk8s.payloads
+import sk8s.results
+import sk8s.session
+import sk8s.testing
+import sk8s.throttle
+
+
+bench_config = dict(sk8s.configs.default_config, service_account_name="default")
+
+
+def make_job_info(n):
+    return [sk8s.run(lambda i=i: i, config=bench_config, _map_helper=True) for i in range(n)]
+
+
+def bench_submit(n, chunk_size=100, max_workers=32):
+    job_info = make_job_info(n)
+    specs = [spec for _, spec in job_info]
+
+    with sk8s.testing.FakeKubeApiServer() as server:
+        api = sk8s.kube.client.BatchV1Api(server.api_client(pool_maxsize=max_workers))
+        start = time.time()
+        # Unpaced, at a fixed concurrency: how fast the client side can go.
+        submitter = sk8s.throttle.Submitter(qps=0, concurrency=max_workers, max_workers=max_workers)
+        errors = sk8s.kube.create_jobs(specs, namespace="default", api=api, submitter=submitter)
+        elapsed = time.time() - start
+        assert(len(errors) == 0 and len(server.jobs) == n)
+        print(f"api:     {n} jobs in {elapsed:.2f}s = {n / elapsed:.0f} jobs/s", flush=True)
+
+    if shutil.which("kubectl") is None:
+        print("kubectl: not found on PATH; skipping the subprocess baseline", flush=True)
+        return
+
+    # The old path: one `kubectl apply` per chunk of rendered YAML.
+    with sk8s.testing.FakeKubeApiServer() as server:
+        chunks = [specs[i:i + chunk_size] for i in range(0, n, chunk_size)]
+        start = time.time()
+        for chunk in chunks:
+            combined = "\n---\n".join(sk8s.jobs.yaml.safe_dump(spec) for spec in chunk)
+            subprocess.run(f"kubectl --server={server.url} --validate=false apply -f -",
+                           shell=True, input=combined.encode("utf-8"),
+                           stdout=subprocess.DEVNULL, check=True)
+        elapsed = time.time() - start
+        print(f"kubectl: {n} jobs in {elapsed:.2f}s = {n / elapsed:.0f} jobs/s (serial chunks of {chunk_size})", flush=True)
+
+
+def bench_ship(n, size):
+    # Manifest bytes and client CPU for a map whose function closes over `size` bytes.
+    data = sk8s.util.random_string(size)
+    func = lambda i: len(data) + i
+
+    start = time.time()
+    inline = [sk8s.run(lambda i=i: func(i), config=bench_config, _map_helper=True)[1] for i in range(n)]
+    inline_time = time.time() - start
+    inline_bytes = sum(len(json.dumps(spec)) for spec in inline)
+
+    start = time.time()
+    payload = sk8s.payloads.ship(func, dryrun=True)
+    shipped = [sk8s.run(payload, i, config=bench_config, _map_helper=True)[1] for i in range(n)]
+    shipped_time = time.time() - start
+    shipped_bytes = sum(len(json.dumps(spec)) for spec in shipped) + len(payload.data)
+
+    print(f"inline:  {n} jobs in {inline_time:.2f}s, {inline_bytes / 1e6:.1f} MB of manifests", flush=True)
+    print(f"shipped: {n} jobs in {shipped_time:.2f}s, {shipped_bytes / 1e6:.1f} MB of manifests + payload", flush=True)
+
+
+def bench_session(n):
+    # Per-call setup (sk8s config from disk, kubeconfig, a new client, the
+    # current namespace) redone on every call, as it used to be, vs. cached in a Session.
+    with sk8s.testing.FakeKubeApiServer() as server, tempfile.TemporaryDirectory() as tmp:
+        kubeconfig = server.write_kubeconfig(f"{tmp}/kubeconfig")
+        config_file = f"{tmp}/config.json"
+        sk8s.configs.save_config(bench_config, config_file)
+
+        def uncached():
+            sk8s.configs.load_config(config_file)
+            config.load_kube_config(config_file=kubeconfig)
+            api = client.BatchV1Api(client.ApiClient())
+            _, active = config.list_kube_config_contexts(config_file=kubeconfig)
+            return api, active["context"]["namespace"]
+
+        session = sk8s.session.Session(kubeconfig=kubeconfig, config_file=config_file)
+
+        def cached():
+            session.config
+            return session.batch_api(), session.namespace
+
+        for label, setup in (("uncached", uncached), ("session", cached)):
+            start = time.time()
+            for _ in range(n):
+                setup()
+            setup_time = time.time() - start
+            start = time.time()
+            for _ in range(n):
+                api, namespace = setup()
+                api.list_namespaced_job(namespace=namespace, _preload_content=False).release_conn()
+            elapsed = time.time() - start
+            print(f"{label + ':':9} {1000 * setup_time / n:.3f} ms/call setup, {1000 * elapsed / n:.2f} ms/call with one list request", flush=True)
+
+        if shutil.which("kubectl") is not None:
+            # And what get_current_namespace() used to cost by itself.
+            start = time.time()
+            for _ in range(min(n, 20)):
+                subprocess.run(f"kubectl --kubeconfig={kubeconfig} config view --minify --output 'jsonpath={{..namespace}}'",
+                               shell=True, check=True, stdout=subprocess.DEVNULL)
+            elapsed = time.time() - start
+            print(f"kubectl:  {1000 * elapsed / min(n, 20):.2f} ms per namespace lookup", flush=True)
+
+
+def bench_results(n, latency, spread=2.0):
+    # n jobs finishing over `spread` seconds, each result taking `latency`
+    # seconds to read. How long after the last job finishes do we have every
+    # result: fetching all at the end, vs. as jobs finish (what wait() does)?
+    def fault(method, path):
+        if path.endswith("/log"):
+            time.sleep(latency)
+
+    for label in ("at end", "as done"):
+        with sk8s.testing.FakeKubeApiServer(fault=fault) as server, tempfile.TemporaryDirectory() as tmp:
+            sk8s.configs.save_config(bench_config, f"{tmp}/config.json")
+            with sk8s.session.Session(kubeconfig=server.write_kubeconfig(f"{tmp}/kubeconfig"), config_file=f"{tmp}/config.json"):
+                jobs = sk8s.map(lambda i: i, range(n), asynchro=True)
+
+                last_finish = []
+                def finish():
+                    for i, job in enumerate(jobs):
+                        time.sleep(spread / n)
+                        server.api.complete_job("default", job, results=[i])
+                    last_finish.append(time.time())
+                threading.Thread(target=finish).start()
+
+                if label == "at end":
+                    table = sk8s.watch.JobTable("default", label_selector=sk8s.run_selector(jobs)).sync()
+                    table.until(lambda statuses: all(job in statuses and statuses[job]["finished"] for job in jobs))
+                    results = sk8s.get_jobs_results(jobs, "default", indexed={})
+                else:
+                    results = sk8s.wait(jobs, delete=False)
+                tail = time.time() - last_finish[0]
+                assert(results == list(range(n)))
+                print(f"{label + ':':8} {n} results, {tail:.2f}s after the last job finished", flush=True)
+
+
+def bench_encoding(sizes, json_max=1e8):
+    # A result of `size` bytes of float64s, and of random-ish data compressors
+    # can't do much with. JSON, as users send arrays today (tolist()), into
+    # the log, vs. the binary encoding into a (local file) result store.
+    import numpy as np
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in sizes:
+            result = np.random.default_rng(0).normal(size=int(size) // 8).round(3)
+
+            if size <= json_max:
+                start = time.time()
+                encoded = json.dumps(result.tolist()).encode("utf-8")
+                encode_time = time.time() - start
+                start = time.time()
+                decoded = np.array(json.loads(encoded))
+                decode_time = time.time() - start
+                assert((decoded == result).all())
+                print(f"{size:8.0e} bytes  json:         {len(encoded) / 1e6:9.1f} MB  encode {encode_time:6.2f}s  decode {decode_time:6.2f}s", flush=True)
+                del encoded, decoded
+            else:
+                print(f"{size:8.0e} bytes  json:         skipped, over -json_max", flush=True)
+
+            for compression in (None, "zlib", "zstd", "lz4"):
+                fname = f"{tmp}/result.sk8s"
+                try:
+                    start = time.time()
+                    with open(fname, "wb") as fp:
+                        sk8s.encoding.dump(result, fp, compression=compression)
+                    encode_time = time.time() - start
+                except ImportError as e:
+                    print(f"{size:8.0e} bytes  pickle+{compression}: skipped, {e}", flush=True)
+                    continue
+                start = time.time()
+                data = bytearray(os.path.getsize(fname))
+                with open(fname, "rb") as fp:
+                    fp.readinto(data)
+                decoded = sk8s.encoding.loads(data)
+                decode_time = time.time() - start
+                assert((decoded == result).all())
+                print(f"{size:8.0e} bytes  pickle+{str(compression):6} {len(data) / 1e6:9.1f} MB  encode {encode_time:6.2f}s  decode {decode_time:6.2f}s", flush=True)
+                del data, decoded
+
+
+def import_times(module):
+    # {imported module: cumulative microseconds}, from python -X importtime, in a fresh interpreter.
+    stderr = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            check=True, capture_output=True, text=True).stderr
+    times = dict()
+    for line in stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            _, cumulative, name = line.split("|")
+            if name.strip() == "site":
+                # Interpreter startup, before the import we're timing.
+                times.clear()
+            elif cumulative.strip().isdigit():
+                times[name.strip()] = int(cumulative)
+    return times
+
+
+def bench_imports(n, budget_ms):
+    # Interpreter startup for a job: importing the in-pod runner, and sk8s
+    # itself. Exits non-zero if the runner takes longer than budget_ms.
+    for module in ("sk8s", "sk8s.runner"):
+        runs = [import_times(module) for _ in range(n)]
+        best = min(runs, key=lambda times: times[module])
+        heaviest = sorted(((t, name) for name, t in best.items() if name != module), reverse=True)[:5]
+        print(f"import {module}: {best[module] / 1000:.1f}ms (best of {n})" +
+              "".join(f", {name} {t / 1000:.1f}ms" for t, name in heaviest), flush=True)
+    if best[module] / 1000 > budget_ms:
+        print(f"import sk8s.runner is over its {budget_ms}ms budget", flush=True)
+        sys.exit(1)
+
+
+def bench_pool(n, workers, task_seconds):
+    # Per-task overhead of a worker pool (see sk8s.pools), with local workers.
+    with sk8s.testing.local_pool(workers) as pool:
+        list(pool.map(time.sleep, [0] * workers))  # warm up
+        start = time.time()
+        list(pool.map(time.sleep, [task_seconds] * n))
+        elapsed = time.time() - start
+    ideal = n * task_seconds / workers
+    print(f"pool: {n} tasks of {task_seconds * 1000:.0f}ms on {workers} workers in {elapsed:.2f}s = {n / elapsed:.0f} tasks/s; "
+          f"{(elapsed - ideal) * workers / n * 1000:.2f}ms overhead per task", flush=True)
+
+
+def bench_local(n, workers):
+    # Per-task overhead of the local backend (see sk8s.backends) over the
+    # process pool it runs on: serializing, payloads, bootstrap, result
+    # encoding and collection. Run the same map on a cluster to see what the
+    # cluster adds on top.
+    arglists = [(i,) for i in range(n)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(abs, range(workers)))  # warm up
+        start = time.time()
+        list(executor.map(abs, range(n)))
+        bare = time.time() - start
+    with sk8s.LocalBackend(max_workers=workers):
+        sk8s.map_arglists(abs, arglists[:workers], config=bench_config)  # warm up
+        start = time.time()
+        sk8s.map_arglists(abs, arglists, config=bench_config)
+        local = time.time() - start
+    print(f"local: {n} tasks on {workers} processes: process pool {bare / n * 1000:.3f}ms per task, "
+          f"local backend {local / n * 1000:.3f}ms per task ({n / local:.0f} tasks/s)", flush=True)
+
+
+def bench_throttle(n, server_qps, server_burst=50, max_workers=64):
+    # Submission to an API server that rejects with 429 beyond server_qps:
+    # with no retries, as before, vs with them and adaptive concurrency.
+    specs = [spec for _, spec in make_job_info(n)]
+    submitters = [("unretried", sk8s.throttle.Submitter(qps=0, concurrency=max_workers, max_workers=max_workers, retries=0)),
+                  ("adaptive", sk8s.throttle.Submitter(qps=0, max_workers=max_workers))]
+    for label, submitter in submitters:
+        with sk8s.testing.FakeKubeApiServer(fault=sk8s.testing.rate_limit(server_qps, server_burst)) as server:
+            api = sk8s.kube.client.BatchV1Api(server.api_client(pool_maxsize=max_workers))
+            start = time.time()
+            sk8s.kube.create_jobs(specs, namespace="default", api=api, submitter=submitter)
+            elapsed = time.time() - start
+            stats = submitter.snapshot()
+            print(f"{label + ':':9} {stats['accepted']} of {n} jobs created in {elapsed:.2f}s = {stats['accepted'] / elapsed:.0f} jobs/s; "
+                  f"{stats['throttled']} throttled, {stats['failed']} failed, {stats['submitted']} requests, "
+                  f"final concurrency {stats['concurrency']}", flush=True)
+
+
+def bench_cleanup(n, max_workers=64):
+    # Deleting a finished run's jobs: one request per job vs. one for the run.
+    job_info = [sk8s.run(lambda i=i: i, config=bench_config, run_id="bench", task_index=i, _map_helper=True) for i in range(n)]
+    jobs = [job for job, _ in job_info]
+    specs = [spec for _, spec in job_info]
+    submitter = sk8s.throttle.Submitter(qps=0, concurrency=max_workers, max_workers=max_workers)
+    for label, selector in (("by name", None), ("by run", sk8s.run_selector(jobs))):
+        with sk8s.testing.FakeKubeApiServer() as server:
+            api = sk8s.kube.client.BatchV1Api(server.api_client(pool_maxsize=max_workers))
+            sk8s.kube.create_jobs(specs, namespace="default", api=api, submitter=submitter)
+            before = server.api.requests
+            start = time.time()
+            errors = sk8s.kube.delete_jobs(jobs, namespace="default", api=api, label_selector=selector, submitter=submitter)
+            elapsed = time.time() - start
+            assert(len(errors) == 0 and len(server.jobs) == 0)
+            print(f"{label + ':':8} {n} jobs deleted in {elapsed:.2f}s with {server.api.requests - before} requests", flush=True)
+
+
+def bench_futures(n, spread=2.0):
+    # n outstanding jobs, finishing over `spread` seconds: a wait() per job,
+    # each in its own thread, vs. a future per job, all on one watch.
+    for label in ("waits", "futures"):
+        with sk8s.testing.FakeKubeApiServer() as server, tempfile.TemporaryDirectory() as tmp:
+            sk8s.configs.save_config(bench_config, f"{tmp}/config.json")
+            with sk8s.session.Session(kubeconfig=server.write_kubeconfig(f"{tmp}/kubeconfig"), config_file=f"{tmp}/config.json"):
+                before = server.api.requests
+                if label == "waits":
+                    jobs = [sk8s.run(lambda i=i: i) for i in range(n)]
+                else:
+                    futures = [sk8s.submit(lambda i=i: i, delete=False) for i in range(n)]
+                    jobs = [future.job for future in futures]
+
+                start = time.time()
+                def finish():
+                    for i, job in enumerate(jobs):
+                        time.sleep(spread / n)
+                        server.api.complete_job("default", job, results=[i])
+                threading.Thread(target=finish).start()
+
+                if label == "waits":
+                    with ThreadPoolExecutor(max_workers=n) as executor:
+                        results = list(executor.map(lambda job: sk8s.wait(job, delete=False), jobs))
+                else:
+                    results = [future.result() for future in futures]
+                    futures[0].watcher.close()
+                elapsed = time.time() - start
+                assert(results == list(range(n)))
+                watches = len([path for t, method, path in server.api.history[before:] if method == "GET" and path.endswith("/jobs")])
+                print(f"{label + ':':8} {n} jobs in {elapsed:.2f}s, {server.api.requests - before} requests (with {n} creates), "
+                      f"{watches} of them job lists and watches", flush=True)
+
+
+def bench_aio(n):
+    # n jobs outstanding on one event loop, all finishing at once.
+    import asyncio
+    import sk8s.aio
+
+    with sk8s.testing.FakeKubeApiServer() as server, tempfile.TemporaryDirectory() as tmp:
+        sk8s.configs.save_config(dict(bench_config, submit_qps=0), f"{tmp}/config.json")
+        with sk8s.session.Session(kubeconfig=server.write_kubeconfig(f"{tmp}/kubeconfig"), config_file=f"{tmp}/config.json"):
+            async def main():
+                start = time.time()
+                futures = await sk8s.aio.submit_map(lambda: None, [()] * n, delete=False)
+                submitted = time.time() - start
+                threads = threading.active_count()
+                for _, job in list(server.jobs):
+                    server.api.complete_job("default", job)
+                start = time.time()
+                assert(await sk8s.aio.wait(futures) == [None] * n)
+                return submitted, time.time() - start, threads
+            submitted, collected, threads = asyncio.run(main())
+    print(f"aio: {n} jobs submitted in {submitted:.2f}s, results collected in {collected:.2f}s, "
+          f"{threads} threads with all of them outstanding", flush=True)
+
+
+def sleep_then(seconds, value):
+    time.sleep(seconds)
+    return value
+
+
+def bench_dag(n, seconds):
+    # A workflow shaped like example_workflow.ngs_workflow -- align each
+    # sample, then QC it and call its SNPs, then merge the QC -- with slow and
+    # fast samples, run stage by stage (a wait() between stages) and as a
+    # graph of tasks (deps=), on the local backend.
+    align = lambda i: seconds * (0.4 + 0.6 * (i % 2))
+    snps = lambda i: seconds * (0.4 + 0.6 * ((i + 1) % 2))
+    with sk8s.LocalBackend(max_workers=2 * n + 1):
+        sk8s.map_arglists(abs, [(i,) for i in range(2 * n + 1)], config=bench_config)  # warm up
+        start = time.time()
+        bams = sk8s.map_arglists(sleep_then, [(align(i), i) for i in range(n)], config=bench_config)
+        qcs = sk8s.map_arglists(sleep_then, [(seconds * 0.2, bam) for bam in bams], config=bench_config)
+        sk8s.map_arglists(sleep_then, [(snps(i), bam) for i, bam in enumerate(bams)], config=bench_config)
+        sk8s.run(sleep_then, seconds * 0.2, qcs, asynchro=False, config=bench_config)
+        staged = time.time() - start
+
+        start = time.time()
+        bams = [sk8s.submit(sleep_then, align(i), i, config=bench_config) for i in range(n)]
+        qcs = [sk8s.run(lambda inputs: sleep_then(seconds * 0.2, list(inputs.values())[0]), deps=bam, config=bench_config) for bam in bams]
+        calls = [sk8s.run(lambda inputs, i=i: sleep_then(snps(i), list(inputs.values())[0]), deps=bam, config=bench_config) for i, bam in enumerate(bams)]
+        merged = sk8s.run(lambda inputs: sleep_then(seconds * 0.2, list(inputs.values())), deps=qcs, config=bench_config)
+        sk8s.wait([merged] + calls)
+        graph = time.time() - start
+    print(f"dag: {n} samples, stage by stage {staged:.2f}s, as a graph {graph:.2f}s "
+          f"(critical path {seconds * 1.4:.2f}s)", flush=True)
+
+
+def bench_refs(n, size):
+    # A two-stage map, with stage one's results handed to stage two by value
+    # (fetched by the client and put in the next jobs) vs. by reference (read
+    # by the next jobs from the result store), on the local backend.
+    import dill
+    with tempfile.TemporaryDirectory() as tmp, sk8s.LocalBackend(max_workers=4):
+        config = dict(bench_config, result_obs_prefix=f"file://{tmp}/results/", result_encoding="pickle")
+        make = lambda i: os.urandom(size)
+        arglists = [(i,) for i in range(n)]
+
+        start = time.time()
+        blobs = sk8s.map_arglists(make, arglists, config=config)
+        through_client = sum(len(blob) for blob in blobs)
+        sk8s.map_arglists(len, [(blob,) for blob in blobs], config=config)
+        by_value = time.time() - start
+
+        start = time.time()
+        jobs = sk8s.map_arglists(make, arglists, asynchro=True, config=config)
+        refs = [sk8s.ref(job, config=config) for job in jobs]
+        sk8s.map_arglists(len, [(ref,) for ref in refs], config=config)
+        by_reference = time.time() - start
+        referenced = sum(len(dill.dumps(ref)) for ref in refs)
+    print(f"refs: {n} results of {size} bytes: by value {by_value:.2f}s, {through_client * 2 / 1e6:.1f}MB through the client; "
+          f"by reference {by_reference:.2f}s, {referenced / 1e3:.1f}kB", flush=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("benchmarks")
+    subparsers = parser.add_subparsers(help="benchmarks", dest="benchmark")
+
+    submit = subparsers.add_parser('submit', help='job submission throughput, API client vs kubectl apply')
+    submit.add_argument('-n', type=int, default=2000, help='number of jobs')
+    submit.add_argument('-chunk_size', type=int, default=100, help='jobs per kubectl apply')
+    submit.add_argument('-max_workers', type=int, default=32, help='concurrent API requests')
+
+    ship = subparsers.add_parser('ship', help='manifest size and build time, function inlined per job vs shipped once')
+    ship.add_argument('-n', type=int, default=1000, help='number of jobs')
+    ship.add_argument('-size', type=int, default=10000, help='bytes captured by the mapped function')
+
+    session = subparsers.add_parser('session', help='per-call overhead, config and client rebuilt every call vs cached in a Session')
+    session.add_argument('-n', type=int, default=200, help='number of calls')
+
+    results = subparsers.add_parser('results', help='time from the last job finishing to having every result')
+    results.add_argument('-n', type=int, default=500, help='number of jobs')
+    results.add_argument('-latency', type=float, default=0.05, help='seconds to read each result')
+
+    encoding = subparsers.add_parser('encoding', help='result size and encode/decode time, JSON in logs vs binary encoding')
+    encoding.add_argument('-sizes', default="1e6,1e8", help='comma-separated result sizes, in bytes')
+    encoding.add_argument('-json_max', type=float, default=1e8, help='largest size to try JSON at (it needs ~10x the size in memory)')
+
+    imports = subparsers.add_parser('imports', help='import time of sk8s and of the in-pod runner; fails over budget')
+    imports.add_argument('-n', type=int, default=5, help='number of tries')
+    imports.add_argument('-budget_ms', type=float, default=100, help='most the runner import may take')
+
+    pool = subparsers.add_parser('pool', help='per-task overhead of a worker pool, with local workers')
+    pool.add_argument('-n', type=int, default=2000, help='number of tasks')
+    pool.add_argument('-workers', type=int, default=8, help='number of workers')
+    pool.add_argument('-task_seconds', type=float, default=0.0, help='how long each task takes')
+
+    local = subparsers.add_parser('local', help='per-task overhead of the local backend over a bare process pool')
+    local.add_argument('-n', type=int, default=1000, help='number of tasks')
+    local.add_argument('-workers', type=int, default=8, help='number of processes')
+
+    throttle = subparsers.add_parser('throttle', help='submission to an API server that rejects requests beyond a rate')
+    throttle.add_argument('-n', type=int, default=2000, help='number of jobs')
+    throttle.add_argument('-server_qps', type=float, default=200, help='job creations per second the server accepts')
+    throttle.add_argument('-max_workers', type=int, default=64, help='most concurrent API requests')
+
+    cleanup = subparsers.add_parser('cleanup', help='deleting a finished run, job by job vs. one deletecollection')
+    cleanup.add_argument('-n', type=int, default=10000, help='number of jobs')
+
+    futures = subparsers.add_parser('futures', help='API requests to follow many outstanding jobs, a wait() each vs. futures')
+    futures.add_argument('-n', type=int, default=200, help='number of jobs')
+
+    aio = subparsers.add_parser('aio', help='many outstanding jobs on one asyncio event loop')
+    aio.add_argument('-n', type=int, default=10000, help='number of jobs')
+
+    dag = subparsers.add_parser('dag', help='a branching workflow, stage by stage vs. tasks started as their inputs finish')
+    dag.add_argument('-n', type=int, default=4, help='number of samples')
+    dag.add_argument('-seconds', type=float, default=0.5, help='how long the slowest step takes')
+
+    refs = subparsers.add_parser('refs', help='results passed from one map to the next, by value vs. by reference')
+    refs.add_argument('-n', type=int, default=20, help='number of jobs per stage')
+    refs.add_argument('-size', type=int, default=10000000, help='bytes in each result')
+
+    args = parser.parse_args()
+
+    if args.benchmark == "submit":
+        bench_submit(args.n, chunk_size=args.chunk_size, max_workers=args.max_workers)
+
+    if args.benchmark == "ship":
+        bench_ship(args.n, args.size)
+
+    if args.benchmark == "session":
+        bench_session(args.n)
+
+    if args.benchmark == "results":
+        bench_results(args.n, args.latency)
+
+    if args.benchmark == "encoding":
+        bench_encoding([float(size) for size in args.sizes.split(",")], json_max=args.json_max)
+
+    if args.benchmark == "imports":
+        bench_imports(args.n, args.budget_ms)
+
+    if args.benchmark == "pool":
+        bench_pool(args.n, args.workers, args.task_seconds)
+
+    if args.benchmark == "local":
+        bench_local(args.n, args.workers)
+
+    if args.benchmark == "throttle":
+        bench_throttle(args.n, args.server_qps, max_workers=args.max_workers)
+
+    if args.benchmark == "cleanup":
+        bench_cleanup(args.n)
+
+    if args.benchmark == "futures":
+        bench_futures(args.n)
+
+    if args.benchmark == "aio":
+        bench_aio(args.n)
+
+    if args.benchmark == "dag":
+        bench_dag(args.n, args.seconds)
+
+    if args.benchmark == "refs":
+        bench_refs(args.n, args.size)
@@ -64,7 +64,10 @@ def count_words_workflow(url):
                                 imports=["collections", "re", "functools"])
 
     #from IPython import embed; embed(header="inside_workflow")
-    return collections.Counter(sk8s.wait(merged_counts_job))
+    counts = collections.Counter(sk8s.wait(merged_counts_job))
+    # Named dependencies are ours to delete, now that nothing else depends on them.
+    sk8s.delete_jobs(count_jobs)
+    return counts
 
 
 
@@ -102,24 +105,20 @@ def call_snps(bam):
 
 
 def ngs_workflow(batch_folder):
-    def wf(batch_folder):
-        import json, sys
-        fastqs = sk8s.wait(sk8s.run(demux_batch, batch_folder))
-        bams = sk8s.map(align_bam, fastqs)
-        sample_qcs = sk8s.map(sample_qc, bams)
-        snps = sk8s.map(call_snps, bams)
-        basic_stats = sk8s.wait(sk8s.run(merge_qc, sample_qcs))
-        return dict(fastq=fastqs,
-                    bams=bams,
-                    sample_qcs=sample_qcs,
-                    snps=snps,
-                    basic_stats=basic_stats)
-
-    #print(k8s.run(wf, batch_folder, test=True))
-
-    wf_job = sk8s.run(wf, batch_folder)
-    print("wf_job:", wf_job, flush=True)
-    results = sk8s.wait(wf_job)
+    # A graph of jobs: each sample's QC and SNP calls start as soon as its
+    # alignment is done, and the merge as soon as the last QC is. Nothing
+    # waits between stages, so no workflow pod is needed to do the waiting.
+    fastqs = sk8s.submit(demux_batch, batch_folder).result()
+    bams = [sk8s.submit(align_bam, fastq) for fastq in fastqs]
+    sample_qcs = [sk8s.run(lambda inputs: sample_qc(*inputs.values()), deps=bam) for bam in bams]
+    snps = [sk8s.run(lambda inputs: call_snps(*inputs.values()), deps=bam) for bam in bams]
+    basic_stats = sk8s.run(lambda inputs: merge_qc(list(inputs.values())), deps=sample_qcs)
+
+    results = dict(fastq=fastqs,
+                   bams=sk8s.wait(bams),
+                   sample_qcs=sk8s.wait(sample_qcs),
+                   snps=sk8s.wait(snps),
+                   basic_stats=sk8s.wait(basic_stats))
     print(json.dumps(results, indent=4))
     return results
 
@@ -20,6 +20,9 @@ setup(
                       'kubernetes',
                       'pandas',
                       ],
+    extras_require={'compression': ['zstandard', 'lz4'],
+                    's3': ['boto3'],
+                    'gcs': ['google-cloud-storage']},
     package_dir={'sk8s': 'sk8s'},
     package_data={'sk8s': ['sk8s/*.yaml',
                            'sk8s/*.txt',
@@ -1,11 +1,50 @@
+import importlib
+import importlib.util
 
-from .configs import *
-from .jobs import *
-from .containers import *
-from .volumes import *
-#from .state import *  # disable workflow state for now; fix later
-from .util import *
-from .kafka import *
-#from .clouds import *
+# The public API, by the module it comes from. Loaded on first use, so that
+# `import sk8s` -- and so every job's startup (see sk8s.runner) -- doesn't pay
+# for kubernetes, pandas and the rest until something needs them.
+_exports = {
+    "configs": ["default_config", "default_fname", "get_homedir", "load_config", "reset_config", "save_config"],
+    "jobs": ["JobName", "check_cluster_config", "chunked_map", "chunked_starmap", "chunked_wait", "compiled_template",
+             "completion_index_annotation", "default_bootstrap_template", "default_job_template", "delete_jobs",
+             "fetch_job_results_obs", "fetch_pod_results", "get_completed_pod_from_jobs", "get_job_statuses",
+             "get_jobs_results", "imap", "imap_unordered", "job_spec", "job_status_columns", "label_job", "map",
+             "map_arglists", "max_chunk_bytes", "max_runs_per_selector", "pack_chunks", "run", "run_indexed",
+             "run_label", "run_selector", "starmap", "submit_jobs", "task_index_label", "wait", "wait_subtrees"],
+    "results": ["load_result", "ref"],
+    "containers": ["docker_build", "docker_build_jobs_image", "docker_name", "docker_push", "docker_template"],
+    "volumes": ["create_volume", "default_volume_template", "delete_volume"],
+    #"state": [...],  # disable workflow state for now; fix later
+    "util": ["check_for_kwargs", "deserialize_func", "get_current_namespace", "get_k8s_config", "get_pod_names_from_job",
+             "get_pods_from_job", "in_pod", "interactive_job", "random_string", "run_cmd", "serialize_func",
+             "set_namespace", "wipe_namespace"],
+    "session": ["Session", "get_session"],
+    "backends": ["LocalBackend", "get_backend"],
+    "futures": ["JobFuture", "as_completed", "submit"],
+    "throttle": ["Submitter", "get_submitter", "submit_stats"],
+    "pools": ["pool"],
+    "kafka": ["build_kafka_image", "create_kafka", "default_kafka_template", "kafka_docker_instructions"],
+    #"clouds": [...],
+}
+_modules = {name: module for module, names in _exports.items() for name in names}
 
-__version__ = "0.1.0"
\ No newline at end of file
+__all__ = list(_modules)
+__version__ = "0.1.0"
+
+
+def __getattr__(name):
+    # Only the names above, and the submodules: anything else (IPython's
+    # _repr_html_ and friends, say) is missing without importing a thing.
+    if name in _modules:
+        value = getattr(importlib.import_module(f"sk8s.{_modules[name]}"), name)
+    elif (not name.startswith("_")) and (importlib.util.find_spec(f"sk8s.{name}") is not None):
+        value = importlib.import_module(f"sk8s.{name}")
+    else:
+        raise AttributeError(f"module 'sk8s' has no attribute {name!r}")
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_modules))
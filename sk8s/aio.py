@@ -0,0 +1,105 @@
+import asyncio
+import functools
+import itertools
+
+import sk8s.futures
+import sk8s.jobs
+
+
+# asyncio versions of run, map and wait, for callers with an event loop:
+#
+#   result = await sk8s.aio.run(f, x)
+#   results = await sk8s.aio.map(f, range(1000))
+#   async for result in sk8s.aio.imap(f, range(1000), ordered=False):
+#       ...
+#
+# A job in flight is an asyncio future chained to its JobFuture (see
+# sk8s.futures), which the process's one watch thread resolves; awaiting it
+# ties up no thread, so one event loop can have tens of thousands of jobs
+# outstanding for the memory of a couple of futures each. Only the job
+# creation requests go to a thread, one per call however many jobs it
+# creates. Cancelling an awaiting task, or a timeout running out, deletes its
+# jobs; a job failing doesn't, any more than it does in sk8s.wait().
+#
+# There's no asyncio Kubernetes client underneath -- sk8s uses the official
+# one -- but with status watching and result fetching shared, what's left to
+# block is short and bounded by the loop's default executor.
+
+
+async def call(func, *args, **kwargs):
+    # func(*args, **kwargs), on the loop's default executor.
+    return await asyncio.get_running_loop().run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+
+async def submit(func, *args, **kwargs):
+    # Starts func(*args) as a job; returns an asyncio future of its result.
+    # Keyword arguments are as for sk8s.submit().
+    return asyncio.wrap_future(await call(sk8s.futures.submit, func, *args, **kwargs))
+
+
+async def submit_map(func, arglists, **kwargs):
+    return [asyncio.wrap_future(future) for future in await call(sk8s.futures.submit_map, func, list(arglists), **kwargs)]
+
+
+async def run(func, *args, timeout=None, **kwargs):
+    return await asyncio.wait_for(await submit(func, *args, **kwargs), timeout)
+
+
+async def starmap(func, iterable, timeout=None, **kwargs):
+    futures = await submit_map(func, [tuple(args) for args in iterable], **kwargs)
+    return await wait(futures, timeout=timeout)
+
+
+async def map(func, iterable, timeout=None, **kwargs):
+    return await starmap(func, [(arg,) for arg in iterable], timeout=timeout, **kwargs)
+
+
+async def imap(func, iterable, max_in_flight=100, ordered=True, **kwargs):
+    # Yields func(arg) for each arg as the jobs finish: in input order, or in
+    # completion order if ordered=False. As with sk8s.imap(), the iterable is
+    # pulled from only as jobs finish, so that at most max_in_flight jobs are
+    # submitted but not yet yielded, and it can be endless. Jobs still running
+    # when the caller stops iterating are cancelled.
+    payload = await call(sk8s.futures.ship, func, config=kwargs.get("config"))
+    args = iter(iterable)
+    exhausted = False
+    futures = []  # submitted, not yet yielded; in input order
+    try:
+        while True:
+            room = max_in_flight - len(futures)
+            if (not exhausted) and (room > 0):
+                batch = list(itertools.islice(args, room))
+                exhausted = len(batch) < room
+                if len(batch) > 0:
+                    futures += await submit_map(payload, [(arg,) for arg in batch], **kwargs)
+            if len(futures) == 0:
+                break
+            if ordered:
+                # Left in the list until it's done, so that it's cancelled with the rest if we are.
+                result = await futures[0]
+                futures.pop(0)
+                yield result
+                continue
+            done, _ = await asyncio.wait(futures, return_when=asyncio.FIRST_COMPLETED)
+            futures = [future for future in futures if future not in done]
+            for future in done:
+                yield future.result()
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+async def wait(jobs, timeout=None, **kwargs):
+    # Futures from submit() or submit_map(), or the names of jobs started
+    # some other way (these waited on as sk8s.wait() does, in a thread).
+    if asyncio.isfuture(jobs):
+        return (await wait([jobs], timeout=timeout))[0]
+    if all(asyncio.isfuture(job) for job in jobs):
+        try:
+            return await asyncio.wait_for(asyncio.gather(*jobs), timeout)
+        except (asyncio.CancelledError, asyncio.TimeoutError):
+            # Given up on: the jobs go too. One failing leaves the rest running, as sk8s.wait() does.
+            for job in jobs:
+                job.cancel()
+            raise
+    return await call(sk8s.jobs.wait, jobs, timeout=timeout, **kwargs)
@@ -0,0 +1,220 @@
+import functools
+import multiprocessing.util
+import os
+import shutil
+import tempfile
+import threading
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+
+import sk8s.results
+import sk8s.runner
+import sk8s.session
+import sk8s.store
+import sk8s.watch
+
+
+# Where jobs run. By default, in the cluster. The local backend runs them in
+# a pool of processes on this machine instead: each job's bootstrap -- the
+# program its pod would run, with the same serialized task, payload, config
+# and result encoding -- runs in a worker process, and what it prints stands
+# in for the pod's log. run(), map(), imap(), wait() and the rest work as
+# they would with a cluster, so it's good for development, for CI with no
+# cluster, and as a baseline for what the cluster adds per task (see
+# benchmarks.py local).
+#
+#   with sk8s.LocalBackend(max_workers=8):
+#       sk8s.map(f, range(100))
+#
+# or set "backend": "local" in the sk8s config (and optionally
+# "local_workers"). Volumes other than the payload's aren't mounted: the
+# jobs see this machine's filesystem.
+
+backends = ["kubernetes", "local"]
+
+
+def pod_env(spec):
+    return {var["name"]: var["value"] for var in spec["spec"]["template"]["spec"]["containers"][0].get("env", [])}
+
+
+class LocalBackend:
+    namespace = "local"
+
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers
+        # A backend belongs to the process that made it. Its jobs' processes
+        # may be forked from this one, but jobs they run go to a backend of their own.
+        self.pid = os.getpid()
+        self.executor = None
+        self.directory = None
+        # Held while the jobs change, and notified when they have.
+        self.condition = threading.Condition(threading.RLock())
+        self.jobs = dict()  # name -> the Job, as the API server would return it
+        self.logs = dict()  # name -> its log, or for Indexed jobs a list of them by completion index
+        self.pods = dict()  # name -> futures of its pods
+        self.tables = weakref.WeakSet()
+
+    def payload_url(self, name):
+        # Payloads that would be in a ConfigMap are files here instead.
+        if self.directory is None:
+            self.directory = tempfile.mkdtemp(prefix="sk8s-local-")
+        return f"file://{self.directory}/{name}"
+
+    def put(self, payload):
+        with self.condition:
+            url = self.payload_url(payload.name)
+        if not os.path.exists(url[len("file://"):]):
+            sk8s.store.put(url, payload.data)
+
+    def release(self, digests):
+        # Deletes the payloads that no remaining job refers to, and returns their digests.
+        with self.condition:
+            in_use = set(sk8s.watch.job_status(job)["payload"] for job in self.jobs.values())
+            released = [digest for digest in digests if digest not in in_use]
+            for digest in released:
+                if self.directory is not None:
+                    path = os.path.join(self.directory, f"sk8s-payload-{digest}")
+                    if os.path.exists(path):
+                        os.remove(path)
+        return released
+
+    def submit(self, job_info):
+        with self.condition:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(max_workers=self.max_workers)
+                # If this process is itself one of a backend's workers (a
+                # job submitting jobs), its workers must be shut down before
+                # it exits, or it waits for them forever -- and before the
+                # finalizers of the executor's own queues run.
+                multiprocessing.util.Finalize(self, self.executor.shutdown, exitpriority=100)
+            for job, spec in job_info:
+                if job in self.jobs:
+                    raise RuntimeError(f"Job {job} already exists.")
+                spec["metadata"]["namespace"] = self.namespace
+                spec["status"] = dict(active=0, succeeded=0, failed=0)
+                indexed = spec["spec"].get("completionMode") == "Indexed"
+                self.jobs[job] = spec
+                self.logs[job] = [None] * spec["spec"]["completions"] if indexed else None
+                self.pods[job] = []
+                self.changed(job)
+                for i in range(spec["spec"]["completions"] if indexed else 1):
+                    self.start(job, i if indexed else None)
+        return [job for job, _ in job_info]
+
+    def start(self, job, index):
+        # Call with the condition held.
+        spec = self.jobs[job]
+        env = pod_env(spec)
+        for volume in spec["spec"]["template"]["spec"].get("volumes") or []:
+            if "configMap" in volume:
+                env[sk8s.runner.payload_url_env] = self.payload_url(volume["configMap"]["name"])
+        if index is not None:
+            env["JOB_COMPLETION_INDEX"] = str(index)
+        spec["status"]["active"] += 1
+        bootstrap = spec["spec"]["template"]["spec"]["containers"][0]["command"][-1]
+        future = self.executor.submit(sk8s.runner.run_pod, bootstrap, env)
+        self.pods[job].append(future)
+        future.add_done_callback(functools.partial(self.finish, job, index))
+
+    def finish(self, job, index, future):
+        with self.condition:
+            if job not in self.jobs:
+                # Deleted.
+                return
+            spec = self.jobs[job]
+            status = spec["status"]
+            status["active"] -= 1
+            if not future.cancelled():
+                succeeded, log = future.result() if future.exception() is None else (False, None)
+                if succeeded:
+                    status["succeeded"] += 1
+                    if index is None:
+                        self.logs[job] = log
+                    else:
+                        self.logs[job][index] = log
+                else:
+                    status["failed"] += 1
+                    if status["failed"] <= spec["spec"].get("backoffLimit", 6):
+                        self.start(job, index)
+                    else:
+                        for pod in self.pods[job]:
+                            pod.cancel()
+            completions = spec["spec"].get("completions") or 1
+            if status["active"] == 0:
+                if status["succeeded"] >= completions:
+                    status["conditions"] = [dict(type="Complete", status="True")]
+                elif status["failed"] > spec["spec"].get("backoffLimit", 6):
+                    status["conditions"] = [dict(type="Failed", status="True")]
+            self.changed(job)
+
+    def changed(self, job, deleted=False):
+        # Call with the condition held.
+        event = dict(type="DELETED" if deleted else "MODIFIED", raw_object=self.jobs[job])
+        for table in list(self.tables):
+            table.update(event)
+        self.condition.notify_all()
+
+    def delete(self, jobs):
+        with self.condition:
+            for job in jobs:
+                if job not in self.jobs:
+                    continue
+                self.changed(job, deleted=True)
+                del self.jobs[job]
+                del self.logs[job]
+                for pod in self.pods.pop(job):
+                    pod.cancel()
+
+    def statuses(self, label_selector=None):
+        with self.condition:
+            return [sk8s.watch.job_status(job) for job in self.jobs.values() if sk8s.watch.selected(job, label_selector)]
+
+    def table(self, label_selector=None, field_selector=None):
+        return sk8s.watch.LocalJobTable(self, label_selector=label_selector, field_selector=field_selector).sync()
+
+    def collector(self, sk8s_config=None, max_workers=None):
+        return sk8s.results.LocalResultCollector(self, sk8s_config=sk8s_config, max_workers=max_workers)
+
+    def close(self):
+        # Jobs still running are abandoned.
+        with self.condition:
+            executor, self.executor = self.executor, None
+            self.delete(list(self.jobs))
+            if self.directory is not None:
+                shutil.rmtree(self.directory, ignore_errors=True)
+                self.directory = None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def __enter__(self):
+        _active.append(self)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        _active.remove(self)
+        self.close()
+
+
+# Backends entered with `with`, innermost last (like sessions, see sk8s.session).
+_active = []
+
+# The local backend used when the config asks for one, by process and number of workers.
+_configured = dict()
+
+
+def get_backend(config=None):
+    # The backend jobs run on: a LocalBackend, or None for the cluster.
+    active = [backend for backend in _active if backend.pid == os.getpid()]
+    if len(active) > 0:
+        return active[-1]
+    if config is None:
+        config = sk8s.session.get_session().config
+    backend = config.get("backend") or "kubernetes"
+    if backend not in backends:
+        raise ValueError(f"Unknown backend {backend!r}; expected one of {', '.join(backends)}.")
+    if backend == "kubernetes":
+        return None
+    key = (os.getpid(), config.get("local_workers"))
+    if key not in _configured:
+        _configured[key] = LocalBackend(max_workers=key[1])
+    return _configured[key]
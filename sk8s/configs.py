@@ -4,6 +4,7 @@ import json
 import subprocess
 
 import sk8s.util
+from sk8s.runner import config_env
 
 
 def get_homedir():
@@ -23,6 +24,11 @@ default_config = dict(
 
 
 def load_config(fname=default_fname, create=True):
+    # In a job, the config it was submitted with (see sk8s.runner) stands in
+    # for the file -- until the job saves a config of its own.
+    if (fname == default_fname) and (config_env in os.environ) and not os.path.exists(fname):
+        return json.loads(os.environ[config_env])
+
     if not os.path.exists(fname):
         save_config(default_config, fname)
 
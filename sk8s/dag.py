@@ -0,0 +1,197 @@
+import concurrent.futures
+import functools
+import os
+import threading
+
+import sk8s.futures
+import sk8s.jobs
+import sk8s.payloads
+import sk8s.results
+import sk8s.runner
+
+
+# Workflows as graphs of jobs. run(..., deps=...) returns at once with a Task,
+# a future of the job's result, and starts the job the moment the jobs it
+# depends on have all succeeded, passing their results in as `inputs`:
+#
+#   bams = [sk8s.submit(align_bam, fastq) for fastq in fastqs]
+#   qcs = [sk8s.run(lambda inputs: sample_qc(*inputs.values()), deps=bam) for bam in bams]
+#   snps = [sk8s.run(lambda inputs: call_snps(*inputs.values()), deps=bam) for bam in bams]
+#   stats = sk8s.run(lambda inputs: merge_qc(list(inputs.values())), deps=qcs)
+#   sk8s.wait(stats)
+#
+# Nothing blocks between stages, here or in a workflow pod: independent
+# branches (each sample's QC and SNP calls above) run side by side, and each
+# one moves on as soon as its own inputs are ready rather than when its whole
+# stage is.
+#
+# A dependency is a future (from sk8s.submit(), or another Task), or the name
+# of a job started some other way -- run() or map() with asynchro=True. The
+# futures are followed by the process's one watcher (see sk8s.futures); a
+# task's named jobs are waited on together, in a thread. If a dependency
+# fails, so does every task downstream of it, without being run. Named jobs
+# aren't deleted here, since a task scheduled later may yet depend on them:
+# the caller deletes them (sk8s.delete_jobs) once their dependents have all
+# started, or gives them a ttlSecondsAfterFinished.
+#
+# Jobs whose arguments refer to other jobs' results (see sk8s.results.ref)
+# are scheduled the same way, with the referenced jobs as dependencies, but
+# aren't passed `inputs`: they read the results for themselves, and the
+# client only follows the referenced jobs' status.
+
+# Threads for starting tasks and waiting on named jobs; a task waiting on
+# named jobs holds one until they finish.
+max_workers = 64
+
+# The process's: a process forked from this one starts its own.
+_executor = None
+_pid = None
+_lock = threading.Lock()
+
+
+def executor():
+    global _executor, _pid
+    with _lock:
+        if (_executor is None) or (_pid != os.getpid()):
+            _executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="sk8s-dag")
+            _pid = os.getpid()
+        return _executor
+
+
+class Task(concurrent.futures.Future):
+    def __init__(self, deps):
+        super().__init__()
+        self.deps = deps
+        # The job's name and JobFuture, once it's started.
+        self.job = None
+        self.future = None
+        self.lock = threading.Lock()
+
+    def cancel(self):
+        # A task not yet started never will be; a running one has its job deleted.
+        if not super().cancel():
+            return False
+        self.set_running_or_notify_cancel()
+        with self.lock:
+            future = self.future
+        if future is not None:
+            future.cancel()
+        return True
+
+    def start(self, submit):
+        with self.lock:
+            if self.cancelled():
+                return
+            self.future = future = submit()
+            self.job = future.job
+        future.add_done_callback(self.settle)
+
+    def settle(self, future):
+        try:
+            if future.cancelled():
+                self.set_exception(concurrent.futures.CancelledError(f"Job {future.job} was cancelled."))
+            elif future.exception() is not None:
+                self.set_exception(future.exception())
+            else:
+                self.set_result(future.result())
+        except concurrent.futures.InvalidStateError:
+            # Cancelled meanwhile.
+            pass
+
+
+def flatten(deps):
+    # A dependency, or a list, tuple or dict (its values) of them.
+    if deps.__class__ == dict:
+        deps = list(deps.values())
+    if deps.__class__ in (list, tuple):
+        return [dep for d in deps for dep in flatten(d)]
+    return [deps]
+
+
+def name_of(dep):
+    return dep.job if isinstance(dep, concurrent.futures.Future) else dep
+
+
+def references(value):
+    # The results a job's arguments refer to: references (see
+    # sk8s.results.ref) and futures, in lists, tuples and dicts too.
+    if isinstance(value, (sk8s.runner.Ref, concurrent.futures.Future)):
+        return [value]
+    if value.__class__ == dict:
+        value = list(value.values())
+    if value.__class__ in (list, tuple):
+        return [ref for v in value for ref in references(v)]
+    return []
+
+
+def resolve(value, config=None):
+    # The arguments, with futures replaced by references to their results.
+    if isinstance(value, concurrent.futures.Future):
+        return sk8s.results.ref(value, config=config)
+    if value.__class__ == dict:
+        return {k: resolve(v, config) for k, v in value.items()}
+    if value.__class__ in (list, tuple):
+        return value.__class__(resolve(v, config) for v in value)
+    return value
+
+
+def schedule(func, *args, deps, inputs=True, delete=True, config=None, **kwargs):
+    # func(*args, inputs=...) as a job, once every dependency has succeeded.
+    # inputs maps each dependency's job name to its result, in the order given.
+    # With inputs=False it's func(*args), whose arguments refer to the
+    # dependencies' results, and the client needn't fetch them (see
+    # sk8s.results.ref). Other keyword arguments are passed on to run().
+    deps = [dep.job if isinstance(dep, sk8s.runner.Ref) else dep for dep in flatten(deps)]
+    task = Task(deps)
+    # What the task waits on, and what to call each in an error.
+    waiting = [(dep, None) for dep in deps if isinstance(dep, concurrent.futures.Future)]
+    names = [dep for dep in deps if not isinstance(dep, concurrent.futures.Future)]
+    if len(names) > 0:
+        # One wait for all of them: one watch, if they're from the same run.
+        waited = executor().submit(sk8s.jobs.wait, names, delete=False, sk8s_config=config, fetch=inputs)
+        waiting.append((waited, " ".join(names)))
+    remaining = [len(waiting)]
+    lock = threading.Lock()
+
+    def submit(inputs):
+        if inputs is None:
+            future = sk8s.futures.submit(func, *resolve(args, config), delete=delete, config=config, **kwargs)
+            if func.__class__ == sk8s.payloads.Payload:
+                # In case a finishing map released it meanwhile (see sk8s.payloads.release).
+                sk8s.payloads.put(func, config=config)
+            return future
+        call = functools.partial(func, *args, inputs=inputs)
+        return sk8s.futures.submit(call, delete=delete, config=config, **kwargs)
+
+    def start():
+        try:
+            failed = [name or name_of(future) for future, name in waiting if future.cancelled() or (future.exception() is not None)]
+            if len(failed) > 0:
+                raise RuntimeError(f"Not run: upstream jobs {' '.join(map(str, failed))} didn't succeed.")
+            if not inputs:
+                task.start(functools.partial(submit, None))
+                return
+            results = dict()
+            if len(names) > 0:
+                found = waited.result()
+                results.update(zip(names, [found] if len(names) == 1 else found))
+            task.start(functools.partial(submit, {name_of(dep): dep.result() if isinstance(dep, concurrent.futures.Future) else results[dep] for dep in deps}))
+        except Exception as e:
+            try:
+                task.set_exception(e)
+            except concurrent.futures.InvalidStateError:
+                pass
+
+    def ready(_):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0] > 0:
+                return
+        # Not on the watcher's thread: starting a job blocks on the API server.
+        executor().submit(start)
+
+    if len(waiting) == 0:
+        executor().submit(start)
+    for future, _ in waiting:
+        future.add_done_callback(ready)
+    return task
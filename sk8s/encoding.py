@@ -0,0 +1,167 @@
+import io
+import pickle
+import struct
+import zlib
+
+import dill
+
+
+# A binary encoding for job results, for results that JSON can't carry (NumPy
+# arrays, DataFrames, ...) or carries slowly. The result is pickled with
+# protocol 5, which hands large buffers (array data) over separately instead
+# of copying them into the pickle. Those buffers are stored as-is, each
+# aligned, so that decoding can rebuild the arrays as views of the fetched
+# bytes rather than copies. The whole thing may be compressed.
+#
+#   magic, compression, padding | part count, (offset, length) per part, parts...
+#
+# Part 0 is the pickle; the rest are its buffers. Offsets count from the
+# start of the body, after the header, which is padded so that the body (and
+# so each part) is aligned in the encoded bytes too.
+
+result_encodings = ("json", "pickle")
+
+magic = b"SK8S\x01"
+compressions = {None: 0, "zlib": 1, "zstd": 2, "lz4": 3}
+alignment = 64
+
+decompress_chunk_size = 1 << 24
+
+
+class Lz4Compressor:
+    # lz4.frame's compressor, with the interface zlib and zstandard share.
+    def __init__(self):
+        import lz4.frame
+        self.compressor = lz4.frame.LZ4FrameCompressor()
+        self.header = self.compressor.begin()
+
+    def compress(self, data):
+        header, self.header = self.header, b""
+        return header + self.compressor.compress(data)
+
+    def flush(self):
+        return self.header + self.compressor.flush()
+
+
+def compressor(compression):
+    if compression == "zlib":
+        return zlib.compressobj(1)
+    if compression == "zstd":
+        import zstandard
+        return zstandard.ZstdCompressor().compressobj()
+    if compression == "lz4":
+        return Lz4Compressor()
+    raise ValueError(f"Unknown result compression {compression!r}; expected one of {', '.join(str(c) for c in compressions)}.")
+
+
+def decompressor(compression):
+    if compression == "zlib":
+        return zlib.decompressobj()
+    if compression == "zstd":
+        import zstandard
+        return zstandard.ZstdDecompressor().decompressobj()
+    if compression == "lz4":
+        import lz4.frame
+        return lz4.frame.LZ4FrameDecompressor()
+
+
+class Pickler(dill.Pickler):
+    def reducer_override(self, obj):
+        # dill pickles arrays its own way, with their data in-band. Have them
+        # hand it over out-of-band, as they do for plain pickle.
+        t = type(obj)
+        if (t.__module__, t.__name__) == ("numpy", "ndarray"):
+            return obj.__reduce_ex__(5)
+        return NotImplemented
+
+
+class CompressedWriter:
+    def __init__(self, fp, compression):
+        self.fp = fp
+        self.compressor = compressor(compression)
+
+    def write(self, data):
+        self.fp.write(self.compressor.compress(data))
+
+    def close(self):
+        self.fp.write(self.compressor.flush())
+
+
+def check_config(config):
+    encoding = config.get("result_encoding") or "json"
+    if encoding not in result_encodings:
+        raise ValueError(f"Unknown result encoding {encoding!r}; expected one of {', '.join(result_encodings)}.")
+    if config.get("result_compression") not in compressions:
+        raise ValueError(f"Unknown result compression {config.get('result_compression')!r}; expected one of {', '.join(str(c) for c in compressions)}.")
+
+
+def padding(offset):
+    return -offset % alignment
+
+
+def dump(obj, fp, compression=None):
+    # Writes obj to the binary file fp, without assembling the encoding in memory first.
+    check_config(dict(result_compression=compression))
+
+    buffers = []
+    try:
+        pickled = pickle.dumps(obj, protocol=5, buffer_callback=buffers.append)
+    except (pickle.PicklingError, AttributeError, TypeError):
+        # Lambdas and the like, which only dill can pickle (more slowly).
+        buffers = []
+        fp_pickle = io.BytesIO()
+        Pickler(fp_pickle, protocol=5, buffer_callback=buffers.append).dump(obj)
+        pickled = fp_pickle.getbuffer()
+    parts = [memoryview(pickled)] + [buffer.raw() for buffer in buffers]
+
+    header = magic + bytes([compressions[compression]])
+    fp.write(header + b"\0" * padding(len(header)))
+    out = CompressedWriter(fp, compression) if compression is not None else fp
+
+    table = struct.Struct(f"<Q{2 * len(parts)}Q")
+    offset = table.size
+    positions = []
+    for part in parts:
+        offset += padding(offset)
+        positions += [offset, part.nbytes]
+        offset += part.nbytes
+
+    out.write(table.pack(len(parts), *positions))
+    offset = table.size
+    for part in parts:
+        out.write(b"\0" * padding(offset))
+        offset += padding(offset)
+        out.write(part)
+        offset += part.nbytes
+
+    if compression is not None:
+        out.close()
+
+
+def dumps(obj, compression=None):
+    fp = io.BytesIO()
+    dump(obj, fp, compression=compression)
+    return fp.getvalue()
+
+
+def loads(data):
+    # data: bytes, bytearray, mmap, or anything else with the buffer protocol.
+    # Arrays come back as views of data itself (or, if it was compressed, of
+    # the buffer it was decompressed into), so are read-only if data is.
+    data = memoryview(data).cast("B")
+    if bytes(data[:len(magic)]) != magic:
+        raise ValueError("Not an sk8s-encoded result.")
+    compression = {code: name for name, code in compressions.items()}[data[len(magic)]]
+    body = data[alignment:]
+
+    if compression is not None:
+        d = decompressor(compression)
+        decompressed = bytearray()
+        for i in range(0, body.nbytes, decompress_chunk_size):
+            decompressed += d.decompress(body[i:i + decompress_chunk_size])
+        body = memoryview(decompressed)
+
+    n_parts = struct.unpack_from("<Q", body)[0]
+    positions = struct.unpack_from(f"<{2 * n_parts}Q", body, 8)
+    parts = [body[positions[2 * i]:positions[2 * i] + positions[2 * i + 1]] for i in range(n_parts)]
+    return dill.loads(parts[0], buffers=parts[1:])
@@ -0,0 +1,269 @@
+import concurrent.futures
+import json
+import os
+import threading
+import time
+import traceback
+
+import sk8s.backends
+import sk8s.jobs
+import sk8s.payloads
+import sk8s.reaper
+import sk8s.results
+import sk8s.session
+import sk8s.util
+import sk8s.watch
+
+
+# Jobs as futures. sk8s.submit() starts a job and returns a JobFuture, which
+# works like any concurrent.futures.Future: result(), done(),
+# add_done_callback(), cancel(), and concurrent.futures.wait() and
+# as_completed() over several.
+#
+#   futures = [sk8s.submit(process, x) for x in inputs]
+#   for future in sk8s.as_completed(futures):
+#       print(future.job, future.result())
+#
+# However many futures are outstanding, a process follows them with one
+# watch (per session and config): submit() puts every job in the same run, so a single
+# JobTable on that run's label sees them all. Results are fetched by one
+# shared ResultCollector as jobs succeed, the future resolved, and the job
+# deleted (unless delete=False) in the background, batched with whatever
+# else finished meanwhile.
+
+# Longest the watcher goes without checking whether it's been closed.
+watch_seconds = 30
+# How long it waits to try again after its watch fails.
+retry_seconds = 5
+
+
+class JobFuture(concurrent.futures.Future):
+    def __init__(self, job, watcher, delete=True):
+        super().__init__()
+        self.job = job
+        self.watcher = watcher
+        self.delete = delete
+
+    def cancel(self):
+        # Deletes the job, if it hasn't finished. Like any future, one that
+        # has finished can't be cancelled.
+        if not super().cancel():
+            return False
+        # As an executor would, so that wait() and as_completed() see it.
+        self.set_running_or_notify_cancel()
+        self.watcher.forget(self.job)
+        self.watcher.spent(self.job)
+        return True
+
+
+class Watcher:
+    def __init__(self, session, config):
+        self.session = session
+        # A copy: the watcher is only used for calls with a config equal to this one.
+        self.config = dict(config)
+        self.backend = sk8s.backends.get_backend(config)
+        self.namespace = session.namespace if self.backend is None else self.backend.namespace
+        # Every job submitted through this watcher is in this run.
+        self.run_id = sk8s.util.random_string(8)
+        self.lock = threading.Lock()
+        self.futures = dict()  # job -> its future
+        self.unused = set()    # jobs to delete, not yet deleted
+        self.payloads = dict() # job -> the payload it uses, if any
+        self.succeeded = []    # (job, its future) of jobs whose results to fetch
+        self.fetching = False
+        self.cleaning = False
+        self.closed = False
+        self.thread = None
+        self.table = None
+        self.collector = None
+        self.resolver = concurrent.futures.ThreadPoolExecutor(max_workers=sk8s.results.default_max_workers,
+                                                              thread_name_prefix="sk8s-futures")
+
+    def submit(self, func, *args, delete=True, **kwargs):
+        job_info = [sk8s.jobs.run(func, *args, run_id=self.run_id, config=self.config, _map_helper=True, **kwargs)]
+        return self.submit_jobs(job_info, delete=delete)[0]
+
+    def submit_map(self, func, arglists, delete=True, **kwargs):
+        # func(*args) for each args in arglists, as map() does it: the function
+        # is shipped once (unless it's already a payload), and the jobs are created together.
+        payload = func if func.__class__ == sk8s.payloads.Payload else self.ship(func)
+        job_info = [sk8s.jobs.run(payload, *args, run_id=self.run_id, config=self.config, _map_helper=True, **kwargs) for args in arglists]
+        futures = self.submit_jobs(job_info, delete=delete)
+        # In case a finishing map released this payload while we were submitting (see sk8s.payloads.release).
+        sk8s.payloads.put(payload, namespace=self.namespace, config=self.config)
+        return futures
+
+    def ship(self, func):
+        return sk8s.payloads.ship(func, namespace=self.namespace, config=self.config)
+
+    def submit_jobs(self, job_info, delete=True):
+        futures = [JobFuture(job, self, delete=delete) for job, _ in job_info]
+        with self.lock:
+            for future in futures:
+                self.futures[future.job] = future
+            self.start()
+        try:
+            sk8s.jobs.submit_jobs(job_info, namespace=self.namespace, config=self.config)
+        except Exception:
+            for future in futures:
+                self.forget(future.job)
+            raise
+        return futures
+
+    def start(self):
+        # Call with the lock held.
+        if self.thread is None:
+            label_selector = f"{sk8s.jobs.run_label}={self.run_id}"
+            if self.backend is not None:
+                self.table = self.backend.table(label_selector=label_selector)
+                self.collector = self.backend.collector(self.config)
+            else:
+                self.table = sk8s.watch.JobTable(self.namespace, label_selector=label_selector, api=self.session.batch_api()).sync()
+                self.collector = sk8s.results.ResultCollector(self.namespace, sk8s_config=self.config)
+            self.thread = threading.Thread(target=self.watch, name="sk8s-watcher", daemon=True)
+            self.thread.start()
+
+    def forget(self, job):
+        with self.lock:
+            self.futures.pop(job, None)
+
+    def watch(self):
+        while not self.closed:
+            try:
+                # One watch request at a time, held open as long as the API
+                # server allows; futures are settled as their jobs' events arrive.
+                self.table.until(self.settle, timeout=watch_seconds)
+            except Exception:
+                # The API server is unreachable, say. Outstanding futures wait for it to come back.
+                traceback.print_exc()
+                time.sleep(retry_seconds)
+
+    def settle(self, statuses):
+        # The watch's condition: settles the futures whose jobs finished since
+        # last time, and is true once the watcher is closed.
+        with self.lock:
+            futures = {job: self.futures[job] for job in self.table.changed if job in self.futures}
+        self.table.changed.clear()
+        succeeded = []
+        for job, future in futures.items():
+            s = statuses.get(job)
+            if (s is not None) and not s["finished"]:
+                continue
+            # Settled: later events about it don't matter.
+            self.forget(job)
+            if (s is not None) and (s["payload"] is not None):
+                with self.lock:
+                    self.payloads[job] = s["payload"]
+            if (s is not None) and (s["succeeded"] >= s["completions"]):
+                # The future's JobName, which knows its run: results are stored by run.
+                succeeded.append((future.job, s["completions"]) if s["indexed"] else future.job)
+            elif s is None:
+                self.resolve(future, error=RuntimeError(f"Job {job} was deleted before it finished."))
+            else:
+                self.resolve(future, error=RuntimeError(f"Job {job} failed."))
+        if len(succeeded) > 0:
+            with self.lock:
+                self.succeeded.extend((job, futures[job[0] if job.__class__ == tuple else job]) for job in succeeded)
+                if self.fetching:
+                    return self.closed
+                self.fetching = True
+            self.resolver.submit(self.fetch)
+        return self.closed
+
+    def fetch(self):
+        # Starts fetching the results of every job that succeeded since last
+        # time, so that their pods are found together (see sk8s.results).
+        with self.lock:
+            succeeded, self.succeeded = self.succeeded, []
+            self.fetching = False
+        self.collector.fetch([job for job, _ in succeeded])
+        for _, future in succeeded:
+            self.resolver.submit(self.collect, future)
+
+    def collect(self, future):
+        try:
+            result = self.collector.pop(future.job)
+        except Exception as e:
+            self.resolve(future, error=e)
+            return
+        self.resolve(future, result)
+
+    def resolve(self, future, result=None, error=None):
+        try:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+        except concurrent.futures.InvalidStateError:
+            # Cancelled meanwhile; cancel() deletes the job.
+            return
+        # Failed jobs are kept, to look into, as wait() keeps them.
+        if future.delete and (error is None):
+            self.spent(future.job)
+
+    def spent(self, job):
+        # Deletes the job soon, with any others that finish meanwhile.
+        with self.lock:
+            self.unused.add(job)
+            if self.cleaning:
+                return
+            self.cleaning = True
+        if self.backend is not None:
+            # Quick, and done while the backend is still open (as sk8s.jobs.reap() does).
+            self.cleanup()
+            return
+        sk8s.reaper.reap(self.cleanup)
+
+    def cleanup(self):
+        with self.lock:
+            jobs, self.unused = sorted(self.unused), set()
+            self.cleaning = False
+            digests = set(self.payloads.pop(job) for job in jobs if job in self.payloads)
+        sk8s.jobs.cleanup(jobs, namespace=self.namespace, digests=digests, config=self.config, session=self.session)
+
+    def close(self):
+        # Stops watching. Outstanding futures are left unresolved, and their jobs running.
+        self.closed = True
+        self.resolver.shutdown(wait=False)
+        if self.collector is not None:
+            self.collector.close()
+
+
+# The process's watchers, by session, backend and config.
+_watchers = dict()
+_lock = threading.Lock()
+
+
+def get_watcher(config=None):
+    session = sk8s.session.get_session()
+    if config is None:
+        config = session.config
+    backend = sk8s.backends.get_backend(config)
+    # Jobs are made, and their results read, with the watcher's config, so calls with another config get another watcher.
+    key = (os.getpid(), id(session), id(backend), json.dumps(config, sort_keys=True, default=str))
+    with _lock:
+        watcher = _watchers.get(key)
+        # Ids get reused; a watcher is only good for the very session and backend it was made for.
+        if (watcher is None) or watcher.closed or (watcher.session is not session) or (watcher.backend is not backend):
+            watcher = _watchers[key] = Watcher(session, config)
+        return watcher
+
+
+def submit(func, *args, delete=True, config=None, **kwargs):
+    # Runs func(*args) as a job, as run() does, and returns its JobFuture.
+    # Other keyword arguments are passed on to run().
+    return get_watcher(config).submit(func, *args, delete=delete, **kwargs)
+
+
+def submit_map(func, arglists, delete=True, config=None, **kwargs):
+    # A JobFuture for each func(*args) in arglists.
+    return get_watcher(config).submit_map(func, arglists, delete=delete, **kwargs)
+
+
+def ship(func, config=None):
+    # func as a payload (see sk8s.payloads), for submit_map() calls to share.
+    return get_watcher(config).ship(func)
+
+
+def as_completed(futures, timeout=None):
+    return concurrent.futures.as_completed(futures, timeout=timeout)
@@ -14,13 +14,28 @@ import time
 import base64
 import json
 import jinja2
+import yaml
 import subprocess
 import multiprocessing
+import itertools
 
-from concurrent.futures import ThreadPoolExecutor
 import functools
+import concurrent.futures
+import warnings
 
 import sk8s
+import sk8s.backends
+import sk8s.dag
+import sk8s.encoding
+import sk8s.kube
+import sk8s.payloads
+import sk8s.reaper
+import sk8s.results
+import sk8s.runner
+import sk8s.session
+import sk8s.store
+import sk8s.throttle
+import sk8s.watch
 
 
 def check_cluster_config():
@@ -31,6 +46,15 @@ def check_cluster_config():
     return svc_acct
 
 
+# The python program each job's container runs. Rendered with the job's
+# name, run id, serialized code, sk8s config, and any modules to import
+# first (run()'s imports=). sk8s.runner imports as little as it can, so that
+# the job gets to its task quickly.
+default_bootstrap_template = """import sk8s.runner
+sk8s.runner.main("{{name}}", "{{run_id}}", "{{code}}", {{payload}}, {{config}}{% if imports %}, imports={{imports}}{% endif %})
+"""
+
+
 # This should be in a file inside the package, but I'm having problems with that right now...
 default_job_template = """apiVersion: batch/v1
 kind: Job
@@ -56,56 +80,7 @@ spec:
         - python
         - -c
         - |
-          import dill as pickle
-          import base64
-          import json
-          import sys
-          import sk8s
-          import os
-          import traceback
-
-          func = sk8s.deserialize_func("{{code}}")
-
-          config = {{config}}
-          sk8s.configs.save_config(config)
-
-          try:
-              result = json.dumps(func())
-
-              if (("result_obs_prefix" in config) 
-                  and (config["result_obs_prefix"] is not None)
-                  and (config["result_obs_prefix"].startswith("s3://"))):
-                  prefix = config["result_obs_prefix"]
-                  with open(f"results.json", "w") as f:
-                        f.write(result)
-                  os.system(f"aws s3 cp results.json {prefix}{{name}}.json")
-
-              sys.stdout.write(result)
-          except Exception as e:
-              # if results are going to object storage, send exceptions too:
-              if (("result_obs_prefix" in config) 
-                  and (config["result_obs_prefix"] is not None)
-                  and (config["result_obs_prefix"].startswith("s3://"))):
-                  prefix = config["result_obs_prefix"]
-
-                  # Get exception type, value, and traceback
-                  exc_type, exc_value, exc_traceback = sys.exc_info()
-
-                  # Format the traceback into a list of strings
-                  traceback_lines = traceback.format_exception(exc_type, exc_value, exc_traceback)
-
-                  # Join the traceback lines into a single string
-                  traceback_string = ''.join(traceback_lines)
-
-                  # Alternatively, get the exception message directly as a string
-                  exception_string = str(e)
-
-                  with open(f"results.json", "w") as f:
-                      f.write(f"Exception message: {exception_string} Full traceback: {traceback_string}")
-
-                  os.system(f"aws s3 cp results.json {prefix}{{name}}.json")
-
-              raise e
+          {{ bootstrap | indent(10) }}
 
         {%- if (requests is defined and requests|length > 0) or (limits is defined and limits|length > 0) %}
         resources:
@@ -137,6 +112,86 @@ spec:
         #- mountPath: "/mnt/{{volume}}"
 
 
+run_label = "sk8s/run"
+task_index_label = "sk8s/task-index"
+
+# Past this many distinct runs, a selector naming them all gets unwieldy.
+max_runs_per_selector = 100
+
+
+class JobName(str):
+    # A job's name, remembering which run()/map() call it came from, so that
+    # its status, pods and results can be found with a label selector instead
+    # of by scanning the namespace. Behaves exactly like the name otherwise.
+    def __new__(cls, name, run_id=None):
+        job = super().__new__(cls, name)
+        job.run_id = run_id
+        return job
+
+
+def run_selector(jobs):
+    # A label selector for the runs these jobs belong to, or None if we don't know them.
+    run_ids = sorted(set(getattr(job, "run_id", None) for job in jobs), key=str)
+    if (len(run_ids) == 0) or (None in run_ids) or (len(run_ids) > max_runs_per_selector):
+        return None
+    if len(run_ids) == 1:
+        return f"{run_label}={run_ids[0]}"
+    return f"{run_label} in ({','.join(run_ids)})"
+
+
+def label_job(spec, run_id, task_index=None):
+    # Labels go on the pods too, so that they can be selected the same way.
+    labels = {run_label: run_id}
+    if task_index is not None:
+        labels[task_index_label] = str(task_index)
+    spec["metadata"].setdefault("labels", dict()).update(labels)
+    spec["spec"]["template"].setdefault("metadata", dict()).setdefault("labels", dict()).update(labels)
+    return spec
+
+
+@functools.lru_cache(maxsize=16)
+def compiled_template(text):
+    # Compiling a template costs far more than rendering it; maps render the same one per job.
+    return jinja2.Template(text)
+
+
+def job_spec(name, bootstrap, image,
+             requests=dict(),
+             limits=dict(),
+             volumes={},
+             imagePullPolicy=None,
+             privileged=False,
+             backoffLimit=0,
+             serviceAccountName=None):
+    # Builds the same Job as default_job_template, directly as a dict that
+    # can be posted to the API server without a round trip through YAML.
+    container = dict(name="worker",
+                     image=image,
+                     imagePullPolicy=imagePullPolicy,
+                     securityContext=dict(privileged=privileged),
+                     command=["python", "-c", bootstrap])
+
+    if len(requests) > 0 or len(limits) > 0:
+        container["resources"] = dict()
+    if len(requests) > 0:
+        container["resources"]["requests"] = {key: str(value) for key, value in requests.items()}
+    if len(limits) > 0:
+        container["resources"]["limits"] = {key: str(value) for key, value in limits.items()}
+    if len(volumes) > 0:
+        container["volumeMounts"] = [dict(mountPath=mountpath, name=volname) for volname, mountpath in volumes.items()]
+
+    pod_spec = dict(volumes=[dict(name=volume, persistentVolumeClaim=dict(claimName=volume)) for volume in volumes.keys()],
+                    serviceAccountName=serviceAccountName,
+                    containers=[container],
+                    restartPolicy="Never")
+
+    return dict(apiVersion="batch/v1",
+                kind="Job",
+                metadata=dict(name=str(name)),
+                spec=dict(template=dict(spec=pod_spec),
+                          backoffLimit=backoffLimit))
+
+
 def run(func, *args,
         image=None,
         volumes={},
@@ -144,7 +199,7 @@ def run(func, *args,
         limits=dict(),
         asynchro=True,
         timeout=None,
-        job_template=default_job_template,
+        job_template=None,
         imagePullPolicy=None,
         backoffLimit=0,
         serviceAccountName=None,
@@ -155,12 +210,36 @@ def run(func, *args,
         state=None,
         config=None,
         export_config=True,
+        completions=None,
+        parallelism=None,
+        run_id=None,
+        task_index=None,
+        ttlSecondsAfterFinished=None,
+        deps=None,
+        imports=None,
         _map_helper=False):
     # Should do it this way, but having problems. Reverting for now:
     # job_template = importlib.resources.read_text("sk8s", "job_template.yaml")
 
+    # Arguments can refer to other jobs' results (see sk8s.results.ref): the
+    # job reads them for itself, once those jobs have succeeded.
+    refs = [] if (_map_helper or dryrun or test) else sk8s.dag.references(args)
+    if (deps is not None) or (len(refs) > 0):
+        # Started once the jobs it depends on have succeeded, with their results as `inputs` (see sk8s.dag).
+        if _map_helper or dryrun or test or (completions is not None):
+            raise ValueError("deps can't be combined with dryrun, test or completions.")
+        if (len(refs) > 0) and (sk8s.runner.result_prefix(config or sk8s.session.get_session().config) is None):
+            raise ValueError("Results are only in the pod logs; set result_volume or result_obs_prefix to pass them by reference.")
+        task = sk8s.dag.schedule(func, *args, deps=refs if deps is None else [deps, refs], inputs=deps is not None, config=config,
+                                 image=image, volumes=volumes, requests=requests, limits=limits,
+                                 job_template=job_template, imagePullPolicy=imagePullPolicy,
+                                 backoffLimit=backoffLimit, serviceAccountName=serviceAccountName,
+                                 privileged=privileged, name=name, state=state, export_config=export_config,
+                                 ttlSecondsAfterFinished=ttlSecondsAfterFinished, imports=imports)
+        return task if asynchro else wait(task, timeout=timeout)
+
     if config is None:
-        config = sk8s.configs.load_config()
+        config = sk8s.session.get_session().config
 
     if image is None:
         image = config["docker_image_prefix"] + "jobs"
@@ -171,25 +250,82 @@ def run(func, *args,
     if serviceAccountName is None:
         serviceAccountName = config["service_account_name"]
 
-    if state is None:
-        code = sk8s.util.serialize_func(lambda a=args: func(*a))
+    sk8s.encoding.check_config(config)
+
+    # A shipped function (see sk8s.payloads) is already in the cluster; the job only needs its arguments.
+    payload = func if func.__class__ == sk8s.payloads.Payload else None
+
+    if payload is not None:
+        code = sk8s.util.serialize_func(args)
+    elif state is None:
+        # A partial rather than a lambda, which would bring this module (and
+        # its imports) into the pod with it.
+        code = sk8s.util.serialize_func(functools.partial(func, *args))
     else:
-        code = sk8s.util.serialize_func(state.memoize(lambda a=args: func(*a)))
+        code = sk8s.util.serialize_func(state.memoize(functools.partial(func, *args)))
+
+    if (len(code) > sk8s.payloads.max_inline_bytes) and not test:
+        # Too big for the job spec (a closure over a dataset, say): ship the
+        # function and its arguments together, as a payload of their own.
+        if payload is not None:
+            f = sk8s.util.deserialize_func(payload.code)
+        else:
+            f, args = sk8s.util.deserialize_func(code), ()
+        if completions is not None:
+            payload = sk8s.payloads.ship(functools.partial(sk8s.runner.call_indexed, f, args), config=config, dryrun=dryrun)
+            args = tuple((i,) for i in range(completions))
+        else:
+            payload = sk8s.payloads.ship(functools.partial(f, *args), config=config, dryrun=dryrun)
+            args = ()
+        code = sk8s.util.serialize_func(args)
 
     if volumes.__class__ == str:
         volumes = {volumes: f"/mnt/{volumes}"}
     if volumes.__class__ == list:
         volumes = {name: f"/mnt/{name}" for name in volumes}
 
+    if config.get("result_volume"):
+        # Results are written to the result volume (see sk8s.results), so every job mounts it.
+        volume = config["result_volume"]
+        mount = sk8s.results.volume_mount(volume)
+        if volumes.get(volume, mount) != mount:
+            raise ValueError(f"The result volume {volume} must be mounted at {mount}, not {volumes[volume]}.")
+        volumes = dict(volumes, **{volume: mount})
+
     if test:
+        if payload is not None:
+            return sk8s.util.deserialize_func(payload.code)(*args)
         func_2 = pickle.loads(base64.b64decode(code))
         return func_2()
 
-    t = jinja2.Template(job_template)
-    s = sk8s.util.random_string(5)
-    job = name=name.format(s=s)
-    j = t.render(name=job,
+    if run_id is None:
+        run_id = sk8s.util.random_string(8)
+
+    # Long enough that a map of 100,000 jobs is unlikely to draw the same name twice.
+    s = sk8s.util.random_string(10)
+    job = JobName(name.format(s=s), run_id)
+    bootstrap = compiled_template(default_bootstrap_template).render(
+                 name=job,
+                 run_id=run_id,
+                 code=code,
+                 payload=payload is not None,
+                 imports=imports,
+                 config=config if export_config else sk8s.configs.default_config)
+
+    if job_template is None:
+        spec = job_spec(job, bootstrap, image,
+                        requests=requests,
+                        limits=limits,
+                        volumes=volumes,
+                        imagePullPolicy=imagePullPolicy,
+                        privileged=privileged,
+                        backoffLimit=backoffLimit,
+                        serviceAccountName=serviceAccountName)
+    else:
+        j = compiled_template(job_template).render(
+                 name=job,
                  code=code,
+                 bootstrap=bootstrap,
                  image=image,
                  requests=requests,
                  limits=limits,
@@ -199,18 +335,31 @@ def run(func, *args,
                  privileged=privileged,
                  backoffLimit=backoffLimit,
                  serviceAccountName=serviceAccountName)
+        spec = yaml.safe_load(j)
+
+    label_job(spec, run_id, task_index=task_index if completions is None else None)
+
+    if ttlSecondsAfterFinished is None:
+        ttlSecondsAfterFinished = config.get("job_ttl_seconds")
+    if ttlSecondsAfterFinished is not None:
+        # Finished jobs (and their pods) expire on their own, even if nothing waits on them.
+        spec["spec"]["ttlSecondsAfterFinished"] = int(ttlSecondsAfterFinished)
+
+    if payload is not None:
+        sk8s.payloads.attach(spec, payload)
+
+    if completions is not None:
+        # One Job, many pods: each pod finds its index in $JOB_COMPLETION_INDEX.
+        spec["spec"].update(completionMode="Indexed",
+                            completions=completions,
+                            parallelism=parallelism if parallelism is not None else completions)
 
     if _map_helper:
-        return (job, j)
+        return (job, spec)
     if dryrun:
-        return j
+        return yaml.safe_dump(spec, sort_keys=False)
 
-    proc = subprocess.run("kubectl apply -f -",
-                          shell=True,
-                          input=j.encode("utf-8"),
-                          stdout=subprocess.DEVNULL,
-                          stderr=subprocess.DEVNULL,
-                          check=True)
+    submit_jobs([(job, spec)], config=config)
 
     if asynchro:
         return job
@@ -218,54 +367,93 @@ def run(func, *args,
         return wait(job, timeout=timeout)
 
 
-def get_job_statuses(namespace=None):
+def submit_jobs(job_info, namespace=None, config=None):
+    # job_info is a list of (name, spec) pairs, as returned by run(..., _map_helper=True).
+    # Every job is attempted; if any were rejected, the error lists each of them.
+    backend = sk8s.backends.get_backend(config)
+    if backend is not None:
+        return backend.submit(job_info)
+    errors = sk8s.kube.create_jobs([spec for _, spec in job_info], namespace=namespace)
+    if len(errors) > 0:
+        details = "\n".join(f"{job}: {e}" for job, e in errors.items())
+        raise RuntimeError(f"Failed to submit {len(errors)} of {len(job_info)} jobs:\n{details}")
+    return [job for job, _ in job_info]
 
-    if sk8s.util.in_pod():
-        config.load_incluster_config()
-    else:
-        config.load_kube_config()
 
-    batch_v1 = client.BatchV1Api()
+job_status_columns = ["job", "namespace", "succeeded", "failed", "active", "completions", "indexed", "finished", "payload", "run"]
 
-    all_jobs = batch_v1.list_job_for_all_namespaces()
+completion_index_annotation = "batch.kubernetes.io/job-completion-index"
 
-    results = []
-    for job in all_jobs.items:
-        name = job.metadata.name
-        succeeded = job.status.succeeded or 0
-        failed = job.status.failed or 0
-        active = job.status.active or 0
-        _namespace = job.metadata.namespace
-        results.append(dict(job=name, namespace=_namespace, succeeded=succeeded, failed=failed, active=active))
-    if namespace is None:
-        return pd.DataFrame(results)
-    else:
-        return pd.DataFrame([r for r in results if r['namespace'] == namespace])
-    
 
-def get_completed_pod_from_jobs(jobs, namespace=None):
+def get_job_statuses(namespace=None, label_selector=None):
+    backend = sk8s.backends.get_backend()
+    if backend is not None:
+        return pd.DataFrame(backend.statuses(label_selector), columns=job_status_columns)
 
-    if sk8s.util.in_pod():
-        config.load_incluster_config()
+    batch_v1 = sk8s.kube.batch_api()
+
+    selectors = dict(label_selector=label_selector) if label_selector is not None else dict()
+    if namespace is None:
+        all_jobs = batch_v1.list_job_for_all_namespaces(_preload_content=False, **selectors)
     else:
-        config.load_kube_config()
+        all_jobs = batch_v1.list_namespaced_job(namespace=namespace, _preload_content=False, **selectors)
 
-    core_v1 = client.CoreV1Api()
+    results = [sk8s.watch.job_status(job) for job in json.loads(all_jobs.data)["items"]]
+    return pd.DataFrame(results, columns=job_status_columns)
     
+
+def get_completed_pod_from_jobs(jobs, namespace=None, label_selector=None, completions=None, errors=None):
+    # Returns {job: pod name}, or for Indexed jobs {job: [pod name for each index]}.
+    # completions, if given, is {job: its number of completions} for Indexed
+    # jobs. An Indexed job missing a succeeded pod for an index (evicted and
+    # garbage-collected, say) is an error: raised, or with errors (a dict)
+    # given, put there by job and left out of the result.
+    core_v1 = sk8s.kube.core_api()
+
     if namespace is None:
         namespace = sk8s.util.get_current_namespace()
 
-    pods = core_v1.list_namespaced_pod(namespace=namespace)
+    if label_selector is None:
+        label_selector = run_selector(jobs)
+    if (label_selector is None) and (len(jobs) == 1):
+        label_selector = f"job-name={jobs[0]}"
+
+    selectors = dict(label_selector=label_selector) if label_selector is not None else dict()
+    response = core_v1.list_namespaced_pod(namespace=namespace, _preload_content=False, **selectors)
+    pods = json.loads(response.data)["items"]
 
     job_set = set(jobs)
 
     results = dict()
-    for pod in pods.items:
-        job = pod.metadata.owner_references[0].name
+    indexed = dict()
+    for pod in pods:
+        metadata = pod["metadata"]
+        if not metadata.get("ownerReferences"):
+            continue
+        job = metadata["ownerReferences"][0]["name"]
         if job not in job_set:
             continue
-        assert(pod.status.phase == 'Succeeded')
-        results[job] = pod.metadata.name
+        # Retried jobs leave their failed pods behind; only the successful one has the result.
+        if pod["status"].get("phase") != 'Succeeded':
+            continue
+        annotations = metadata.get("annotations") or {}
+        if completion_index_annotation in annotations:
+            indexed.setdefault(job, dict())[int(annotations[completion_index_annotation])] = metadata["name"]
+        else:
+            results[job] = metadata["name"]
+
+    for job, pods_by_index in indexed.items():
+        n = (completions or {}).get(job)
+        if n is None:
+            n = max(pods_by_index) + 1
+        missing = [i for i in range(n) if i not in pods_by_index]
+        if len(missing) > 0:
+            e = RuntimeError(f"No succeeded pod found for job {job} completion indexes {', '.join(str(i) for i in missing)}.")
+            if errors is None:
+                raise e
+            errors[job] = e
+            continue
+        results[job] = [pods_by_index[i] for i in range(n)]
 
     return results
 
@@ -275,100 +463,327 @@ def fetch_pod_results(pod_name, namespace=None):
         namespace = sk8s.util.get_current_namespace()
 
     try:
-        v1 = client.CoreV1Api()
-        return json.loads(v1.read_namespaced_pod_log(name=pod_name, namespace=namespace, _preload_content=False).data.decode("utf-8"))
+        return sk8s.results.fetch_pod_log(pod_name, namespace, encoding=sk8s.session.get_session().config.get("result_encoding") or "json")
     except Exception as e:
         print(f"Failed to fetch logs for pod {pod_name}: {e}")
         raise
 
 
 def fetch_job_results_obs(job, namespace=None):
-    if namespace is None:
-        namespace = sk8s.util.get_current_namespace()
     try:
-        obs_prefix = sk8s.configs.load_config()["result_obs_prefix"]
-        obs_file = f"{obs_prefix}{job}.json"
-        if obs_file.startswith("s3://"):
-            return json.loads(subprocess.run(f"aws s3 cp {obs_file} -", shell=True, check=True, capture_output=True).stdout.decode("utf-8"))
-        else:
-            raise NotImplementedError("Only S3 is supported for results collection for now.")
+        obs_prefix = sk8s.results.result_prefix(sk8s.session.get_session().config)
+        return sk8s.results.fetch_obs(f"{obs_prefix}{sk8s.results.result_key(job)}.json")
     except Exception as e:
         print(f"Failed to fetch logs for job {job}: {e}")
         raise
 
 
-def get_jobs_results(jobs, namespace=None, sk8s_config=None):
-    if sk8s.util.in_pod():
-        config.load_incluster_config()
-    else: 
-        config.load_kube_config()
+def get_jobs_results(jobs, namespace=None, sk8s_config=None, indexed=None, max_workers=None):
+    # indexed maps the Indexed jobs among `jobs` to their number of completions.
+    # Their results come back as lists, ordered by completion index.
+    # The jobs must have succeeded. See sk8s.results for fetching results as jobs finish.
 
     if sk8s_config is None:
-        sk8s_config = sk8s.configs.load_config()
-        
-    core_v1 = client.CoreV1Api()
+        sk8s_config = sk8s.session.get_session().config
 
+    backend = sk8s.backends.get_backend(sk8s_config)
+    if backend is not None:
+        namespace = backend.namespace
+        collector = backend.collector(sk8s_config, max_workers=max_workers)
+    else:
+        if namespace is None:
+            namespace = sk8s.util.get_current_namespace()
+        collector = sk8s.results.ResultCollector(namespace, sk8s_config=sk8s_config, max_workers=max_workers)
+
+    with collector:
+        if collector.obs_prefix is not None:
+            # Results are stored by run, and for Indexed jobs by completion index too.
+            if any(getattr(job, "run_id", None) is None for job in jobs):
+                # Just names: the jobs know their runs.
+                status = get_job_statuses(namespace)
+                status = status.loc[status['job'].isin(jobs)]
+                runs = dict(zip(status['job'], status['run']))
+                jobs = [JobName(job, runs.get(job)) for job in jobs]
+                if indexed is None:
+                    indexed = dict(zip(status['job'][status['indexed']], status['completions'][status['indexed']]))
+            if indexed is None:
+                indexed = {job: n for job, n in collector.stored(jobs).items() if n is not None}
+            collector.fetch([(job, indexed[job]) if job in indexed else job for job in jobs])
+        else:
+            # Result logs are found from the pods, which know their own completion index.
+            collector.fetch(jobs)
+        return [collector.result(job) for job in jobs]
+
+
+def delete_jobs(jobs, namespace=None, label_selector=None, config=None, session=None):
+    # With a label_selector, deletes every job it matches in one call; the
+    # caller must know that's just `jobs`. Their pods are deleted after them,
+    # in the background (see sk8s.kube).
+    backend = sk8s.backends.get_backend(config)
+    if backend is not None:
+        backend.delete(jobs)
+        return
+    if session is None:
+        session = sk8s.session.get_session()
     if namespace is None:
-        namespace = sk8s.util.get_current_namespace()
+        namespace = session.namespace
+    submitter = sk8s.throttle.get_submitter(config if config is not None else session.config)
+    errors = sk8s.kube.delete_jobs(jobs, namespace=namespace, api=session.batch_api(), label_selector=label_selector, submitter=submitter)
+    if len(errors) > 0:
+        details = "\n".join(f"{job}: {e}" for job, e in errors.items())
+        raise RuntimeError(f"Failed to delete {len(errors)} of {len(jobs)} jobs:\n{details}")
+
+
+def cleanup(jobs, namespace=None, label_selector=None, digests=(), config=None, session=None):
+    # Deletes finished jobs, then the payloads no job uses any more. wait()
+    # and imap() leave this to the reaper (see sk8s.reaper), so as not to
+    # hold up their results; it runs against the session they were called in.
+    delete_jobs(jobs, namespace=namespace, label_selector=label_selector, config=config, session=session)
+    if len(digests) > 0:
+        sk8s.payloads.release(digests, namespace=namespace, config=config, session=session)
+
+
+def reap(jobs, namespace=None, label_selector=None, digests=(), config=None):
+    # cleanup(), in the background -- except on the local backend, where it's quick.
+    if sk8s.backends.get_backend(config) is not None:
+        cleanup(jobs, namespace=namespace, label_selector=label_selector, digests=digests, config=config)
+        return
+    sk8s.reaper.reap(cleanup, list(jobs), namespace=namespace, label_selector=label_selector, digests=list(digests),
+                     config=config, session=sk8s.session.get_session())
+
+
+def wait(jobs, timeout=None, verbose=False, delete=True, polling_interval=1.0, sk8s_config=None, fetch_workers=None, fetch=True):
+    # polling_interval is no longer used: job status changes are watched, not polled.
+    # Results are fetched as jobs succeed (see sk8s.results), fetch_workers at a
+    # time -- or with fetch=False, not at all: the jobs' results are all None.
+    if isinstance(jobs, concurrent.futures.Future):
+        # From sk8s.submit() or run(..., deps=...), which delete their own jobs.
+        return jobs.result(timeout=timeout)
+    if (jobs.__class__ == list) and any(isinstance(job, concurrent.futures.Future) for job in jobs):
+        # Futures, and maybe names too: a map whose jobs take references to
+        # others' results starts those jobs as the others finish.
+        deadline = None if timeout is None else time.time() + timeout
+        names = [job for job in jobs if not isinstance(job, concurrent.futures.Future)]
+        found = [] if len(names) == 0 else wait(names, timeout=timeout, verbose=verbose, delete=delete, sk8s_config=sk8s_config,
+                                                  fetch_workers=fetch_workers, fetch=fetch)
+        found = iter([found] if len(names) == 1 else found)
+        return [job.result(timeout=None if deadline is None else max(0, deadline - time.time()))
+                if isinstance(job, concurrent.futures.Future) else next(found) for job in jobs]
+
+    backend = sk8s.backends.get_backend(sk8s_config)
+    ns = sk8s.get_current_namespace() if backend is None else backend.namespace
+
+    if jobs.__class__ in (str, JobName):
+        jobs = [jobs]
 
-    with ThreadPoolExecutor(max_workers=100) as executor:
-        if ("result_obs_prefix" in sk8s_config) and (sk8s_config["result_obs_prefix"] is not None):
-            logs = executor.map(functools.partial(fetch_job_results_obs, namespace=namespace), jobs)
-        else:
-            # Do it the old way, via logs
-            pods = get_completed_pod_from_jobs(jobs, namespace)
-            logs = executor.map(functools.partial(fetch_pod_results, namespace=namespace), pods.values())
+    label_selector = run_selector(jobs)
+    field_selector = f"metadata.name={jobs[0]}" if (label_selector is None) and (len(jobs) == 1) else None
+    if backend is not None:
+        table = backend.table(label_selector=label_selector, field_selector=field_selector)
+        collector = backend.collector(sk8s_config, max_workers=fetch_workers)
+    else:
+        table = sk8s.watch.JobTable(ns, label_selector=label_selector, field_selector=field_selector).sync()
+        collector = sk8s.results.ResultCollector(ns, sk8s_config=sk8s_config, max_workers=fetch_workers)
+
+    with collector:
+        unsettled = set(jobs)
+        table.changed = set(jobs)
+
+        def settled(statuses):
+            # Finished, or gone (deleted out from under us). Only the jobs that
+            # changed since we last looked can have settled.
+            succeeded = []
+            for job in table.changed & unsettled:
+                s = statuses.get(job)
+                if (s is None) or s["finished"]:
+                    unsettled.remove(job)
+                    if (s is not None) and (s["succeeded"] >= s["completions"]):
+                        # Results are stored by run; a plain name needs its run from the job.
+                        if getattr(job, "run_id", None) is None:
+                            job = JobName(job, s["run"])
+                        succeeded.append((job, s["completions"]) if s["indexed"] else job)
+            table.changed.clear()
+            if fetch:
+                collector.fetch(succeeded)
+            return len(unsettled) == 0
+
+        if not table.until(settled, timeout=timeout):
+            raise TimeoutError(f"Timed out after {timeout}s waiting for {len(unsettled)} of {len(jobs)} jobs.")
+
+        missing = [job for job in jobs if job not in table.statuses]
+        if len(missing) > 0:
+            raise RuntimeError(f"Jobs {' '.join(missing)} not found in namespace {ns}.")
+
+        status = [table.statuses[job] for job in jobs]
+
+        if any(s["succeeded"] < s["completions"] for s in status):
+            failures = [s["job"] for s in status if (s["succeeded"] < s["completions"]) and (s["failed"] > 0)]
+            n_succeeded = sum(s["succeeded"] for s in status)
+            n_failed = sum(s["failed"] for s in status)
+            n_active = sum(s["active"] for s in status)
+            n1 = len(jobs)
+            n2 = len(status)
+            raise RuntimeError(f"Jobs {n_succeeded} {n_failed} {n_active} {n1} {n2} {' '.join(failures)} failed.")
+
+        results = [collector.result(job) if fetch else None for job in jobs]
 
-    results = dict()
-    for job, log in zip(jobs, logs):
-        results[job] = log
+    if delete == True:
+        # If we waited on whole runs, the selector deletes them in one call.
+        whole_runs = (label_selector is not None) and (set(table.statuses) == set(jobs))
+        reap(jobs, namespace=ns, label_selector=label_selector if whole_runs else None,
+             digests=set(s["payload"] for s in status if s["payload"] is not None), config=sk8s_config)
 
-    final = []
-    for job in jobs:
-        final.append(results[job])
+    if len(jobs) != 1:
+        return results
+    else:
+        return results[0]
 
-    return final
 
+def run_indexed(func, arglists, parallelism=None, timeout=None, delete=True, asynchro=False, dryrun=False, **kwargs):
+    # Runs func(*args) for every args in arglists as a single Indexed Job, at
+    # most `parallelism` pods at a time. Waiting on the job returns the results in order.
+    if len(arglists) == 0:
+        return []
 
-def wait(jobs, timeout=None, verbose=False, delete=True, polling_interval=1.0, sk8s_config=None):
-    ns = sk8s.get_current_namespace()
+    payload = sk8s.payloads.ship(func, dryrun=dryrun, config=kwargs.get("config"))
+    job = run(payload, *arglists, completions=len(arglists), parallelism=parallelism, dryrun=dryrun, **kwargs)
 
-    if jobs.__class__ == str:
-        jobs = [jobs]
+    if dryrun:
+        return job
 
-    while True:
-        status = get_job_statuses(ns)
-        status = status.loc[status['job'].isin(jobs)]
-        
-        if status['active'].sum() > 0:
-            time.sleep(polling_interval)
-            continue
-        else:
-            break
+    # In case a finishing map released this payload while we were submitting (see sk8s.payloads.release).
+    sk8s.payloads.put(payload, config=kwargs.get("config"))
 
-    if status.succeeded.sum() != len(jobs):
-        failures = status.loc[(status['succeeded'] == 0) & (status['failed'] > 0), 'job'].tolist()
-        n_succeeded = status.succeeded.sum()
-        n_failed = status.failed.sum()
-        n_active = status.active.sum()
-        n1 = len(jobs)
-        n2 = len(status)
-        raise RuntimeError(f"Jobs {n_succeeded} {n_failed} {n_active} {n1} {n2} {' '.join(failures)} failed.")
+    if asynchro:
+        return [job]
+    else:
+        return wait(job, timeout=timeout, delete=delete, sk8s_config=kwargs.get("config"))
 
-    results = get_jobs_results(jobs, ns, sk8s_config=sk8s_config)
 
-    if delete == True:
-        with ThreadPoolExecutor(max_workers=1000) as executor:
-            # chunk jobs into groups of ten
-            job_chunks = [jobs[i:i + 10] for i in range(0, len(jobs), 10)]
-            cmds = [f"kubectl delete job {' '.join(chunk)}" for chunk in job_chunks]
-            executor.map(functools.partial(subprocess.run, shell=True, check=True, capture_output=True), 
-                         cmds)
+# A tree map (mode="tree") has its jobs submitted from inside the cluster.
+# The client submits `fanout` submitter jobs, each with a slice of the
+# arguments. A submitter with more than leaf_size of them splits them among
+# `fanout` submitters of its own; one with fewer submits their jobs itself.
+# Each waits for what it submitted, and returns its slice's results, so
+# they come back up the same tree. Submission then takes time logarithmic,
+# rather than linear, in the number of jobs.
+tree_fanout = 10
+tree_leaf_size = 1000
+submitter_name = "sk8s-submit-{s}"
 
-    if len(jobs) != 1:
-        return results
+
+def split(arglists, n):
+    size = -(-len(arglists) // n)
+    return [arglists[i:i + size] for i in range(0, len(arglists), size)]
+
+
+def submit_subtrees(payload, arglists, fanout, leaf_size, delete, kwargs, dryrun=False):
+    # Submitters run in the jobs image, which has sk8s (and the kubernetes client) in it.
+    config = kwargs["config"]
+    parts = split(arglists, fanout)
+    if dryrun:
+        return [run(fan_out, payload, part, fanout, leaf_size, delete, kwargs, name=submitter_name, config=config, dryrun=True) for part in parts]
+    run_id = sk8s.util.random_string(8)
+    job_info = [run(fan_out, payload, part, fanout, leaf_size, delete, kwargs, name=submitter_name, config=config,
+                    run_id=run_id, task_index=i, _map_helper=True) for i, part in enumerate(parts)]
+    return submit_jobs(job_info, config=config)
+
+
+def fan_out(payload, arglists, fanout, leaf_size, delete, kwargs):
+    # What a submitter job of a tree map runs: its slice of the map, as a list of results.
+    config = kwargs["config"]
+    if len(arglists) > leaf_size:
+        jobs = submit_subtrees(payload, arglists, fanout, leaf_size, delete, kwargs)
     else:
-        return results[0]
+        run_id = sk8s.util.random_string(8)
+        jobs = submit_jobs([run(payload, *args, run_id=run_id, task_index=i, _map_helper=True, **kwargs) for i, args in enumerate(arglists)], config=config)
+        # In case a finishing part of the tree released this payload while we were submitting (see sk8s.payloads.release).
+        sk8s.payloads.put(payload, config=config)
+    if len(arglists) > leaf_size:
+        return wait_subtrees(jobs, delete=delete, sk8s_config=config)
+    results = wait(jobs, delete=delete, sk8s_config=config)
+    return [results] if len(jobs) == 1 else results
+
+
+def wait_subtrees(submitters, **kwargs):
+    # The results of a tree map's submitters, in order.
+    results = wait(submitters, **kwargs)
+    if len(submitters) == 1:
+        results = [results]
+    return [result for part in results for result in part]
+
+
+def tree_map(func, arglists, fanout=None, leaf_size=None, timeout=None, delete=True, asynchro=False, dryrun=False, **kwargs):
+    # asynchro returns the top submitters; wait_subtrees() on them returns the results.
+    if fanout is None:
+        fanout = tree_fanout
+    if leaf_size is None:
+        leaf_size = tree_leaf_size
+    if kwargs.get("config") is None:
+        kwargs["config"] = sk8s.session.get_session().config
+
+    payload = sk8s.payloads.ship(func, dryrun=dryrun, config=kwargs["config"])
+    submitters = submit_subtrees(payload, arglists, fanout, leaf_size, delete, kwargs, dryrun=dryrun)
+    if dryrun:
+        return submitters
+    sk8s.payloads.put(payload, config=kwargs["config"])
+
+    if asynchro:
+        return submitters
+    return wait_subtrees(submitters, timeout=timeout, delete=delete, sk8s_config=kwargs["config"])
+
+
+def map_arglists(func, arglists, timeout=None, delete=True, asynchro=False, dryrun=False, mode="jobs", parallelism=None, fanout=None, leaf_size=None, **kwargs):
+    # The guts of map and starmap: runs func(*args) for each args in arglists.
+    # The function is shipped to the cluster once (see sk8s.payloads), and
+    # each job carries only its own arguments.
+    if mode == "indexed":
+        return run_indexed(func, arglists, parallelism=parallelism, timeout=timeout, delete=delete, asynchro=asynchro, dryrun=dryrun, **kwargs)
+    elif mode == "tree":
+        if len(arglists) == 0:
+            return []
+        return tree_map(func, arglists, fanout=fanout, leaf_size=leaf_size, timeout=timeout, delete=delete, asynchro=asynchro, dryrun=dryrun, **kwargs)
+    elif mode != "jobs":
+        raise ValueError(f"Unknown map mode {mode!r}; expected 'jobs', 'indexed' or 'tree'.")
+
+    if len(arglists) == 0:
+        return []
+
+    if kwargs.get("config") is None:
+        kwargs["config"] = sk8s.session.get_session().config
+
+    payload = sk8s.payloads.ship(func, dryrun=dryrun, config=kwargs["config"])
+
+    if dryrun:
+        return [run(payload, *args, task_index=i, dryrun=True, **kwargs) for i, args in enumerate(arglists)]
+
+    if any(len(sk8s.dag.references(args)) > 0 for args in arglists):
+        # Jobs whose arguments refer to other jobs' results each start when
+        # those jobs have succeeded; wait() takes the futures and names together.
+        jobs = [run(payload, *args, task_index=i, **kwargs) for i, args in enumerate(arglists)]
+        sk8s.payloads.put(payload, config=kwargs["config"])
+        return jobs if asynchro else wait(jobs, timeout=timeout, delete=delete, sk8s_config=kwargs["config"])
+
+    run_id = sk8s.util.random_string(8)
+    job_info = [run(payload, *args, run_id=run_id, task_index=i, _map_helper=True, **kwargs) for i, args in enumerate(arglists)]
+
+    job_names = submit_jobs(job_info, config=kwargs["config"])
+
+    # In case a finishing map released this payload while we were submitting (see sk8s.payloads.release).
+    sk8s.payloads.put(payload, config=kwargs["config"])
+
+    if asynchro:
+        return job_names
+    else:
+        return wait(job_names, timeout=timeout, delete=delete, sk8s_config=kwargs["config"])
+
+
+def deprecated_map_args(**kwargs):
+    # Left from submitting with kubectl apply, a chunk of jobs at a time: jobs
+    # are created one by one through the API now (see sk8s.kube.create_jobs).
+    for arg, value in kwargs.items():
+        if value is not None:
+            warnings.warn(f"{arg} no longer does anything and will be removed.", DeprecationWarning, stacklevel=3)
 
 
 def map(func,
@@ -385,52 +800,16 @@ def map(func,
         asynchro=False,
         name="job-{s}",
         dryrun=False,
-        verbose=False,
-        chunk_size=100):
-    thunks = [lambda arg=i: func(arg) for i in iterable]
-
-    if dryrun:
-        job_names = [run(thunk, image=image, name=name, requests=requests, limits=limits, backoffLimit=backoffLimit, imagePullPolicy=imagePullPolicy, privileged=privileged, volumes=volumes, dryrun=dryrun) for thunk in thunks]
-        return job_names
-    
-    job_info = [run(thunk, image=image, name=name, requests=requests, limits=limits, volumes=volumes, backoffLimit=backoffLimit, imagePullPolicy=imagePullPolicy, privileged=privileged, dryrun=dryrun, _map_helper=True) for thunk in thunks]
-
-    def chunk_job_info(job_info, chunk_size):
-        for i in range(0, len(job_info), chunk_size):
-            yield job_info[i:i + chunk_size]
-            
-    def submit_jobs_from_info(job_infos):
-        job_names = [ji[0] for ji in job_infos]
-        job_specs = [ji[1] for ji in job_infos]
-        combined_job_spec = "\n---\n".join(job_specs)
-        
-        encoded_job_spec = combined_job_spec.encode("utf-8")
-        if encoded_job_spec.__sizeof__() > 1000000:
-            raise ValueError("Job spec too large. Please reduce the chunk size.")
-
-        try:
-            proc = subprocess.run("kubectl apply -f -",
-                            shell=True,
-                            input=combined_job_spec.encode("utf-8"),
-                            stdout=subprocess.DEVNULL,
-                            stderr=subprocess.DEVNULL,
-                            check=True)
-        except subprocess.CalledProcessError as e:
-            print("Error in submitting jobs:", e, flush=True)
-            print("Command:" + e.cmd, "-----stdout-----", e.stdout, "-----stderr-----", e.stderr, flush=True, sep="\n")
-            raise e
-
-        return job_names    
-  
-    with ThreadPoolExecutor(max_workers=1000) as executor:
-        chunk_names = executor.map(submit_jobs_from_info, list(chunk_job_info(job_info, chunk_size)))
-
-    job_names = [name for chunk in chunk_names for name in chunk] 
-    
-    if asynchro or dryrun:
-        return job_names
-    else:
-        return wait(job_names, timeout=timeout, delete=delete)
+        verbose=None,
+        chunk_size=None,
+        mode="jobs",
+        parallelism=None,
+        fanout=None,
+        leaf_size=None,
+        imports=None,
+        config=None):
+    deprecated_map_args(verbose=verbose, chunk_size=chunk_size)
+    return map_arglists(func, [(arg,) for arg in iterable], requests=requests, limits=limits, image=image, backoffLimit=backoffLimit, volumes=volumes, imagePullPolicy=imagePullPolicy, privileged=privileged, timeout=timeout, delete=delete, asynchro=asynchro, name=name, dryrun=dryrun, mode=mode, parallelism=parallelism, fanout=fanout, leaf_size=leaf_size, imports=imports, config=config)
 
 
 def starmap(func,
@@ -447,103 +826,203 @@ def starmap(func,
             delete=True,
             asynchro=False,
             dryrun=False,
-            verbose=False,
-            chunk_size=100):
-    thunks = [lambda arg=i: func(*arg) for i in iterable]
-
-    if dryrun:
-        job_names = [run(thunk, image=image, name=name, requests=requests, limits=limits, backoffLimit=backoffLimit, imagePullPolicy=imagePullPolicy, privileged=privileged, volumes=volumes, dryrun=dryrun) for thunk in thunks]
-        return job_names
-    
-    job_info = [run(thunk, image=image, name=name, requests=requests, limits=limits, backoffLimit=backoffLimit, volumes=volumes, imagePullPolicy=imagePullPolicy, privileged=privileged, dryrun=dryrun, _map_helper=True) for thunk in thunks]
-
-    def chunk_job_info(job_info, chunk_size):
-        for i in range(0, len(job_info), chunk_size):
-            yield job_info[i:i + chunk_size]
-            
-    def submit_jobs_from_info(job_infos):
-        job_names = [ji[0] for ji in job_infos]
-        job_specs = [ji[1] for ji in job_infos]
-        combined_job_spec = "\n---\n".join(job_specs)
-        
-        encoded_job_spec = combined_job_spec.encode("utf-8")
-        if encoded_job_spec.__sizeof__() > 1000000:
-            raise ValueError("Job spec too large. Please reduce the chunk size.")
-
-        try:
-            proc = subprocess.run("kubectl apply -f -",
-                            shell=True,
-                            input=combined_job_spec.encode("utf-8"),
-                            stdout=subprocess.DEVNULL,
-                            stderr=subprocess.DEVNULL,
-                            check=True)
-        except subprocess.CalledProcessError as e:
-            print("Error in submitting jobs:", e, flush=True)
-            print("Command:" + e.cmd, "-----stdout-----", e.stdout, "-----stderr-----", e.stderr, flush=True, sep="\n")
-            print("---- job spec -----", combined_job_spec, "---- end job spec ----", flush=True, sep="\n")
-            raise e
-
-        return job_names    
-  
-    # Submit the chunks one by one
-    with ThreadPoolExecutor(max_workers=1000) as executor:
-        chunk_names = executor.map(submit_jobs_from_info, list(chunk_job_info(job_info, chunk_size)))   
-
-    job_names = [name for chunk in chunk_names for name in chunk] 
-    
-    if asynchro or dryrun:
-        return job_names
-    else:
-        return wait(job_names, timeout=timeout, delete=delete)
+            verbose=None,
+            chunk_size=None,
+            mode="jobs",
+            parallelism=None,
+            fanout=None,
+            leaf_size=None,
+            imports=None,
+            config=None):
+    deprecated_map_args(verbose=verbose, chunk_size=chunk_size)
+    return map_arglists(func, [tuple(args) for args in iterable], requests=requests, limits=limits, image=image, backoffLimit=backoffLimit, volumes=volumes, imagePullPolicy=imagePullPolicy, privileged=privileged, timeout=timeout, delete=delete, asynchro=asynchro, name=name, dryrun=dryrun, mode=mode, parallelism=parallelism, fanout=fanout, leaf_size=leaf_size, imports=imports, config=config)
 
 
 ################
-# Chunked versions of map and starmap -- for very large sets of jobs
+# Streaming versions of map -- for iterables too big (or too slow) to submit all at once
 
-def chunked_map(func, iterable, size=100, asynchro=False, **kwargs):
-    thunks = [lambda arg=arg: func(arg) for arg in iterable]
+def imap(func, iterable, max_in_flight=100, ordered=True, delete=True, sk8s_config=None, **kwargs):
+    # Yields func(arg) for each arg, pulling from the iterable only as jobs
+    # finish, so that at most max_in_flight jobs are submitted but not yet
+    # yielded. Results come out in input order, or in completion order if
+    # ordered=False. Other keyword arguments are passed on to run().
+    if kwargs.get("config") is None:
+        kwargs["config"] = sk8s.session.get_session().config
 
-    def thunker(thunks):
-        results = [thunk() for thunk in thunks]
-        return results
-
-    thunk_chunks = [thunks[i:i + size] for i in range(0, len(thunks), size)]
+    backend = sk8s.backends.get_backend(kwargs["config"])
+    ns = sk8s.get_current_namespace() if backend is None else backend.namespace
 
-    #chunked_results = [thunker(chunk) for chunk in thunk_chunks]
- 
-    def flatten(l):
-        return [item for sublist in l for item in sublist]
+    payload = sk8s.payloads.ship(func, namespace=ns, config=kwargs["config"])
 
-    if asynchro:
-        chunked_jobs = sk8s.map(thunker, thunk_chunks, asynchro=True, **kwargs)
-        return chunked_jobs
+    run_id = sk8s.util.random_string(8)
+    if backend is not None:
+        table = backend.table(label_selector=f"{run_label}={run_id}")
+        collector = backend.collector(sk8s_config)
     else:
-        chunked_jobs = sk8s.map(thunker, thunk_chunks, asynchro=True, **kwargs)
-        results = sk8s.chunked_wait(chunked_jobs)
-        return results
-    
+        table = sk8s.watch.JobTable(ns, label_selector=f"{run_label}={run_id}").sync()
+        collector = sk8s.results.ResultCollector(ns, sk8s_config=sk8s_config)
 
-def chunked_starmap(func, iterable, size=100, asynchro=False, **kwargs):
-    thunks = [lambda arg=arg: func(*arg) for arg in iterable]
+    args = iter(iterable)
+    exhausted = False
+    in_flight = dict()  # job name -> position in the input
+    finished = dict()   # position -> result, held until its turn comes (ordered only)
+    next_in = 0
+    next_out = 0
 
-    def thunker(thunks):
-        results = [thunk() for thunk in thunks]
-        return results
+    try:
+        while True:
+            room = max_in_flight - len(in_flight) - len(finished)
+            if (not exhausted) and (room > 0):
+                batch = list(itertools.islice(args, room))
+                exhausted = len(batch) < room
+                if len(batch) > 0:
+                    job_info = [run(payload, arg, run_id=run_id, task_index=next_in + i, _map_helper=True, **kwargs) for i, arg in enumerate(batch)]
+                    for i, (job, _) in enumerate(job_info):
+                        in_flight[job] = next_in + i
+                    next_in += len(batch)
+                    submit_jobs(job_info, namespace=ns, config=kwargs["config"])
+                    sk8s.payloads.put(payload, namespace=ns, config=kwargs["config"])
+
+            if len(in_flight) == 0:
+                break
+
+            table.until(lambda statuses: any(job in statuses and statuses[job]["finished"] for job in in_flight))
+            done = [job for job in in_flight if job in table.statuses and table.statuses[job]["finished"]]
+
+            failures = [job for job in done if table.statuses[job]["succeeded"] < table.statuses[job]["completions"]]
+            if len(failures) > 0:
+                raise RuntimeError(f"Jobs {' '.join(failures)} failed.")
+
+            collector.fetch(done)
+            results = [collector.pop(job) for job in done]
+            if delete:
+                reap(done, namespace=ns, config=kwargs["config"])
+
+            for job, result in zip(done, results):
+                position = in_flight.pop(job)
+                if ordered:
+                    finished[position] = result
+                else:
+                    yield result
+
+            while next_out in finished:
+                yield finished.pop(next_out)
+                next_out += 1
+    finally:
+        # Also runs if the caller stops iterating early.
+        collector.close()
+        if delete:
+            # Whatever is left of the run (jobs still in flight if the caller
+            # stopped early) goes in one call.
+            reap(list(in_flight), namespace=ns, label_selector=f"{run_label}={run_id}", digests=[payload.digest], config=kwargs["config"])
+
+
+def imap_unordered(func, iterable, max_in_flight=100, **kwargs):
+    return imap(func, iterable, max_in_flight=max_in_flight, ordered=False, **kwargs)
 
-    thunk_chunks = [thunks[i:i + size] for i in range(0, len(thunks), size)]
 
-    #chunked_results = [thunker(chunk) for chunk in thunk_chunks]
- 
-    def flatten(l):
-        return [item for sublist in l for item in sublist]
+################
+# Chunked versions of map and starmap -- for very large sets of jobs
+
+# Each chunk carries its arguments pickled, at most max_chunk_bytes of them
+# (and at most `size` arguments, unless size is None), so that chunks of big
+# arguments get fewer of them rather than outgrowing the job spec. The
+# function goes to the cluster once, as the map's payload.
+max_chunk_bytes = 32 << 10
+
+
+def pack_chunks(arglists, size=None, max_bytes=None):
+    if max_bytes is None:
+        max_bytes = max_chunk_bytes
+    chunks = []
+    chunk, chunk_bytes = [], 0
+    for args in arglists:
+        pickled = pickle.dumps(args)
+        if (len(chunk) > 0) and ((chunk_bytes + len(pickled) > max_bytes) or (size is not None and len(chunk) >= size)):
+            chunks.append(chunk)
+            chunk, chunk_bytes = [], 0
+        chunk.append(pickled)
+        chunk_bytes += len(pickled)
+    if len(chunk) > 0:
+        chunks.append(chunk)
+    return chunks
+
+
+# With size="auto", chunks are sized to take about target_seconds each:
+# a pilot chunk of pilot_chunk_size arguments is timed first, then the rest
+# are streamed out (see imap), max_pods at a time, each chunk sized by the
+# seconds per argument measured so far. Chunks are also kept to an even
+# share of what's left among max_pods, so the last of the work is spread
+# out rather than left to a few long chunks.
+chunk_target_seconds = 180
+max_chunk_pods = 100
+pilot_chunk_size = 10
+
+
+def auto_chunk_size(seconds, items, remaining, target_seconds, max_pods):
+    # seconds is how long `items` arguments have taken so far.
+    share = -(-remaining // max_pods)
+    if seconds <= 0:
+        return max(1, share)
+    return max(1, min(share, int(target_seconds * items / seconds)))
+
+
+def auto_chunks(func, arglists, cpus=None, target_seconds=None, max_pods=None, max_chunk_bytes=None, timeout=None, delete=True, **kwargs):
+    if target_seconds is None:
+        target_seconds = chunk_target_seconds
+    if max_pods is None:
+        max_pods = max_chunk_pods
+    timed = functools.partial(sk8s.runner.run_timed_chunk, func, cpus=cpus)
+
+    pilot = pack_chunks(arglists[:pilot_chunk_size], max_bytes=max_chunk_bytes)[0]
+    seconds, results = wait(run(timed, pilot, **kwargs), timeout=timeout, delete=delete, sk8s_config=kwargs.get("config"))
+    measured = dict(seconds=seconds, items=len(pilot))
+
+    def chunks():
+        # Pulled by imap as chunks finish, so each is sized with the latest measurements.
+        i = len(pilot)
+        while i < len(arglists):
+            size = auto_chunk_size(measured["seconds"], measured["items"], len(arglists) - i, target_seconds, max_pods)
+            yield from pack_chunks(arglists[i:i + size], max_bytes=max_chunk_bytes)
+            i += size
+
+    for seconds, chunk_results in imap(timed, chunks(), max_in_flight=max_pods, delete=delete, sk8s_config=kwargs.get("config"), **kwargs):
+        measured["seconds"] += seconds
+        measured["items"] += len(chunk_results)
+        results.extend(chunk_results)
+    return results
+
 
+def cpu_quantity(value):
+    # A Kubernetes CPU quantity (2, "1.5", "500m") in CPUs.
+    if value is None:
+        return None
+    value = str(value)
+    return int(value[:-1]) / 1000 if value.endswith("m") else float(value)
+
+
+def chunked_starmap(func, iterable, size=100, asynchro=False, max_chunk_bytes=None, target_seconds=None, max_pods=None, **kwargs):
+    # Each chunk's pod runs its arguments in as many processes as it has
+    # CPUs (see sk8s.runner.chunk_processes): as many as it requests, or
+    # failing that its CPU limit.
+    cpus = cpu_quantity((kwargs.get("requests") or {}).get("cpu") or (kwargs.get("limits") or {}).get("cpu"))
+    arglists = [tuple(args) for args in iterable]
+    if size == "auto":
+        if asynchro:
+            raise ValueError("Chunks sized with size='auto' are sized as they run, so they can't be run asynchro.")
+        if len(arglists) == 0:
+            return []
+        return auto_chunks(func, arglists, cpus=cpus, target_seconds=target_seconds, max_pods=max_pods, max_chunk_bytes=max_chunk_bytes, **kwargs)
+    chunks = pack_chunks(arglists, size=size, max_bytes=max_chunk_bytes)
+    chunked_jobs = sk8s.map(functools.partial(sk8s.runner.run_chunk, func, cpus=cpus), chunks, asynchro=True, **kwargs)
     if asynchro:
-        chunked_jobs = sk8s.map(thunker, thunk_chunks, asynchro=True, **kwargs)
         return chunked_jobs
-    else:
-        chunked_jobs = sk8s.map(thunker, thunk_chunks, asynchro=True, **kwargs)
-        results = sk8s.chunked_wait(chunked_jobs)
-        return results
+    return sk8s.chunked_wait(chunked_jobs, sk8s_config=kwargs.get("config"))
+
+
+def chunked_map(func, iterable, size=100, asynchro=False, max_chunk_bytes=None, target_seconds=None, max_pods=None, **kwargs):
+    return chunked_starmap(func, [(arg,) for arg in iterable], size=size, asynchro=asynchro, max_chunk_bytes=max_chunk_bytes,
+                           target_seconds=target_seconds, max_pods=max_pods, **kwargs)
 
 
 def chunked_wait(chunked_jobs, **kwargs):
@@ -0,0 +1,94 @@
+from kubernetes import client
+
+import sk8s.session
+import sk8s.throttle
+import sk8s.util
+
+
+# Clients come from the current session (see sk8s.session), which keeps a
+# single long-lived ApiClient. Its urllib3 pool keeps HTTP connections to the
+# API server alive between calls, so submitting thousands of jobs costs
+# thousands of requests rather than thousands of processes.
+
+
+def api_client():
+    return sk8s.session.get_session().api_client
+
+
+def batch_api():
+    return sk8s.session.get_session().batch_api()
+
+
+def core_api():
+    return sk8s.session.get_session().core_api()
+
+
+def drain(response):
+    response.data
+    response.release_conn()
+
+
+def create_job(job, namespace, api=None):
+    if api is None:
+        api = batch_api()
+    # Skip deserializing the echoed Job into model objects; just drain the
+    # body so the connection can go back to the pool.
+    drain(api.create_namespaced_job(namespace=namespace, body=job, _preload_content=False))
+
+
+def create_jobs(jobs, namespace=None, api=None, max_workers=None, submitter=None):
+    # Create each job with its own request, and collect errors per job rather
+    # than letting one bad job sink its neighbours. Requests are paced, and
+    # retried when the API server pushes back, by the submitter (see
+    # sk8s.throttle). Returns {name: exception} for the jobs that could not be
+    # created.
+    if namespace is None:
+        namespace = sk8s.util.get_current_namespace()
+    if api is None:
+        api = batch_api()
+    if submitter is None:
+        submitter = sk8s.throttle.get_submitter()
+
+    outcomes = submitter.map(lambda job: create_job(job, namespace, api=api), jobs, max_workers=max_workers)
+
+    return {job["metadata"]["name"]: e for job, e in zip(jobs, outcomes) if e is not None}
+
+
+# Deletes use background propagation: the API server removes the job and
+# returns, and the garbage collector removes its pods after. A job that's
+# already gone (say its ttlSecondsAfterFinished ran out) counts as deleted.
+
+
+def delete_job(name, namespace, api=None):
+    if api is None:
+        api = batch_api()
+    drain(api.delete_namespaced_job(name=name, namespace=namespace, propagation_policy="Background", _preload_content=False))
+
+
+def delete_job_collection(namespace, label_selector, api=None):
+    # Every job the selector matches, in one request.
+    if api is None:
+        api = batch_api()
+    drain(api.delete_collection_namespaced_job(namespace=namespace, label_selector=label_selector,
+                                               propagation_policy="Background", _preload_content=False))
+
+
+def delete_jobs(names, namespace=None, api=None, label_selector=None, submitter=None):
+    # Deletes the named jobs, or with a label_selector every job it matches
+    # (the caller must know that's just `names`). Returns {name: exception}
+    # for the jobs that could not be deleted, as create_jobs() does.
+    if namespace is None:
+        namespace = sk8s.util.get_current_namespace()
+    if api is None:
+        api = batch_api()
+    if submitter is None:
+        submitter = sk8s.throttle.get_submitter()
+
+    if label_selector is not None:
+        e = submitter.call(lambda: delete_job_collection(namespace, label_selector, api=api))
+        if getattr(e, "status", None) != 403:
+            return {name: e for name in names} if e is not None else {}
+        # A role without deletecollection (from before sk8s used it, say): one at a time, then.
+
+    outcomes = submitter.map(lambda name: delete_job(name, namespace, api=api), names)
+    return {name: e for name, e in zip(names, outcomes) if (e is not None) and (getattr(e, "status", None) != 404)}
@@ -0,0 +1,146 @@
+import base64
+import hashlib
+import zlib
+from collections import namedtuple
+
+import dill
+from kubernetes.client.rest import ApiException
+
+import sk8s.backends
+import sk8s.kube
+import sk8s.results
+import sk8s.session
+import sk8s.store
+import sk8s.util
+# The pods load their payloads with load_task (see sk8s.runner).
+from sk8s.runner import load_task, payload_mount_dir, payload_mount_path, payload_url_env
+
+
+# A payload is a serialized function stored once, compressed, under its
+# content hash, and fetched by every job that runs it. Jobs then carry only
+# their own arguments, instead of a fresh copy of the function (and its
+# closure and globals) each. Small payloads go in a ConfigMap that's mounted
+# into the jobs; ones too big for a ConfigMap go in the result store (the
+# result volume or result_obs_prefix, see sk8s.results), and the jobs fetch
+# them from there when they start.
+
+Payload = namedtuple("Payload", ["name", "digest", "code", "data", "url"])
+
+payload_label = "sk8s/payload"
+payload_volume = "sk8s-payload"
+
+# Compressed payloads bigger than this go in the result store. (ConfigMaps
+# hold 1MiB, base64-encoded.)
+max_configmap_bytes = 512 << 10
+
+# Serialized arguments bigger than this are shipped as a payload too, rather
+# than in the job spec (see sk8s.jobs.run).
+max_inline_bytes = 64 << 10
+
+# Payloads in the result store are under {prefix}{payloads_dir}{digest}.
+payloads_dir = "sk8s-payloads/"
+
+
+def payload_url(digest, config):
+    prefix = sk8s.results.result_prefix(config)
+    if prefix is None:
+        return None
+    return f"{prefix}{payloads_dir}{digest}"
+
+
+def make_payload(func, config=None):
+    pickled = dill.dumps(func, byref=True, recurse=False)
+    digest = hashlib.sha256(pickled).hexdigest()[:32]
+    data = zlib.compress(pickled, 1)
+    url = None
+    if len(data) > max_configmap_bytes:
+        url = payload_url(digest, config if config is not None else sk8s.session.get_session().config)
+        if url is None:
+            raise ValueError(f"This function is {len(data)} bytes compressed, too big to ship in a ConfigMap; "
+                             "set result_volume or result_obs_prefix so it can be stored there.")
+    return Payload(name=f"sk8s-payload-{digest}", digest=digest, code=base64.b64encode(pickled).decode("utf-8"), data=data, url=url)
+
+
+def put(payload, namespace=None, config=None):
+    # Idempotent: a payload with the same content hash is the same payload.
+    if payload.url is not None:
+        # Content-addressed, so if it's there, it's this.
+        if not any(url == payload.url for url, _ in sk8s.store.list_objects(payload.url)):
+            sk8s.store.put(payload.url, payload.data)
+        return
+    backend = sk8s.backends.get_backend(config)
+    if backend is not None:
+        backend.put(payload)
+        return
+    if namespace is None:
+        namespace = sk8s.util.get_current_namespace()
+    body = dict(apiVersion="v1",
+                kind="ConfigMap",
+                metadata=dict(name=payload.name, labels={payload_label: payload.digest}),
+                binaryData=dict(payload=base64.b64encode(payload.data).decode("ascii")))
+    try:
+        response = sk8s.kube.core_api().create_namespaced_config_map(namespace=namespace, body=body, _preload_content=False)
+        # Drained, so the connection goes back to the pool clean.
+        response.data
+        response.release_conn()
+    except ApiException as e:
+        if e.status != 409:
+            raise
+
+
+def ship(func, namespace=None, dryrun=False, config=None):
+    payload = make_payload(func, config=config)
+    if not dryrun:
+        put(payload, namespace=namespace, config=config)
+    return payload
+
+
+def attach(spec, payload):
+    # Mount the payload into a job built by run(), and label the job with it
+    # so we can tell when the payload is no longer in use.
+    spec["metadata"].setdefault("labels", dict())[payload_label] = payload.digest
+    pod_spec = spec["spec"]["template"]["spec"]
+    if payload.url is not None:
+        pod_spec["containers"][0].setdefault("env", []).append(dict(name=payload_url_env, value=payload.url))
+        return spec
+    pod_spec.setdefault("volumes", []).append(dict(name=payload_volume, configMap=dict(name=payload.name)))
+    pod_spec["containers"][0].setdefault("volumeMounts", []).append(dict(name=payload_volume, mountPath=payload_mount_dir, readOnly=True))
+    return spec
+
+
+def release(digests, namespace=None, config=None, session=None):
+    # Delete the payloads that no remaining job refers to. Submitters put()
+    # their payload again after creating their jobs, so a payload deleted here
+    # just before a new map started using it gets recreated, and the new
+    # pods' mounts are retried until it is back.
+    if session is None:
+        session = sk8s.session.get_session()
+    if config is None:
+        config = session.config
+    backend = sk8s.backends.get_backend(config)
+    if backend is not None:
+        for digest in backend.release(digests):
+            delete_stored(digest, config)
+        return
+    if namespace is None:
+        namespace = session.namespace
+    batch_v1 = session.batch_api()
+    core_v1 = session.core_api()
+    for digest in digests:
+        remaining = batch_v1.list_namespaced_job(namespace=namespace, label_selector=f"{payload_label}={digest}", limit=1)
+        if len(remaining.items) > 0:
+            continue
+        delete_stored(digest, config)
+        try:
+            core_v1.delete_namespaced_config_map(name=f"sk8s-payload-{digest}", namespace=namespace)
+        except ApiException as e:
+            if e.status != 404:
+                raise
+
+
+def delete_stored(digest, config):
+    url = payload_url(digest, config)
+    if url is not None:
+        for stored, _ in list(sk8s.store.list_objects(url)):
+            if stored == url:
+                sk8s.store.delete(url)
@@ -0,0 +1,591 @@
+import base64
+import concurrent.futures
+import functools
+import hashlib
+import hmac
+import http.client
+import itertools
+import json
+import math
+import secrets
+import socket
+import subprocess
+import threading
+import time
+import traceback
+import urllib.parse
+import uuid
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import dill
+
+import sk8s.util
+
+
+# A pool of long-lived workers that pull tasks from a queue: for lots of
+# short tasks, which as jobs would each pay for scheduling a pod, starting
+# its container and starting Python. The queue and the workers are services
+# (see sk8s.services), and a Pool is used like a concurrent.futures executor:
+#
+#   with sk8s.pool(20, requests={"cpu": "1"}) as pool:
+#       squares = list(pool.map(lambda x: x * x, range(10000)))
+#       future = pool.submit(f, 1, y=2)
+#
+# The number of workers follows the queue: one per tasks_per_worker tasks
+# queued or running, up to max_workers, and back down to min_workers once
+# there's been less to do for scale_down_seconds. A task whose worker goes
+# away (scaled down, say) goes back on the queue for another one.
+#
+# Every request to the queue carries the pool's token, which only the pool
+# and its workers have. Control messages are JSON, and the queue never
+# unpickles anything: functions, arguments and results are pickled by the
+# client and the workers, and only passed through the queue, base64-encoded.
+
+queue_port = 5000
+
+# A worker that stops reporting on its task for lease_seconds is presumed
+# gone. Workers report every heartbeat_seconds while they run a task.
+lease_seconds = 30
+heartbeat_seconds = 5
+
+# Longest a request waits for a task, or for results, before coming back empty.
+poll_seconds = 10
+
+# Tasks per request, when submitting many.
+max_tasks_per_put = 1000
+
+default_tasks_per_worker = 4
+default_scale_down_seconds = 60
+default_autoscale_interval = 2
+
+
+class TaskQueue:
+    def __init__(self, lease_seconds=lease_seconds):
+        self.lease_seconds = lease_seconds
+        self.lock = threading.Condition()
+        self.funcs = dict()     # digest -> pickled function
+        self.pending = deque()  # (task id, function digest, base64 of the pickled (args, kwargs))
+        self.leased = dict()    # task id -> (task, lease expiry)
+        self.results = dict()   # client id -> [(task id, ok, base64 of the pickled value or exception)]
+
+    def put_func(self, digest, data):
+        with self.lock:
+            self.funcs[digest] = data
+
+    def put_tasks(self, tasks):
+        with self.lock:
+            self.pending.extend(tasks)
+            self.lock.notify_all()
+
+    def cancel(self, task_ids):
+        # Drops those of task_ids that haven't started.
+        task_ids = set(task_ids)
+        with self.lock:
+            self.pending = deque(task for task in self.pending if task[0] not in task_ids)
+
+    def expire(self):
+        # Call with the lock held. Tasks whose workers went quiet go back at the front of the queue.
+        now = time.time()
+        expired = [task for task, expiry in self.leased.values() if expiry < now]
+        for task in expired:
+            del self.leased[task[0]]
+        self.pending.extendleft(reversed(expired))
+
+    def take(self, wait):
+        deadline = time.time() + wait
+        with self.lock:
+            while True:
+                self.expire()
+                if len(self.pending) > 0:
+                    task = self.pending.popleft()
+                    self.leased[task[0]] = (task, time.time() + self.lease_seconds)
+                    return task
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self.lock.wait(min(remaining, self.lease_seconds))
+
+    def heartbeat(self, task_ids):
+        with self.lock:
+            for task_id in task_ids:
+                if task_id in self.leased:
+                    self.leased[task_id] = (self.leased[task_id][0], time.time() + self.lease_seconds)
+
+    def finish(self, task_id, ok, data):
+        with self.lock:
+            # A task handed out twice (its first worker went quiet, then came
+            # back) is finished by whichever worker gets there first.
+            if self.leased.pop(task_id, None) is None:
+                return
+            self.results.setdefault(task_id.rsplit("-", 1)[0], []).append((task_id, ok, data))
+            self.lock.notify_all()
+
+    def collect(self, client, wait):
+        deadline = time.time() + wait
+        with self.lock:
+            while len(self.results.get(client) or []) == 0:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return []
+                self.lock.wait(remaining)
+            return self.results.pop(client)
+
+    def stats(self):
+        with self.lock:
+            self.expire()
+            return dict(pending=len(self.pending), running=len(self.leased))
+
+
+def make_handler(queue, token):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def reply(self, code, data=b"", content_type="application/octet-stream"):
+            self.send_response(code)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def dispatch(self, method):
+            try:
+                self.route(method)
+            except (TypeError, ValueError, KeyError):
+                # A malformed message.
+                self.reply(400)
+
+        def route(self, method):
+            url = urllib.parse.urlparse(self.path)
+            query = urllib.parse.parse_qs(url.query)
+            wait = float(query.get("wait", [0])[0])
+            length = int(self.headers.get("Content-Length") or 0)
+            body = self.rfile.read(length) if length > 0 else b""
+
+            if not hmac.compare_digest(self.headers.get("Authorization") or "", f"Bearer {token}"):
+                return self.reply(403)
+            if url.path.startswith("/funcs/"):
+                digest = url.path[len("/funcs/"):]
+                if method == "POST":
+                    queue.put_func(digest, body)
+                    return self.reply(204)
+                with queue.lock:
+                    data = queue.funcs.get(digest)
+                return self.reply(404) if data is None else self.reply(200, data)
+            message = json.loads(body) if len(body) > 0 else None
+            if url.path == "/tasks" and method == "POST":
+                # [task id, function digest, base64 of the pickled (args, kwargs)] each.
+                queue.put_tasks([(str(task_id), str(digest), str(args)) for task_id, digest, args in message])
+                return self.reply(204)
+            if url.path == "/tasks" and method == "DELETE":
+                queue.cancel([str(task_id) for task_id in message])
+                return self.reply(204)
+            if url.path == "/task":
+                task = queue.take(wait)
+                return self.reply(204) if task is None else self.reply_json(list(task))
+            if url.path == "/heartbeat":
+                queue.heartbeat([str(task_id) for task_id in message])
+                return self.reply(204)
+            if url.path == "/results" and method == "POST":
+                # [task id, whether it succeeded, base64 of the pickled result or exception].
+                task_id, ok, data = message
+                queue.finish(str(task_id), bool(ok), str(data))
+                return self.reply(204)
+            if url.path == "/results":
+                return self.reply_json([list(result) for result in queue.collect(query["client"][0], wait)])
+            if url.path == "/stats":
+                return self.reply_json(queue.stats())
+            self.reply(404)
+
+        def reply_json(self, message):
+            self.reply(200, json.dumps(message).encode("utf-8"), content_type="application/json")
+
+        def do_GET(self): self.dispatch("GET")
+        def do_POST(self): self.dispatch("POST")
+        def do_DELETE(self): self.dispatch("DELETE")
+
+        def handle(self):
+            try:
+                super().handle()
+            except ConnectionError:
+                pass
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+class QueueServer:
+    def __init__(self, host="127.0.0.1", port=0, lease_seconds=lease_seconds, token=None):
+        self.queue = TaskQueue(lease_seconds=lease_seconds)
+        self.token = token if token is not None else new_token()
+        self.server = ThreadingHTTPServer((host, port), make_handler(self.queue, self.token))
+        self.server.daemon_threads = True
+        self.url = f"http://{host}:{self.server.server_address[1]}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+
+
+def new_token():
+    return secrets.token_hex(16)
+
+
+def serve(token, port=queue_port):
+    # The queue service's main loop.
+    QueueServer(host="0.0.0.0", port=port, token=token).server.serve_forever()
+
+
+class QueueClient:
+    # Requests to the queue, over a kept-alive connection per thread.
+    def __init__(self, url, token):
+        parsed = urllib.parse.urlparse(url)
+        self.host = parsed.hostname
+        self.port = parsed.port
+        self.headers = {"Authorization": f"Bearer {token}"}
+        self.local = threading.local()
+
+    def send(self, method, path, message):
+        return self.request(method, path, json.dumps(message).encode("utf-8"))
+
+    def request(self, method, path, body=None):
+        for attempt in range(2):
+            connection = getattr(self.local, "connection", None)
+            if connection is None:
+                connection = self.local.connection = http.client.HTTPConnection(self.host, self.port, timeout=poll_seconds + 30)
+            try:
+                connection.request(method, path, body=body, headers=self.headers)
+                response = connection.getresponse()
+                data = response.read()
+            except (ConnectionError, http.client.HTTPException, socket.timeout):
+                # The queue dropped our kept-alive connection; try once more on a new one.
+                connection.close()
+                self.local.connection = None
+                if attempt == 1:
+                    raise
+                continue
+            if response.status >= 400:
+                raise RuntimeError(f"Task queue: {method} {path} failed with {response.status}.")
+            return response.status, data
+
+
+def encode(data):
+    return base64.b64encode(data).decode("ascii")
+
+
+def decode(data):
+    return base64.b64decode(data)
+
+
+def dump_exception(e):
+    try:
+        return dill.dumps(e)
+    except Exception:
+        return dill.dumps(RuntimeError("".join(traceback.format_exception(type(e), e, e.__traceback__))))
+
+
+def work(url, token, stop=None, wait=poll_seconds):
+    # A worker's main loop: runs tasks from the queue at url, one at a time,
+    # until stop (a threading.Event) is set, or forever.
+    queue = QueueClient(url, token)
+    funcs = dict()
+    current = [None]
+    stopped = stop if stop is not None else threading.Event()
+
+    def heartbeat():
+        while not stopped.wait(heartbeat_seconds):
+            if current[0] is not None:
+                try:
+                    queue.send("POST", "/heartbeat", [current[0]])
+                except Exception:
+                    pass
+    threading.Thread(target=heartbeat, daemon=True).start()
+
+    while not stopped.is_set():
+        try:
+            status, data = queue.request("GET", f"/task?wait={wait}")
+            if status == 204:
+                continue
+            task_id, digest, args = json.loads(data)
+            if digest not in funcs:
+                funcs[digest] = dill.loads(queue.request("GET", f"/funcs/{digest}")[1])
+        except Exception:
+            # The queue isn't up yet, or is restarting.
+            traceback.print_exc()
+            time.sleep(1)
+            continue
+
+        current[0] = task_id
+        try:
+            args, kwargs = dill.loads(decode(args))
+            result = [task_id, True, encode(dill.dumps(funcs[digest](*args, **kwargs)))]
+        except Exception as e:
+            traceback.print_exc()
+            result = [task_id, False, encode(dump_exception(e))]
+        current[0] = None
+
+        for attempt in itertools.count():
+            try:
+                queue.send("POST", "/results", result)
+                break
+            except Exception:
+                if stopped.is_set():
+                    break
+                time.sleep(min(30, 2 ** attempt))
+
+
+def run_chunk(func, chunk):
+    return [func(*args) for args in chunk]
+
+
+class Pool:
+    def __init__(self, url, token, scale=None, workers=1, min_workers=None, max_workers=None,
+                 tasks_per_worker=default_tasks_per_worker,
+                 scale_down_seconds=default_scale_down_seconds,
+                 autoscale_interval=default_autoscale_interval,
+                 on_shutdown=None):
+        # scale(n), if given, sets the number of workers, now `workers`;
+        # on_shutdown(), if given, tears the pool down.
+        self.queue = QueueClient(url, token)
+        self.url = url
+        self.scale = scale
+        self.workers = workers
+        self.min_workers = min_workers if min_workers is not None else min(1, workers)
+        self.max_workers = max_workers if max_workers is not None else workers
+        self.tasks_per_worker = tasks_per_worker
+        self.scale_down_seconds = scale_down_seconds
+        self.autoscale_interval = autoscale_interval
+        self.on_shutdown = on_shutdown
+        self.client_id = uuid.uuid4().hex[:16]
+        self.task_ids = itertools.count()
+        self.lock = threading.Lock()
+        self.futures = dict()  # task id -> future, for tasks not yet done
+        self.funcs = set()     # digests the queue has
+        self.quiet_since = None
+        self.closed = threading.Event()
+        self.collector = threading.Thread(target=self.collect, daemon=True)
+        self.collector.start()
+
+    def register(self, fn):
+        data = dill.dumps(fn, byref=True, recurse=False)
+        digest = hashlib.sha256(data).hexdigest()[:32]
+        if digest not in self.funcs:
+            self.queue.request("POST", f"/funcs/{digest}", data)
+            self.funcs.add(digest)
+        return digest
+
+    def submit_many(self, fn, arglists):
+        # Submits fn(*args, **kwargs) for each (args, kwargs) in arglists, returning their futures.
+        if self.closed.is_set():
+            raise RuntimeError("cannot schedule new futures after shutdown")
+        digest = self.register(fn)
+        tasks = [[f"{self.client_id}-{next(self.task_ids)}", digest, encode(dill.dumps((tuple(args), kwargs)))] for args, kwargs in arglists]
+        futures = [concurrent.futures.Future() for _ in tasks]
+        for task, future in zip(tasks, futures):
+            future.task_id = task[0]
+        with self.lock:
+            self.futures.update((task[0], future) for task, future in zip(tasks, futures))
+        for i in range(0, len(tasks), max_tasks_per_put):
+            self.queue.send("POST", "/tasks", tasks[i:i + max_tasks_per_put])
+        return futures
+
+    def cancel(self, futures):
+        # Cancels those of futures that haven't finished, and takes their
+        # tasks off the queue, so that no worker starts them.
+        task_ids = [future.task_id for future in futures if future.cancel()]
+        with self.lock:
+            for task_id in task_ids:
+                self.futures.pop(task_id, None)
+        for i in range(0, len(task_ids), max_tasks_per_put):
+            self.queue.send("DELETE", "/tasks", task_ids[i:i + max_tasks_per_put])
+
+    def submit(self, fn, *args, **kwargs):
+        return self.submit_many(fn, [(args, kwargs)])[0]
+
+    def map(self, fn, *iterables, timeout=None, chunksize=1):
+        # Like Executor.map: everything is submitted now, and the results come
+        # back in order as they're iterated over.
+        arglists = list(zip(*iterables))
+        if chunksize > 1:
+            chunks = [arglists[i:i + chunksize] for i in range(0, len(arglists), chunksize)]
+            futures = self.submit_many(functools.partial(run_chunk, fn), [((chunk,), {}) for chunk in chunks])
+        else:
+            futures = self.submit_many(fn, [(args, {}) for args in arglists])
+        deadline = time.time() + timeout if timeout is not None else None
+
+        def results():
+            try:
+                for future in futures:
+                    result = future.result(timeout=None if deadline is None else max(0, deadline - time.time()))
+                    if chunksize > 1:
+                        yield from result
+                    else:
+                        yield result
+            finally:
+                self.cancel(futures)
+        return results()
+
+    def collect(self):
+        # Resolves futures as their results come in, and scales the workers.
+        last_scaled = 0
+        while not (self.closed.is_set() and len(self.futures) == 0):
+            try:
+                _, data = self.queue.request("GET", f"/results?client={self.client_id}&wait=0.5")
+                results = json.loads(data)
+            except Exception:
+                if self.closed.is_set():
+                    break
+                time.sleep(1)
+                continue
+            for task_id, ok, value in results:
+                with self.lock:
+                    future = self.futures.pop(task_id, None)
+                if (future is None) or not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    value = dill.loads(decode(value))
+                except Exception as e:
+                    ok, value = False, e
+                if ok:
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+            if (self.scale is not None) and (time.time() - last_scaled >= self.autoscale_interval) and not self.closed.is_set():
+                last_scaled = time.time()
+                try:
+                    self.autoscale()
+                except Exception:
+                    traceback.print_exc()
+
+    def wanted_workers(self, stats):
+        outstanding = stats["pending"] + stats["running"]
+        return max(self.min_workers, min(self.max_workers, math.ceil(outstanding / self.tasks_per_worker)))
+
+    def autoscale(self):
+        stats = json.loads(self.queue.request("GET", "/stats")[1])
+        wanted = self.wanted_workers(stats)
+        if wanted > self.workers:
+            self.scale(wanted)
+            self.workers = wanted
+        if wanted >= self.workers:
+            self.quiet_since = None
+        elif self.quiet_since is None:
+            self.quiet_since = time.time()
+        elif time.time() - self.quiet_since >= self.scale_down_seconds:
+            self.scale(wanted)
+            self.workers = wanted
+            self.quiet_since = None
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        with self.lock:
+            outstanding = dict(self.futures)
+        if cancel_futures:
+            self.cancel(list(outstanding.values()))
+        if wait:
+            concurrent.futures.wait(outstanding.values())
+        self.closed.set()
+        if wait:
+            self.collector.join()
+        if self.on_shutdown is not None:
+            self.on_shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.shutdown(wait=type is None, cancel_futures=type is not None)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def port_forward(service, port, namespace, timeout=60):
+    # Forwards a free local port to service:port; returns the process and its URL.
+    local_port = free_port()
+    process = subprocess.Popen(["kubectl", "port-forward", "-n", namespace, f"service/{service}", f"{local_port}:{port}"],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    start = time.time()
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", local_port), timeout=1).close()
+            return process, f"http://127.0.0.1:{local_port}"
+        except OSError:
+            if (process.poll() is not None) or (time.time() - start > timeout):
+                process.kill()
+                raise RuntimeError(f"Couldn't forward a port to service {service}.")
+            time.sleep(0.2)
+
+
+def pool(n_workers,
+         image=None,
+         requests=dict(),
+         limits=dict(),
+         min_workers=None,
+         max_workers=None,
+         tasks_per_worker=default_tasks_per_worker,
+         scale_down_seconds=default_scale_down_seconds,
+         name=None,
+         namespace=None,
+         config=None,
+         timeout=300):
+    # Starts a queue and n_workers workers, as services, and returns a Pool
+    # of them. Shutting the pool down deletes them. The workers scale
+    # between min_workers (default 1) and max_workers (default n_workers).
+    import sk8s.services
+    from kubernetes import client
+    import sk8s.kube
+
+    if name is None:
+        name = f"pool-{sk8s.util.random_string(5)}"
+    # In the queue's and the workers' specs, so readable to whoever can read Deployments in the namespace.
+    token = new_token()
+    if namespace is None:
+        namespace = sk8s.util.get_current_namespace()
+    queue_service = f"{name}-queue"
+    workers_deployment = f"{name}-workers"
+
+    sk8s.services.service(serve, token, queue_port, name=queue_service, ports=[queue_port], namespace=namespace,
+                          config=config, image=image, timeout=timeout)
+    try:
+        sk8s.services.service(work, f"http://{queue_service}:{queue_port}", token, name=workers_deployment, ports=[], expose=False,
+                              replicas=n_workers, requests=requests, limits=limits, namespace=namespace,
+                              config=config, image=image, timeout=timeout)
+        forwarder = None
+        if sk8s.util.in_pod():
+            url = f"http://{queue_service}:{queue_port}"
+        else:
+            forwarder, url = port_forward(queue_service, queue_port, namespace)
+    except Exception:
+        subprocess.run(f"kubectl delete service,deployment -n {namespace} {queue_service} --ignore-not-found && "
+                       f"kubectl delete deployment -n {namespace} {workers_deployment} --ignore-not-found", shell=True)
+        raise
+
+    def scale(n):
+        client.AppsV1Api(sk8s.kube.api_client()).patch_namespaced_deployment_scale(
+            name=workers_deployment, namespace=namespace, body={"spec": {"replicas": n}})
+
+    def shutdown():
+        if forwarder is not None:
+            forwarder.terminate()
+        subprocess.run(f"kubectl delete deployment -n {namespace} {workers_deployment} && "
+                       f"kubectl delete service,deployment -n {namespace} {queue_service}", shell=True, check=True)
+
+    return Pool(url, token, scale=scale, workers=n_workers, min_workers=min_workers, max_workers=max_workers,
+                tasks_per_worker=tasks_per_worker, scale_down_seconds=scale_down_seconds, on_shutdown=shutdown)
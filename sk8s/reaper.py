@@ -0,0 +1,71 @@
+import atexit
+import concurrent.futures
+import os
+import threading
+import traceback
+
+
+# Cleans up after finished jobs in the background, so that wait() and imap()
+# hand back results without waiting on deletes. Cleanups run one at a time,
+# in the order they were asked for; one that fails prints its traceback and
+# doesn't stop the rest. Whatever is still pending when the process exits
+# runs before it does, or call flush() to wait for it sooner.
+
+# The process's reaper, and what it has yet to do. A process forked from
+# this one (see sk8s.backends) starts its own.
+_executor = None
+_pid = None
+_pending = set()
+_lock = threading.Lock()
+
+
+def report(future):
+    with _lock:
+        _pending.discard(future)
+    if (not future.cancelled()) and (future.exception() is not None):
+        e = future.exception()
+        traceback.print_exception(type(e), e, e.__traceback__)
+
+
+def reap(func, *args, **kwargs):
+    # Runs func(*args, **kwargs) in the background; returns its future.
+    global _executor, _pid
+    with _lock:
+        if (_executor is None) or (_pid != os.getpid()):
+            _executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="sk8s-reaper")
+            _pid = os.getpid()
+            _pending.clear()
+        future = _executor.submit(func, *args, **kwargs)
+        _pending.add(future)
+    future.add_done_callback(report)
+    return future
+
+
+def flush(timeout=None):
+    # Waits for the cleanups asked for so far. Returns whether they all finished.
+    with _lock:
+        pending = list(_pending)
+    _, not_done = concurrent.futures.wait(pending, timeout=timeout)
+    return len(not_done) == 0
+
+
+def forked():
+    # The parent's cleanups are the parent's to run: a forked process (a
+    # local backend's worker, say) mustn't wait for them at exit, or for a
+    # lock it inherited while held.
+    global _executor, _pid, _lock
+    _executor, _pid, _lock = None, None, threading.Lock()
+    _pending.clear()
+
+
+os.register_at_fork(after_in_child=forked)
+
+# At exit, before thread pools stop taking work: cleanups use them (see
+# sk8s.throttle). atexit handlers run too late for that -- concurrent.futures
+# has shut its pools down by then -- and only threading's own exit hook, which
+# is private, runs early enough. Where it's missing, atexit is the best
+# there is: cleanups that need a pool fail, and leave their jobs to their TTL.
+if hasattr(threading, "_register_atexit"):
+    threading._register_atexit(flush)
+else:
+    atexit.register(flush)
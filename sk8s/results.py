@@ -0,0 +1,309 @@
+import base64
+import itertools
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import urllib3
+from kubernetes.client.rest import ApiException
+
+import sk8s.encoding
+import sk8s.jobs
+import sk8s.kube
+import sk8s.session
+import sk8s.store
+import sk8s.util
+# The pods store results with these (see sk8s.runner).
+from sk8s.runner import Ref, binary_suffix, fetch_obs, result_prefix, save_exception, save_result, volume_mount
+
+
+# Fetches job results as the jobs finish, rather than all at once at the end.
+# wait() hands each job to a ResultCollector the moment it sees the job
+# succeed, so fetching overlaps with the jobs still running, and by the time
+# the last job finishes there's only its own result left to fetch.
+
+# Fetches in flight at once.
+default_max_workers = 32
+
+# Retries, with exponential backoff from backoff_seconds, of API calls that fail
+# because the API server is overloaded (429) or having trouble (5xx).
+default_retries = 5
+backoff_seconds = 0.5
+max_backoff_seconds = 30
+
+# Jobs per pod list, when locating the pods that hold results in their logs.
+max_jobs_per_locate = 100
+
+read_chunk_size = 1 << 20
+
+# Results in the result store (result_obs_prefix or result_volume, see
+# sk8s.store) are under a directory per run: {prefix}{run id}/{job}[-{completion index}]{suffix}.
+# The suffix is .json, or binary_suffix for binary-encoded results (see
+# sk8s.encoding). On a result volume (a ReadWriteMany PVC, see sk8s.volumes),
+# which every job then mounts, whoever else mounts it (the client in a pod,
+# or a downstream job) reads them with mmap, rather than through the API
+# server or the client.
+
+def retryable(e):
+    if isinstance(e, ApiException):
+        return (e.status == 429) or (e.status is not None and e.status >= 500)
+    return isinstance(e, (urllib3.exceptions.HTTPError, ConnectionError))
+
+
+def with_retries(func, retries=None):
+    if retries is None:
+        retries = default_retries
+    for attempt in itertools.count():
+        try:
+            return func()
+        except Exception as e:
+            if (attempt >= retries) or not retryable(e):
+                raise
+            headers = getattr(e, "headers", None) or {}
+            try:
+                delay = float(headers.get("Retry-After"))
+            except (TypeError, ValueError):
+                # Jittered, so that fetches that failed together don't retry together.
+                delay = min(max_backoff_seconds, backoff_seconds * 2 ** attempt) * random.uniform(0.5, 1.0)
+            time.sleep(delay)
+
+
+def read_body(response, chunk_size=read_chunk_size):
+    # Reads a response body into one buffer as it arrives, so that it is held
+    # once, rather than as bytes and then again as a decoded str.
+    buffer = bytearray()
+    try:
+        for chunk in response.stream(chunk_size, decode_content=True):
+            buffer += chunk
+    finally:
+        response.release_conn()
+    return buffer
+
+
+def result_key(job, index=None):
+    key = f"{job.run_id}/{job}" if getattr(job, "run_id", None) is not None else str(job)
+    return key if index is None else f"{key}-{index}"
+
+
+def result_suffix(encoding):
+    return ".json" if encoding == "json" else binary_suffix
+
+
+def fetch_pod_log(pod_name, namespace, retries=None, encoding="json"):
+    core_v1 = sk8s.kube.core_api()
+    response = with_retries(lambda: core_v1.read_namespaced_pod_log(name=pod_name, namespace=namespace, _preload_content=False), retries)
+    return read_log(response, encoding)
+
+
+def read_log(response, encoding="json", chunk_size=None):
+    # A result as a pod logs it, decoded as it arrives where it can be: a
+    # binary result's base64 is decoded a chunk at a time, so only the decoded
+    # bytes are held, not the log as well. JSON is parsed once it's all in --
+    # the json module can't parse incrementally -- from the one buffer.
+    if chunk_size is None:
+        chunk_size = read_chunk_size
+    if encoding == "json":
+        return decode_log(read_body(response, chunk_size), encoding)
+    decoded = bytearray()
+    pending = b""
+    try:
+        for chunk in response.stream(chunk_size, decode_content=True):
+            # Whole 4-character base64 groups only; the rest waits for the next chunk.
+            chunk = pending + chunk.translate(None, b" \t\r\n")
+            whole = len(chunk) - len(chunk) % 4
+            decoded += base64.b64decode(chunk[:whole])
+            pending = chunk[whole:]
+    finally:
+        response.release_conn()
+    decoded += base64.b64decode(pending)
+    # A bytearray, so the arrays built on it are writable.
+    return sk8s.encoding.loads(decoded)
+
+
+def decode_log(body, encoding="json"):
+    # A result as a pod logs it (see sk8s.runner.save_result).
+    if encoding == "json":
+        return json.loads(body)
+    # Decoded into a bytearray, so the arrays built on it are writable.
+    return sk8s.encoding.loads(bytearray(base64.b64decode(body)))
+
+
+def load_result(job, index=None, config=None):
+    # The result of `job` (as returned by run() or map()), read from the
+    # result store directly: e.g. in a downstream job, off the result volume,
+    # without the result going through the client.
+    if config is None:
+        config = sk8s.session.get_session().config
+    prefix = result_prefix(config)
+    if prefix is None:
+        raise ValueError("Results are only in the pod logs; set result_volume or result_obs_prefix to load them directly.")
+    return fetch_obs(f"{prefix}{result_key(job, index)}{result_suffix(config.get('result_encoding') or 'json')}")
+
+
+def ref(job, index=None, config=None):
+    # A reference to the result of `job` (a job name, or a future that's
+    # started), to pass to run() or map() in place of the result itself: the
+    # job it's passed to reads it from the result store, so it goes through
+    # neither the client nor a job spec. run() and map() start that job once
+    # `job` has succeeded (see sk8s.dag).
+    if isinstance(job, Future):
+        if job.job is None:
+            raise ValueError("This task hasn't started yet; pass the future itself to run() or map() instead.")
+        job = job.job
+    if config is None:
+        config = sk8s.session.get_session().config
+    prefix = result_prefix(config)
+    if prefix is None:
+        raise ValueError("Results are only in the pod logs; set result_volume or result_obs_prefix to pass them by reference.")
+    # The name as a plain str: a JobName would bring sk8s.jobs into the pod to unpickle it.
+    return Ref(f"{prefix}{result_key(job, index)}{result_suffix(config.get('result_encoding') or 'json')}", str(job))
+
+
+class ResultCollector:
+    def __init__(self, namespace=None, sk8s_config=None, max_workers=None, retries=None):
+        if namespace is None:
+            namespace = sk8s.util.get_current_namespace()
+        if sk8s_config is None:
+            sk8s_config = sk8s.session.get_session().config
+        self.namespace = namespace
+        self.obs_prefix = result_prefix(sk8s_config)
+        self.encoding = sk8s_config.get("result_encoding") or "json"
+        volume = sk8s_config.get("result_volume")
+        if volume and not os.path.isdir(volume_mount(volume)):
+            # The result volume isn't mounted here (we're outside the cluster, say).
+            if self.encoding != "json":
+                raise RuntimeError(f"Results are on volume {volume}, which isn't mounted at {volume_mount(volume)} here; "
+                                   f"collect them in a job that mounts it (volumes=[{volume!r}]).")
+            # JSON results are in the logs too.
+            self.obs_prefix = None
+        self.retries = retries
+        self.executor = ThreadPoolExecutor(max_workers=max_workers if max_workers is not None else default_max_workers)
+        self.lock = threading.Lock()
+        self.located = dict()  # job -> future of a future (or list of futures, for Indexed jobs) of its result
+
+    def fetch(self, jobs):
+        # Starts fetching the results of `jobs`, which must have succeeded: a
+        # list of job names, or of (job, completions) for Indexed jobs stored
+        # in object storage, whose result keys can't be found otherwise.
+        jobs = [job if job.__class__ == tuple else (job, None) for job in jobs]
+        with self.lock:
+            jobs = [(job, completions) for job, completions in jobs if job not in self.located]
+            if self.obs_prefix is not None:
+                for job, completions in jobs:
+                    self.located[job] = self.executor.submit(self.fetch_obs, job, completions)
+            else:
+                for i in range(0, len(jobs), max_jobs_per_locate):
+                    batch = [job for job, _ in jobs[i:i + max_jobs_per_locate]]
+                    located = self.executor.submit(self.locate_pods, batch, dict(jobs[i:i + max_jobs_per_locate]))
+                    for job in batch:
+                        self.located[job] = located
+
+    def url(self, job, index=None):
+        return f"{self.obs_prefix}{result_key(job, index)}{result_suffix(self.encoding)}"
+
+    def fetch_obs(self, job, completions):
+        if completions is None:
+            return self.executor.submit(fetch_obs, self.url(job))
+        return [self.executor.submit(fetch_obs, self.url(job, i)) for i in range(completions)]
+
+    def stored(self, jobs):
+        # Which of `jobs` have results in the result store, listing each run's
+        # directory (a request per thousand results) rather than asking about
+        # each job. Maps each to None, or for Indexed jobs to how many results they have.
+        stored = dict()
+        suffix = result_suffix(self.encoding)
+        for run_id in set(getattr(job, "run_id", None) for job in jobs):
+            names = set(job for job in jobs if getattr(job, "run_id", None) == run_id)
+            directory = f"{self.obs_prefix}{run_id}/" if run_id is not None else self.obs_prefix
+            for url, _ in sk8s.store.list_objects(directory):
+                if not url.endswith(suffix):
+                    continue
+                name = url[len(directory):-len(suffix)]
+                if name in names:
+                    stored[name] = None
+                elif name.rsplit("-", 1)[0] in names and name.rsplit("-", 1)[1].isdigit():
+                    job = name.rsplit("-", 1)[0]
+                    stored[job] = (stored.get(job) or 0) + 1
+        return stored
+
+    def locate_pods(self, jobs, completions=None):
+        # Finds the pods whose logs hold the results of `jobs` with one pod
+        # list, and starts fetching their logs. completions is as for
+        # sk8s.jobs.get_completed_pod_from_jobs().
+        if len(jobs) == 1:
+            selector = f"job-name={jobs[0]}"
+        else:
+            selector = f"job-name in ({','.join(jobs)})"
+        errors = dict()
+        pods = with_retries(lambda: sk8s.jobs.get_completed_pod_from_jobs(jobs, self.namespace, label_selector=selector,
+                                                                          completions=completions, errors=errors), self.retries)
+        located = dict()
+        for job in jobs:
+            if job in errors:
+                located[job] = self.executor.submit(self.fail, errors[job])
+            elif job not in pods:
+                located[job] = self.executor.submit(self.missing, job)
+            elif pods[job].__class__ == list:
+                located[job] = [self.executor.submit(fetch_pod_log, pod, self.namespace, self.retries, self.encoding) for pod in pods[job]]
+            else:
+                located[job] = self.executor.submit(fetch_pod_log, pods[job], self.namespace, self.retries, self.encoding)
+        return located
+
+    def missing(self, job):
+        raise RuntimeError(f"No succeeded pod found for job {job} in namespace {self.namespace}.")
+
+    def fail(self, e):
+        raise e
+
+    def result(self, job):
+        # Blocks until the result of `job` (which must have been passed to fetch()) is in.
+        located = self.located[job].result()
+        if located.__class__ == dict:
+            located = located[job]
+        if located.__class__ == list:
+            return [future.result() for future in located]
+        return located.result()
+
+    def pop(self, job):
+        # result(), and forget the job, for callers that stream through many of them.
+        result = self.result(job)
+        with self.lock:
+            del self.located[job]
+        return result
+
+    def close(self):
+        # Drops fetches that haven't started; ones under way finish in the background.
+        with self.lock:
+            for located in self.located.values():
+                located.cancel()
+        self.executor.shutdown(wait=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+class LocalResultCollector(ResultCollector):
+    # Results of the local backend's jobs (see sk8s.backends): from their
+    # logs, or from the result store if there is one, as in a cluster.
+    def __init__(self, backend, sk8s_config=None, max_workers=None):
+        super().__init__(backend.namespace, sk8s_config=sk8s_config, max_workers=max_workers)
+        self.backend = backend
+
+    def locate_pods(self, jobs, completions=None):
+        with self.backend.condition:
+            logs = {job: self.backend.logs.get(job) for job in jobs}
+        located = dict()
+        for job in jobs:
+            if logs[job] is None:
+                located[job] = self.executor.submit(self.missing, job)
+            elif logs[job].__class__ == list:
+                located[job] = [self.executor.submit(decode_log, log, self.encoding) for log in logs[job]]
+            else:
+                located[job] = self.executor.submit(decode_log, logs[job], self.encoding)
+        return located
@@ -0,0 +1,291 @@
+import base64
+import contextlib
+import functools
+import io
+import json
+import os
+import sys
+import time
+import traceback
+import zlib
+
+import dill
+
+import sk8s.encoding
+import sk8s.store
+
+
+# What a job's pod runs (see the bootstrap in sk8s.jobs): loads the task,
+# runs it, and stores its result. For short tasks, interpreter startup is
+# most of the job, so this imports only what that takes -- not kubernetes,
+# pandas, or the rest of sk8s, which the task can still import if it uses them.
+
+# The job's sk8s config, for the task's own use of sk8s (see sk8s.configs.load_config).
+config_env = "SK8S_CONFIG"
+
+# Where the job finds its payload (see sk8s.payloads): mounted from a
+# ConfigMap, or in the result store at the URL in payload_url_env.
+payload_mount_dir = "/var/run/sk8s/payload"
+payload_mount_path = f"{payload_mount_dir}/payload"
+payload_url_env = "SK8S_PAYLOAD_URL"
+load_retries = 30
+
+# Results in the result store (see sk8s.results) are binary_suffix files for
+# binary-encoded results (see sk8s.encoding), .json otherwise. On the result
+# volume they're under {volume_mount_dir}/{volume}/{volume_results_dir}/.
+binary_suffix = ".sk8s"
+volume_mount_dir = "/mnt"
+volume_results_dir = "sk8s-results"
+
+# Where a container finds its CPU limit: cgroup v2, or v1.
+cgroup_cpu_max = "/sys/fs/cgroup/cpu.max"
+cgroup_cfs_quota = "/sys/fs/cgroup/cpu/cpu.cfs_quota_us"
+cgroup_cfs_period = "/sys/fs/cgroup/cpu/cpu.cfs_period_us"
+
+
+def volume_mount(volume):
+    return f"{volume_mount_dir}/{volume}"
+
+
+def result_prefix(config):
+    # Where results are stored, as a URL prefix: on the result volume, in
+    # result_obs_prefix, or (None) only in the pod logs.
+    if config.get("result_volume"):
+        return f"file://{volume_mount(config['result_volume'])}/{volume_results_dir}/"
+    return config.get("result_obs_prefix")
+
+
+def fetch_obs(url):
+    if url.endswith(".json"):
+        return json.loads(sk8s.store.get(url))
+    # Mapped, if it's a file, so arrays in the result are views of the file.
+    return sk8s.encoding.loads(sk8s.store.get(url, mapped=True))
+
+
+# Set while a job loads its task, so that references to other jobs' results
+# in its arguments (see sk8s.results.ref) load those results from the result
+# store. Anywhere else, they unpickle as references.
+resolving_refs = False
+
+
+class Ref:
+    # A job's result, by its URL in the result store: passed to another job
+    # in place of the result, which that job's pod then reads for itself.
+    def __init__(self, url, job=None):
+        self.url = url
+        self.job = job
+
+    def __reduce__(self):
+        return load_ref, (self.url, self.job)
+
+    def __repr__(self):
+        return f"Ref({self.job if self.job is not None else self.url!r})"
+
+
+def load_ref(url, job=None):
+    if not resolving_refs:
+        return Ref(url, job)
+    # The job has succeeded (see sk8s.dag), but an object store may take a moment to show its result.
+    for attempt in range(load_retries + 1):
+        try:
+            return fetch_obs(url)
+        except json.JSONDecodeError:
+            # What save_exception() leaves in its place.
+            raise RuntimeError(f"Job {job} failed, so its result can't be used.")
+        except Exception:
+            if attempt == load_retries:
+                raise
+            time.sleep(1)
+
+
+def deserialize(code):
+    return dill.loads(base64.b64decode(code))
+
+
+def load_task(code, path=payload_mount_path):
+    # The payload is the function, `code` its arguments.
+    if payload_url_env in os.environ:
+        # If it was released just as this job was submitted, the submitter puts it back (see sk8s.payloads.release).
+        for attempt in range(load_retries + 1):
+            try:
+                data = sk8s.store.get(os.environ[payload_url_env])
+                break
+            except Exception:
+                if attempt == load_retries:
+                    raise
+                time.sleep(1)
+    else:
+        with open(path, "rb") as fp:
+            data = fp.read()
+    func = dill.loads(zlib.decompress(data))
+    args = deserialize(code)
+    if "JOB_COMPLETION_INDEX" in os.environ:
+        # Indexed jobs carry one argument tuple per index.
+        args = args[int(os.environ["JOB_COMPLETION_INDEX"])]
+    return lambda: func(*args)
+
+
+def call_indexed(func, arglists, i):
+    return func(*arglists[i])
+
+
+def cgroup_cpus():
+    # The container's CPU limit, from its cgroup (v2, or v1), or None if it hasn't one.
+    try:
+        with open(cgroup_cpu_max) as fp:
+            quota, period = fp.read().split()
+        return None if quota == "max" else int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+    try:
+        with open(cgroup_cfs_quota) as fp:
+            quota = int(fp.read())
+        with open(cgroup_cfs_period) as fp:
+            period = int(fp.read())
+        return None if quota <= 0 else quota / period
+    except (OSError, ValueError):
+        return None
+
+
+def chunk_processes(cpus=None):
+    # How many processes a chunk runs its arguments in: the CPUs its job
+    # asked for (see sk8s.jobs.chunked_starmap), or if it didn't say, its CPU
+    # limit -- but no more than the container can run on.
+    limit = cgroup_cpus()
+    if cpus is None:
+        cpus = limit if limit is not None else 1
+    usable = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    if limit is not None:
+        usable = min(usable, limit)
+    return max(1, int(min(cpus, usable)))
+
+
+class ChunkError(Exception):
+    # Some of a chunk's arguments failed: failures maps their positions in the chunk to their tracebacks.
+    def __init__(self, failures, n):
+        self.failures = failures
+        details = "\n".join(f"item {i}: {tb}" for i, tb in sorted(failures.items()))
+        super().__init__(f"{len(failures)} of {n} items in the chunk failed:\n{details}")
+
+
+# The function of the chunk being run, inherited by the processes it's run in.
+chunk_func = None
+
+
+def run_item(args, pickled=False):
+    # Returns whether it succeeded, and its result or traceback. Results
+    # coming back from another process are pickled with dill, which can
+    # pickle more of them than the process pool can.
+    try:
+        outcome = True, chunk_func(*dill.loads(args))
+    except Exception:
+        outcome = False, traceback.format_exc()
+    return dill.dumps(outcome) if pickled else outcome
+
+
+def run_chunk(func, chunk, cpus=None):
+    # A chunk of a chunked map: arguments pickled one by one (see
+    # sk8s.jobs.pack_chunks), run in as many processes as chunk_processes(cpus).
+    global chunk_func
+    chunk_func = func
+    processes = min(chunk_processes(cpus), len(chunk))
+    if processes > 1:
+        # Forked, so the processes have the function without pickling it
+        # again. (Imported here, so that jobs that aren't chunks don't pay for it.)
+        import multiprocessing
+        with multiprocessing.get_context("fork").Pool(processes) as pool:
+            outcomes = pool.map(functools.partial(run_item, pickled=True), chunk, chunksize=max(1, len(chunk) // (4 * processes)))
+        outcomes = [dill.loads(outcome) for outcome in outcomes]
+    else:
+        outcomes = [run_item(args) for args in chunk]
+    failures = {i: result for i, (succeeded, result) in enumerate(outcomes) if not succeeded}
+    if len(failures) > 0:
+        raise ChunkError(failures, len(chunk))
+    return [result for _, result in outcomes]
+
+
+def run_timed_chunk(func, chunk, cpus=None):
+    # A chunk of an adaptively chunked map (see sk8s.jobs.auto_chunks): its
+    # results, and how many seconds they took.
+    start = time.perf_counter()
+    results = run_chunk(func, chunk, cpus=cpus)
+    return [time.perf_counter() - start, results]
+
+
+def save_result(key, result, config):
+    # JSON results go to the log, and to the result store if there is one.
+    # Binary ones go to the result store, or if there isn't one to the log,
+    # base64-encoded.
+    encoding = config.get("result_encoding") or "json"
+    prefix = result_prefix(config)
+    if encoding == "json":
+        result = json.dumps(result)
+        if prefix is not None:
+            sk8s.store.put(f"{prefix}{key}.json", result.encode("utf-8"))
+        sys.stdout.write(result)
+    elif prefix is not None:
+        with sk8s.store.writer(f"{prefix}{key}{binary_suffix}") as fp:
+            sk8s.encoding.dump(result, fp, compression=config.get("result_compression"))
+    else:
+        sys.stdout.write(base64.b64encode(sk8s.encoding.dumps(result, compression=config.get("result_compression"))).decode("ascii"))
+
+
+def save_exception(key, e, config):
+    # If results are going to the result store, the exception goes there too.
+    prefix = result_prefix(config)
+    if prefix is not None:
+        traceback_string = "".join(traceback.format_exception(type(e), e, e.__traceback__))
+        message = f"Exception message: {e} Full traceback: {traceback_string}"
+        sk8s.store.put(f"{prefix}{key}.json", message.encode("utf-8"))
+
+
+def import_modules(names):
+    # Made available to the task by name, as if imported where it was
+    # defined: as builtins, which every module's globals fall back on.
+    import builtins
+    import importlib
+    for name in names:
+        importlib.import_module(name)
+        top = name.split(".")[0]
+        setattr(builtins, top, sys.modules[top])
+
+
+def main(name, run_id, code, payload, config, imports=None):
+    global resolving_refs
+    os.environ[config_env] = json.dumps(config)
+    if imports:
+        import_modules(imports)
+    resolving_refs = True
+    func = load_task(code) if payload else deserialize(code)
+
+    # Where the result goes in the result store, if there is one.
+    # Pods of an Indexed job share a name, so their results are keyed by index too.
+    key = f"{run_id}/{name}"
+    if "JOB_COMPLETION_INDEX" in os.environ:
+        key += "-" + os.environ["JOB_COMPLETION_INDEX"]
+
+    try:
+        save_result(key, func(), config)
+    except Exception as e:
+        save_exception(key, e, config)
+        raise e
+
+
+def run_pod(bootstrap, env):
+    # What a job's pod does, for the local backend (see sk8s.backends), in
+    # one of its worker processes: runs the bootstrap with the pod's
+    # environment. Returns whether it succeeded, and what it printed.
+    saved = dict(os.environ)
+    os.environ.update(env)
+    log = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(log):
+            exec(bootstrap, {"__name__": "__main__"})
+        return True, log.getvalue()
+    except Exception:
+        # To stderr, as the pod would.
+        traceback.print_exc()
+        return False, log.getvalue()
+    finally:
+        os.environ.clear()
+        os.environ.update(saved)
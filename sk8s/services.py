@@ -4,6 +4,7 @@ import subprocess
 import pymongo
 import sk8s.util
 import sk8s.volumes
+import functools
 import hashlib
 import sys
 from collections import namedtuple
@@ -21,7 +22,7 @@ spec:
     matchLabels:
       app.kubernetes.io/name: {{name}}
       app.kubernetes.io/component: backend
-  replicas: 1
+  replicas: {{replicas|default(1)}}
   template:
     metadata:
       labels:
@@ -59,14 +60,27 @@ spec:
           - 0.0.0.0
         resources:
           requests:
+          {%- if requests is defined and requests|length > 0 %}
+          {%- for resource, amount in requests.items() %}
+            {{resource}}: "{{amount}}"
+          {%- endfor %}
+          {%- else %}
             cpu: 100m
             memory: 100Mi
+          {%- endif %}
+          {%- if limits is defined and limits|length > 0 %}
+          limits:
+          {%- for resource, amount in limits.items() %}
+            {{resource}}: "{{amount}}"
+          {%- endfor %}
+          {%- endif %}
         {%- if (ports is defined and ports|length > 0) %}
         ports:
         {%- for port in ports %}
         - containerPort: {{port}}
         {%- endfor %}
         {%- endif %}
+{%- if expose is not defined or expose %}
 ---
 apiVersion: v1
 kind: Service
@@ -86,6 +100,7 @@ spec:
   selector:
     app.kubernetes.io/name: {{name}}
     app.kubernetes.io/component: backend
+{%- endif %}
 """
 
 
@@ -120,7 +135,7 @@ def service(func, *args,
     if imagePullPolicy is None:
         imagePullPolicy = config["docker_default_pull_policy"]
 
-    code = sk8s.util.serialize_func(lambda a=args: func(*a))
+    code = sk8s.util.serialize_func(functools.partial(func, *args))
 
     template_args = kwargs.copy()
     template_args["name"] = name
@@ -128,7 +143,7 @@ def service(func, *args,
     template_args["ports"] = ports
     template_args["namespace"] = namespace
     template_args["imagePullPolicy"] = imagePullPolicy
-    template_args["config"] = config if export_config else sk8s.configs.default_config,
+    template_args["config"] = config if export_config else sk8s.configs.default_config
     template_args["code"] = code
 
     service_yaml = template.render(**template_args)
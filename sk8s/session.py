@@ -0,0 +1,145 @@
+import os
+import threading
+
+from kubernetes import client, config
+
+import sk8s.configs
+import sk8s.util
+
+
+# A Session resolves the things nearly every sk8s call needs -- the kube
+# config, the current namespace, API clients, and the sk8s config -- once,
+# instead of once per call. It notices when the kubeconfig or sk8s config
+# file changes on disk and resolves them again.
+#
+# There is a default session, used unless another one is active:
+#
+#   with sk8s.Session(context="other-cluster", namespace="scratch"):
+#       sk8s.map(...)
+
+serviceaccount_dir = "/var/run/secrets/kubernetes.io/serviceaccount"
+
+
+def file_stamp(fname):
+    try:
+        st = os.stat(fname)
+        return (st.st_mtime_ns, st.st_size)
+    except OSError:
+        return None
+
+
+class Session:
+    def __init__(self, kubeconfig=None, context=None, namespace=None, config_file=None, pool_maxsize=64):
+        self.kubeconfig = kubeconfig
+        self.context = context
+        self.namespace_override = namespace
+        self.config_file = config_file
+        self.pool_maxsize = pool_maxsize
+        self.lock = threading.RLock()
+        self.kube_stamp = None
+        self.config_stamp = None
+        self._api_client = None
+        self._namespace = None
+        self._config = None
+
+    def kubeconfig_files(self):
+        if self.kubeconfig is not None:
+            return [self.kubeconfig]
+        if "KUBECONFIG" in os.environ:
+            return [f for f in os.environ["KUBECONFIG"].split(os.pathsep) if f]
+        return [os.path.expanduser("~/.kube/config")]
+
+    def check_kube(self):
+        # Call with the lock held. Throws away the kube-derived state if the kubeconfig changed.
+        if sk8s.util.in_pod() and self.kubeconfig is None:
+            stamp = ("in-pod",)
+        else:
+            stamp = tuple(file_stamp(f) for f in self.kubeconfig_files())
+        if stamp != self.kube_stamp:
+            self.kube_stamp = stamp
+            self.drop_api_client()
+            self._namespace = None
+
+    def drop_api_client(self):
+        # Call with the lock held. Closed, so that its connection pool and threads go with it.
+        if self._api_client is not None:
+            self._api_client.close()
+        self._api_client = None
+
+    @property
+    def api_client(self):
+        with self.lock:
+            self.check_kube()
+            if self._api_client is None:
+                configuration = client.Configuration()
+                if sk8s.util.in_pod() and self.kubeconfig is None:
+                    config.load_incluster_config(client_configuration=configuration)
+                else:
+                    config.load_kube_config(config_file=self.kubeconfig, context=self.context, client_configuration=configuration)
+                # One long-lived pool, so requests reuse their HTTP connections.
+                configuration.connection_pool_maxsize = self.pool_maxsize
+                self._api_client = client.ApiClient(configuration)
+            return self._api_client
+
+    def batch_api(self):
+        return client.BatchV1Api(self.api_client)
+
+    def core_api(self):
+        return client.CoreV1Api(self.api_client)
+
+    @property
+    def namespace(self):
+        if self.namespace_override is not None:
+            return self.namespace_override
+        with self.lock:
+            self.check_kube()
+            if self._namespace is None:
+                if sk8s.util.in_pod() and self.kubeconfig is None:
+                    with open(f"{serviceaccount_dir}/namespace") as fp:
+                        namespace = fp.read()
+                else:
+                    contexts, active = config.list_kube_config_contexts(config_file=self.kubeconfig)
+                    if self.context is not None:
+                        active = next(c for c in contexts if c["name"] == self.context)
+                    namespace = active["context"].get("namespace") or ""
+                # A context with no namespace set means "default"; the API calls need it spelled out.
+                self._namespace = namespace.strip() or "default"
+            return self._namespace
+
+    @property
+    def config(self):
+        # The sk8s config. Shared, so treat it as read-only; use
+        # sk8s.configs.load_config() for a copy to modify and save.
+        fname = self.config_file if self.config_file is not None else sk8s.configs.default_fname
+        with self.lock:
+            stamp = file_stamp(fname)
+            if (self._config is None) or (stamp != self.config_stamp):
+                self._config = sk8s.configs.load_config(fname)
+                self.config_stamp = file_stamp(fname)
+            return self._config
+
+    def invalidate(self):
+        with self.lock:
+            self.kube_stamp = None
+            self.config_stamp = None
+            self.drop_api_client()
+            self._namespace = None
+            self._config = None
+
+    def __enter__(self):
+        _active.append(self)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        _active.remove(self)
+
+
+default_session = Session()
+
+# Sessions entered with `with`, innermost last. Process-wide rather than per
+# thread, so that the worker threads sk8s uses internally see them too.
+_active = []
+
+
+def get_session():
+    return _active[-1] if len(_active) > 0 else default_session
@@ -2,10 +2,18 @@
 import jinja2
 import subprocess
 import pymongo
+import bson
+import bson.codec_options
+import bson.raw_bson
+import sk8s.futures
 import sk8s.util
 import sk8s.volumes
+import collections
+import concurrent.futures
+import functools
 import hashlib
 import sys
+import threading
 
 
 default_mongodb_template = """apiVersion: apps/v1
@@ -101,6 +109,61 @@ def mongo_db_port_forward(db):
     return proc
 
 
+# Memos are kept in the process too, in front of Mongo, as the BSON documents
+# Mongo sent or was sent: read through, written through, and evicted least
+# recently used first once there are more than cache_entries of them or more
+# than cache_bytes together. A cached key's value is taken never to change
+# once set, which is so for memoize()'s keys (hashes of the call), so only
+# they are cached unless a call asks with cache=True; 0 turns it off.
+cache_entries = 100000
+cache_bytes = 256 * 2**20
+# Keys per find or bulk write in get_many() and set_many().
+batch_size = 1000
+
+
+class LRUCache:
+    def __init__(self, max_entries=cache_entries, max_bytes=cache_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()  # key -> its document's raw BSON
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            raw = self.entries.get(key)
+            if raw is not None:
+                self.entries.move_to_end(key)
+            return raw
+
+    def put(self, key, raw):
+        with self.lock:
+            self.discard(key)
+            if (self.max_entries <= 0) or (len(raw) > self.max_bytes):
+                return
+            self.entries[key] = raw
+            self.bytes += len(raw)
+            while (len(self.entries) > self.max_entries) or (self.bytes > self.max_bytes):
+                _, old = self.entries.popitem(last=False)
+                self.bytes -= len(old)
+
+    def discard(self, key):
+        # Call with the lock held.
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.bytes -= len(old)
+
+    def drop(self, key):
+        with self.lock:
+            self.discard(key)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+
 # Note: this class only works within pods right now.
 class WorkflowState:
     def __init__(self, db=None):
@@ -113,19 +176,107 @@ class WorkflowState:
         self.name = self.database["name"]
         self.local_mode = False
         self.client = pymongo.MongoClient(self.database["url"])
-
-    def set(self, key, val):
-        self.client.state.memos.update_one(dict(key=key), {"$set": {"val": val}}, upsert=True)
+        self.init_memos()
+
+    def init_memos(self):
+        # Keyed by _id, so every lookup uses its index. Documents come back
+        # as raw BSON, to be cached as they are and decoded on each get().
+        options = bson.codec_options.CodecOptions(document_class=bson.raw_bson.RawBSONDocument)
+        self.memos = self.client.state.memos.with_options(codec_options=options)
+        self.cache = LRUCache(cache_entries, cache_bytes)
+        self.migrated = False
+
+    def migrate(self):
+        # Memos from before they were keyed by _id -- {"key": ..., "val": ...},
+        # under ObjectIds of their own -- are moved over, the first time the
+        # database is used since; a marker in state.versions says it's done.
+        if self.migrated:
+            return
+        versions = self.client.state.versions
+        if versions.find_one({"_id": "memos"}) is None:
+            legacy = self.client.state.memos
+            ops = []
+            for doc in legacy.find({"key": {"$exists": True}}):
+                # Ordered, so each memo is in its new place before its old one goes.
+                ops += [pymongo.ReplaceOne({"_id": doc["key"]}, {"_id": doc["key"], "val": doc.get("val")}, upsert=True),
+                        pymongo.DeleteOne({"_id": doc["_id"]})]
+                if len(ops) >= 2 * batch_size:
+                    legacy.bulk_write(ops)
+                    ops = []
+            if len(ops) > 0:
+                legacy.bulk_write(ops)
+            versions.replace_one({"_id": "memos"}, {"_id": "memos", "version": 2}, upsert=True)
+        self.migrated = True
+
+    # cache=True, for keys whose values never change once set (as memoize()'s
+    # don't), keeps them in the process's cache; other keys are always read
+    # from Mongo, so other jobs' writes to them are seen.
+    def remember(self, key, raw, cache):
+        if cache:
+            self.cache.put(key, raw)
+        else:
+            self.cache.drop(key)
+
+    def raw(self, key, cache=False):
+        # The key's document, from the cache or with one find; None if there's none.
+        raw = self.cache.get(key) if cache else None
+        if raw is None:
+            self.migrate()
+            doc = self.memos.find_one({"_id": key})
+            if doc is None:
+                return None
+            raw = doc.raw
+            if cache:
+                self.cache.put(key, raw)
+        return raw
+
+    def set(self, key, val, cache=False):
+        self.migrate()
+        raw = bson.encode({"_id": key, "val": val})
+        self.memos.replace_one({"_id": key}, bson.raw_bson.RawBSONDocument(raw), upsert=True)
+        self.remember(key, raw, cache)
         return None
 
-    def get(self, key):
-        result = self.client.state.memos.find_one(dict(key=key))
-        if result is None: return None
-        return result["val"]
-
-    def contains(self, key):
-        result = self.client.state.memos.find_one(dict(key=key))
-        return result is not None
+    def get(self, key, default=None, cache=False):
+        # default if the key isn't set: pass one of your own to tell that from a value of None.
+        raw = self.raw(key, cache=cache)
+        if raw is None:
+            return default
+        return bson.decode(raw)["val"]
+
+    def contains(self, key, cache=False):
+        return self.raw(key, cache=cache) is not None
+
+    def get_many(self, keys, cache=False):
+        # The values of those keys that are set, by key; the ones not cached
+        # are looked up batch_size at a time.
+        keys = list(dict.fromkeys(keys))
+        found = dict()
+        for key in keys if cache else []:
+            raw = self.cache.get(key)
+            if raw is not None:
+                found[key] = raw
+        wanted = [key for key in keys if key not in found]
+        if len(wanted) > 0:
+            self.migrate()
+        for i in range(0, len(wanted), batch_size):
+            for doc in self.memos.find({"_id": {"$in": wanted[i:i + batch_size]}}):
+                found[doc["_id"]] = doc.raw
+                if cache:
+                    self.cache.put(doc["_id"], doc.raw)
+        return {key: bson.decode(found[key])["val"] for key in keys if key in found}
+
+    def set_many(self, items, cache=False):
+        # items: a dict, or (key, value) pairs. Written with unordered bulk
+        # writes, batch_size at a time.
+        self.migrate()
+        docs = [(key, bson.encode({"_id": key, "val": val})) for key, val in dict(items).items()]
+        for i in range(0, len(docs), batch_size):
+            self.memos.bulk_write([pymongo.ReplaceOne({"_id": key}, bson.raw_bson.RawBSONDocument(raw), upsert=True)
+                                   for key, raw in docs[i:i + batch_size]], ordered=False)
+        for key, raw in docs:
+            self.remember(key, raw, cache)
+        return None
 
     def enter_local_mode(self):
         # TODO: pick a random open port to forward through, in case 27017 is in use.
@@ -133,6 +284,7 @@ class WorkflowState:
         self.local_mode = True
         self.local_url = "mongodb://localhost:27017"
         self.client = pymongo.MongoClient(self.local_url)
+        self.init_memos()
 
     def exit_local_mode(self):
         if self.local_mode:
@@ -178,20 +330,64 @@ class WorkflowState:
     def db(self):
         return self.database
 
+    @staticmethod
+    def func_key(func):
+        return hashlib.sha1(sk8s.util.serialize_func(func).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def args_key(func_key, args):
+        return hashlib.sha1((func_key + sk8s.util.serialize_func(tuple(args))).encode("utf-8")).hexdigest()
+
     @staticmethod
     def func_2_md5(func, *args):
-        code = sk8s.util.serialize_func(lambda a=args: func(*a))
-        hash = hashlib.sha1(code.encode("utf-8")).hexdigest()
-        return hash
+        # The function and its arguments are hashed apart, so that a map
+        # (see memoize_map) serializes the function once; a partial's are
+        # taken apart too, so that run(f, x, state=...) agrees with it.
+        if (func.__class__ == functools.partial) and not func.keywords:
+            func, args = func.func, func.args + args
+        return WorkflowState.args_key(WorkflowState.func_key(func), args)
 
     def memoize(self, func, *args):
         hash = self.func_2_md5(func, *args)
         def new_func(args=args, state=self, hash=hash):
-            if hash in state:
-                result = state[hash]
-                return result
-            else:
+            # One lookup: a memoized None is a hit like any other result.
+            nothing = object()
+            result = state.get(hash, nothing, cache=True)
+            if result is nothing:
                 result = func(*args)
-                state[hash] = result
-                return result
-        return new_func
\ No newline at end of file
+                state.set(hash, result, cache=True)
+            return result
+        return new_func
+
+    def memoize_map(self, func, arglists, timeout=None, **kwargs):
+        # func(*args) for each args in arglists, as a map of jobs, but only
+        # the calls not memoized yet run: the rest are looked up together with
+        # get_many(), and the new results memoized together with set_many() --
+        # those that succeeded, even if others failed. Keyword arguments are
+        # as for sk8s.submit().
+        if kwargs.get("asynchro"):
+            raise ValueError("memoize_map waits for its jobs; asynchro=True isn't supported.")
+        kwargs.pop("asynchro", None)
+        arglists = [tuple(args) for args in arglists]
+        func_key = self.func_key(func)
+        keys = [self.args_key(func_key, args) for args in arglists]
+        found = self.get_many(keys, cache=True)
+        todo = list({key: args for key, args in zip(keys, arglists) if key not in found}.items())
+        if len(todo) > 0:
+            # Futures rather than map(), whose results aren't a list when there's only one.
+            futures = sk8s.futures.submit_map(func, [args for _, args in todo], **kwargs)
+            try:
+                concurrent.futures.wait(futures, timeout=timeout)
+                computed = {key: future.result() for (key, _), future in zip(todo, futures)
+                            if future.done() and (not future.cancelled()) and (future.exception() is None)}
+                if len(computed) > 0:
+                    self.set_many(computed, cache=True)
+                for future in futures:
+                    # The first failure, or a TimeoutError if one's still running.
+                    future.result(timeout=0)
+            finally:
+                # Jobs still running when we give up (or are interrupted) are deleted, as aio.imap's are.
+                for future in futures:
+                    future.cancel()
+            found.update(computed)
+        return [found[key] for key in keys]
@@ -0,0 +1,277 @@
+import io
+import mmap
+import os
+import tempfile
+import threading
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Object storage for job results (result_obs_prefix), by URL: file://, s3://
+# and gs://. One client per bucket per process, with a connection pool shared
+# by every thread, rather than a CLI process per object. Large objects are
+# uploaded in parts and downloaded as parallel ranged reads.
+#
+#   sk8s.store.put("s3://bucket/results/x.json", data)
+#   sk8s.store.get("s3://bucket/results/x.json")
+#   sk8s.store.list_objects("s3://bucket/results/")
+
+# Objects past this size are moved in parts of this size.
+part_size = 16 << 20
+
+# Parts of one object moved at once, and connections per client.
+max_part_workers = 8
+max_pool_connections = 64
+
+
+class FileStore:
+    # A directory, local or on a shared filesystem.
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, key):
+        return os.path.join(self.root, key)
+
+    def writer(self, key):
+        # Written beside the final name and moved into place when done, so
+        # nobody reads half a result.
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return AtomicFile(path)
+
+    def put(self, key, data):
+        with self.writer(key) as fp:
+            fp.write(data)
+
+    def get(self, key, mapped=False):
+        with open(self.path(key), "rb") as fp:
+            size = os.fstat(fp.fileno()).st_size
+            if mapped and size > 0:
+                # Copy-on-write: pages are read in as they're touched, and
+                # copied only if they're written to.
+                return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_COPY)
+            data = bytearray(size)
+            fp.readinto(data)
+        return data
+
+    def list(self, prefix):
+        # Keys under prefix, like an object store: not just one directory level.
+        directory = os.path.dirname(self.path(prefix))
+        if not os.path.isdir(directory):
+            return
+        for dirpath, _, fnames in os.walk(directory):
+            for fname in fnames:
+                path = os.path.join(dirpath, fname)
+                key = os.path.relpath(path, self.root)
+                if key.startswith(prefix) and not AtomicFile.is_temporary(fname):
+                    yield key, os.path.getsize(path)
+
+    def delete(self, key):
+        os.remove(self.path(key))
+
+
+class AtomicFile:
+    temporary_suffix = ".sk8s-partial"
+
+    def __init__(self, path):
+        self.path = path
+        self.fp = tempfile.NamedTemporaryFile(dir=os.path.dirname(path), prefix=os.path.basename(path) + ".",
+                                              suffix=self.temporary_suffix, delete=False)
+
+    @classmethod
+    def is_temporary(cls, fname):
+        return fname.endswith(cls.temporary_suffix)
+
+    def write(self, data):
+        return self.fp.write(data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.fp.close()
+        if type is None:
+            os.replace(self.fp.name, self.path)
+        else:
+            os.remove(self.fp.name)
+
+
+class UploadOnClose:
+    # A local temporary file, handed to upload(fname) once it's complete.
+    def __init__(self, upload):
+        self.upload = upload
+        self.fp = tempfile.NamedTemporaryFile(delete=False)
+
+    def write(self, data):
+        return self.fp.write(data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.fp.close()
+        try:
+            if type is None:
+                self.upload(self.fp.name)
+        finally:
+            os.remove(self.fp.name)
+
+
+def ranged_get(size, read_range, first=b""):
+    # Reads an object of `size` bytes with read_range(start, end) (end
+    # exclusive), part_size bytes at a time in parallel, into one buffer.
+    # `first` is what's already been read from the start.
+    data = bytearray(size)
+    data[:len(first)] = first
+    view = memoryview(data)
+
+    def read(start):
+        end = min(start + part_size, size)
+        view[start:end] = read_range(start, end)
+
+    list(transfers().map(read, range(len(first), size, part_size)))
+    return data
+
+
+class S3Store:
+    def __init__(self, bucket):
+        import boto3
+        import botocore.config
+        self.bucket = bucket
+        self.client = boto3.client("s3", config=botocore.config.Config(max_pool_connections=max_pool_connections,
+                                                                        retries=dict(mode="adaptive")))
+
+    def transfer_config(self):
+        from boto3.s3.transfer import TransferConfig
+        return TransferConfig(multipart_threshold=part_size, multipart_chunksize=part_size, max_concurrency=max_part_workers)
+
+    def writer(self, key):
+        return UploadOnClose(lambda fname: self.client.upload_file(fname, self.bucket, key, Config=self.transfer_config()))
+
+    def put(self, key, data):
+        self.client.upload_fileobj(io.BytesIO(data), self.bucket, key, Config=self.transfer_config())
+
+    def get(self, key, mapped=False):
+        import botocore.exceptions
+        try:
+            first = self.client.get_object(Bucket=self.bucket, Key=key, Range=f"bytes=0-{part_size - 1}")
+        except botocore.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] == "InvalidRange":
+                return bytearray()  # empty object
+            raise
+        size = int(first["ContentRange"].split("/")[-1])
+        return ranged_get(size,
+                          lambda start, end: self.client.get_object(Bucket=self.bucket, Key=key, Range=f"bytes={start}-{end - 1}")["Body"].read(),
+                          first=first["Body"].read())
+
+    def list(self, prefix):
+        # A thousand keys per request.
+        for page in self.client.get_paginator("list_objects_v2").paginate(Bucket=self.bucket, Prefix=prefix):
+            for item in page.get("Contents", []):
+                yield item["Key"], item["Size"]
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+
+
+class GCSStore:
+    def __init__(self, bucket):
+        from google.cloud import storage
+        self.client = storage.Client()
+        self.bucket = self.client.bucket(bucket)
+
+    def writer(self, key):
+        def upload(fname):
+            blob = self.bucket.blob(key, chunk_size=part_size)
+            blob.upload_from_filename(fname)
+        return UploadOnClose(upload)
+
+    def put(self, key, data):
+        self.bucket.blob(key, chunk_size=part_size).upload_from_file(io.BytesIO(data))
+
+    def get(self, key, mapped=False):
+        blob = self.bucket.get_blob(key)
+        if blob is None:
+            raise FileNotFoundError(f"gs://{self.bucket.name}/{key}")
+        if blob.size <= part_size:
+            return bytearray(blob.download_as_bytes())
+        return ranged_get(blob.size, lambda start, end: blob.download_as_bytes(start=start, end=end - 1))
+
+    def list(self, prefix):
+        # A thousand keys per request.
+        for blob in self.client.list_blobs(self.bucket, prefix=prefix, page_size=1000):
+            yield blob.name, blob.size
+
+    def delete(self, key):
+        self.bucket.blob(key).delete()
+
+
+backends = {"file": FileStore, "s3": S3Store, "gs": GCSStore}
+
+_lock = threading.Lock()
+_stores = dict()
+_transfers = None
+
+
+def transfers():
+    global _transfers
+    with _lock:
+        if _transfers is None:
+            _transfers = ThreadPoolExecutor(max_workers=max_part_workers)
+        return _transfers
+
+
+def supported(url):
+    return (url is not None) and (urllib.parse.urlparse(url).scheme in backends)
+
+
+def store_for(url):
+    # The (shared) store an object URL is in, and its key there.
+    parsed = urllib.parse.urlparse(url)
+    if parsed.scheme not in backends:
+        raise ValueError(f"Unsupported result store {url!r}; expected one of {', '.join(s + '://' for s in backends)}.")
+    if parsed.scheme == "file":
+        location, key = "/", urllib.parse.unquote(parsed.path).lstrip("/")
+    else:
+        location, key = parsed.netloc, parsed.path.lstrip("/")
+    with _lock:
+        if (parsed.scheme, location) not in _stores:
+            _stores[(parsed.scheme, location)] = backends[parsed.scheme](location)
+        return _stores[(parsed.scheme, location)], key
+
+
+def url_for(url, key):
+    # The URL of `key` in the same store as `url`.
+    parsed = urllib.parse.urlparse(url)
+    if parsed.scheme == "file":
+        return f"file:///{key}"
+    return f"{parsed.scheme}://{parsed.netloc}/{key}"
+
+
+def writer(url):
+    # A file to write an object to; it's stored when the file is closed, with `with`.
+    store, key = store_for(url)
+    return store.writer(key)
+
+
+def put(url, data):
+    store, key = store_for(url)
+    store.put(key, data)
+
+
+def get(url, mapped=False):
+    # Returns a bytearray, or with mapped=True, for file:// URLs, a memory map of the file.
+    store, key = store_for(url)
+    return store.get(key, mapped=mapped)
+
+
+def list_objects(prefix):
+    # Yields (url, size) for every object whose URL starts with prefix.
+    store, key = store_for(prefix)
+    for name, size in store.list(key):
+        yield url_for(prefix, name), size
+
+
+def delete(url):
+    store, key = store_for(url)
+    store.delete(key)
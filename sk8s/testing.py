@@ -0,0 +1,380 @@
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from kubernetes import client
+
+import sk8s.pools
+import sk8s.throttle
+from sk8s.watch import selected
+
+
+# A tiny in-memory stand-in for the parts of the Kubernetes API that sk8s
+# talks to. Good enough for unit tests and for benchmarking the client side
+# of job submission without a cluster. Not good enough for anything else.
+
+job_path = re.compile(r"^/apis/batch/v1/namespaces/(?P<namespace>[^/]+)/jobs(/(?P<name>[^/]+))?/?$")
+configmap_path = re.compile(r"^/api/v1/namespaces/(?P<namespace>[^/]+)/configmaps(/(?P<name>[^/]+))?/?$")
+pod_path = re.compile(r"^/api/v1/namespaces/(?P<namespace>[^/]+)/pods(/(?P<name>[^/]+)(?P<log>/log)?)?/?$")
+
+discovery = {
+    "/api": {"kind": "APIVersions", "versions": ["v1"]},
+    "/apis": {"kind": "APIGroupList", "apiVersion": "v1",
+              "groups": [{"name": "batch",
+                          "versions": [{"groupVersion": "batch/v1", "version": "v1"}],
+                          "preferredVersion": {"groupVersion": "batch/v1", "version": "v1"}}]},
+    "/apis/batch/v1": {"kind": "APIResourceList", "apiVersion": "v1", "groupVersion": "batch/v1",
+                       "resources": [{"name": "jobs", "singularName": "job", "namespaced": True, "kind": "Job",
+                                      "verbs": ["create", "delete", "deletecollection", "get", "list", "patch", "update", "watch"]}]},
+    "/api/v1": {"kind": "APIResourceList", "groupVersion": "v1", "resources": []},
+}
+
+
+def status(code, reason, message):
+    return code, {"kind": "Status", "apiVersion": "v1", "status": "Failure", "reason": reason, "message": message, "code": code}
+
+
+def rate_limit(qps, burst):
+    # A fault for FakeKubeApi: rejects job creation with 429 beyond qps, as
+    # the API server's priority and fairness limits would.
+    bucket = sk8s.throttle.TokenBucket(qps, burst)
+    return lambda method, path: 429 if method == "POST" and job_path.match(path) and bucket.take() > 0 else None
+
+
+class FakeKubeApi:
+    def __init__(self, reject=None, fault=None):
+        # reject(name) may return an HTTP status code to refuse a job with, and
+        # fault(method, path) one to fail any request with.
+        self.reject = reject
+        self.fault = fault
+        self.jobs = dict()
+        self.pods = dict()
+        self.logs = dict()
+        self.configmaps = dict()
+        self.history = []  # (time, method, path) of every request
+        self.events = []  # (resourceVersion, type, job), oldest first
+        self.resource_version = 0
+        self.requests = 0
+        self.lock = threading.Condition()
+
+    def record(self, event_type, job):
+        # Call with the lock held.
+        self.resource_version += 1
+        job["metadata"]["resourceVersion"] = str(self.resource_version)
+        self.events.append((self.resource_version, event_type, json.loads(json.dumps(job))))
+        self.lock.notify_all()
+
+    def delete_job(self, namespace, name):
+        # Call with the lock held.
+        job = self.jobs.pop((namespace, name), None)
+        if job is not None:
+            self.record("DELETED", job)
+            # The garbage collector would take the job's pods with it.
+            for key in [key for key, pod in self.pods.items() if key[0] == namespace and pod["metadata"]["labels"]["job-name"] == name]:
+                del self.pods[key]
+                del self.logs[key]
+        return job
+
+    def set_job_status(self, namespace, name, **job_status):
+        with self.lock:
+            job = self.jobs[(namespace, name)]
+            job["status"] = job_status
+            self.record("MODIFIED", job)
+
+    def complete_job(self, namespace, name, failed=False, results=None, logs=None):
+        # What the job controller does once a job's pods are done. A pod per
+        # completion, each of which logs its entry of results as JSON (or
+        # its entry of logs, verbatim).
+        with self.lock:
+            job = self.jobs[(namespace, name)]
+            completions = job["spec"].get("completions") or 1
+            indexed = job["spec"].get("completionMode") == "Indexed"
+            for i in range(completions):
+                pod_name = f"{name}-{i}-{self.resource_version}"
+                metadata = dict(name=pod_name, namespace=namespace,
+                                labels=dict(job["spec"]["template"].get("metadata", {}).get("labels") or {}, **{"job-name": name}),
+                                ownerReferences=[dict(apiVersion="batch/v1", kind="Job", name=name, uid=name)])
+                if indexed:
+                    metadata["annotations"] = {"batch.kubernetes.io/job-completion-index": str(i)}
+                self.pods[(namespace, pod_name)] = dict(metadata=metadata, status=dict(phase="Failed" if failed else "Succeeded"))
+                if logs is not None:
+                    self.logs[(namespace, pod_name)] = logs[i]
+                else:
+                    self.logs[(namespace, pod_name)] = json.dumps(results[i] if results is not None else None) + "\n"
+        condition = dict(type="Failed" if failed else "Complete", status="True")
+        if failed:
+            self.set_job_status(namespace, name, failed=1, conditions=[condition])
+        else:
+            self.set_job_status(namespace, name, succeeded=completions, conditions=[condition])
+
+    def watch(self, namespace, since, label_selector, field_selector, timeout):
+        deadline = time.time() + timeout
+        position = 0
+        while True:
+            with self.lock:
+                while position < len(self.events) and self.events[position][0] <= since:
+                    position += 1
+                if position == len(self.events):
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return
+                    self.lock.wait(remaining)
+                    continue
+                events = self.events[position:]
+                position = len(self.events)
+            for _, event_type, job in events:
+                if job["metadata"].get("namespace") == namespace and selected(job, label_selector, field_selector):
+                    yield {"type": event_type, "object": job}
+
+    def handle(self, method, url, body):
+        parsed = urlparse(url)
+        path = parsed.path
+        query = {key: values[0] for key, values in parse_qs(parsed.query).items()}
+
+        with self.lock:
+            self.requests += 1
+            self.history.append((time.time(), method, path))
+
+        code = self.fault(method, path) if self.fault is not None else None
+        if code is not None:
+            return status(code, "Injected", f"{method} {path} failed by test")
+
+        if method == "GET" and path in discovery:
+            return 200, discovery[path]
+
+        m = configmap_path.match(path)
+        if m is not None:
+            return self.handle_configmaps(method, m.group("namespace"), m.group("name"), body)
+
+        m = pod_path.match(path)
+        if m is not None:
+            return self.handle_pods(method, m.group("namespace"), m.group("name"), m.group("log") is not None, query)
+
+        m = job_path.match(path)
+        if m is None:
+            return status(404, "NotFound", f"no fake handler for {method} {path}")
+        namespace, name = m.group("namespace"), m.group("name")
+        label_selector, field_selector = query.get("labelSelector"), query.get("fieldSelector")
+
+        if method == "POST" and name is None:
+            name = body["metadata"]["name"]
+            if self.reject is not None and self.reject(name):
+                code = self.reject(name)
+                return status(code, "Rejected", f"job {name} rejected by test")
+            with self.lock:
+                if (namespace, name) in self.jobs:
+                    return status(409, "AlreadyExists", f'jobs.batch "{name}" already exists')
+                body["metadata"]["namespace"] = namespace
+                self.jobs[(namespace, name)] = body
+                self.record("ADDED", body)
+            return 201, body
+
+        if method == "GET" and name is not None:
+            with self.lock:
+                job = self.jobs.get((namespace, name))
+            if job is None:
+                return status(404, "NotFound", f'jobs.batch "{name}" not found')
+            return 200, job
+
+        if method == "GET" and name is None and query.get("watch") == "true":
+            since = int(query.get("resourceVersion") or 0)
+            timeout = int(query.get("timeoutSeconds") or 60)
+            return 200, self.watch(namespace, since, label_selector, field_selector, timeout)
+
+        if method == "GET" and name is None:
+            with self.lock:
+                items = [job for (ns, _), job in self.jobs.items() if ns == namespace and selected(job, label_selector, field_selector)]
+                items = json.loads(json.dumps(items))
+                resource_version = str(self.resource_version)
+            return 200, {"kind": "JobList", "apiVersion": "batch/v1", "metadata": {"resourceVersion": resource_version}, "items": items}
+
+        if method == "DELETE" and name is not None:
+            with self.lock:
+                job = self.delete_job(namespace, name)
+            if job is None:
+                return status(404, "NotFound", f'jobs.batch "{name}" not found')
+            return 200, job
+
+        if method == "DELETE" and name is None:
+            with self.lock:
+                names = [n for (ns, n), job in self.jobs.items() if ns == namespace and selected(job, label_selector, field_selector)]
+                items = [self.delete_job(namespace, n) for n in names]
+            return 200, {"kind": "JobList", "apiVersion": "batch/v1", "metadata": {}, "items": items}
+
+        return status(405, "MethodNotAllowed", f"{method} {path}")
+
+    def handle_configmaps(self, method, namespace, name, body):
+        with self.lock:
+            if method == "POST" and name is None:
+                name = body["metadata"]["name"]
+                if (namespace, name) in self.configmaps:
+                    return status(409, "AlreadyExists", f'configmaps "{name}" already exists')
+                self.configmaps[(namespace, name)] = body
+                return 201, body
+            if method == "DELETE" and name is not None:
+                configmap = self.configmaps.pop((namespace, name), None)
+                if configmap is None:
+                    return status(404, "NotFound", f'configmaps "{name}" not found')
+                return 200, configmap
+        return status(405, "MethodNotAllowed", f"{method} configmaps")
+
+    def handle_pods(self, method, namespace, name, log, query):
+        if method == "GET" and name is None:
+            with self.lock:
+                items = [pod for (ns, _), pod in self.pods.items() if ns == namespace and selected(pod, query.get("labelSelector"), query.get("fieldSelector"))]
+                items = json.loads(json.dumps(items))
+            return 200, {"kind": "PodList", "apiVersion": "v1", "metadata": {"resourceVersion": str(self.resource_version)}, "items": items}
+
+        if method == "GET" and log:
+            with self.lock:
+                text = self.logs.get((namespace, name))
+            if text is None:
+                return status(404, "NotFound", f'pods "{name}" not found')
+            return 200, text
+
+        return status(405, "MethodNotAllowed", f"{method} pods")
+
+
+def make_handler(api):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive, like the real thing
+        disable_nagle_algorithm = True  # headers and body go out as separate writes
+
+        def dispatch(self, method):
+            length = int(self.headers.get("Content-Length") or 0)
+            body = json.loads(self.rfile.read(length)) if length > 0 else None
+            code, payload = api.handle(method, self.path, body)
+
+            if isinstance(payload, str):
+                # A pod log
+                data = payload.encode("utf-8")
+                self.send_response(code)
+                self.send_header("Content-Type", "text/plain")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+                return
+
+            if not isinstance(payload, dict):
+                # A watch: one JSON event per line, one line per chunk, as the API server does.
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                for event in payload:
+                    line = json.dumps(event).encode("utf-8") + b"\n"
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(line), line))
+                    self.wfile.flush()
+                self.wfile.write(b"0\r\n\r\n")
+                return
+
+            data = json.dumps(payload).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self): self.dispatch("GET")
+        def do_POST(self): self.dispatch("POST")
+        def do_PUT(self): self.dispatch("PUT")
+        def do_PATCH(self): self.dispatch("PATCH")
+        def do_DELETE(self): self.dispatch("DELETE")
+
+        def handle(self):
+            try:
+                super().handle()
+            except ConnectionError:
+                pass  # a client dropped its pooled connection
+
+        def finish(self):
+            try:
+                super().finish()
+            except (ConnectionError, ValueError):
+                pass
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+class FakeKubeApiServer:
+    def __init__(self, reject=None, fault=None, port=0):
+        self.api = FakeKubeApi(reject=reject, fault=fault)
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(self.api))
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def api_client(self, pool_maxsize=64):
+        configuration = client.Configuration(host=self.url)
+        configuration.connection_pool_maxsize = pool_maxsize
+        return client.ApiClient(configuration)
+
+    def write_kubeconfig(self, fname, namespace="default"):
+        # A kubeconfig for this server, for sk8s.Session(kubeconfig=fname).
+        kubeconfig = {"apiVersion": "v1", "kind": "Config", "current-context": "fake",
+                      "clusters": [dict(name="fake", cluster=dict(server=self.url))],
+                      "users": [dict(name="fake", user=dict())],
+                      "contexts": [dict(name="fake", context=dict(cluster="fake", user="fake", namespace=namespace))]}
+        with open(fname, "w") as fp:
+            json.dump(kubeconfig, fp)
+        return fname
+
+    @property
+    def jobs(self):
+        return self.api.jobs
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+
+
+class LocalWorkers:
+    # Threads standing in for a pool's worker Deployment (see sk8s.pools).
+    def __init__(self, url, token, wait=0.2):
+        self.url = url
+        self.token = token
+        self.wait = wait
+        self.workers = []  # (thread, stop event)
+
+    def scale(self, n):
+        while len(self.workers) < n:
+            stop = threading.Event()
+            thread = threading.Thread(target=sk8s.pools.work, args=(self.url, self.token), kwargs=dict(stop=stop, wait=self.wait), daemon=True)
+            thread.start()
+            self.workers.append((thread, stop))
+        while len(self.workers) > n:
+            # A worker stops after its current task, or an idle one within `wait`.
+            self.workers.pop()[1].set()
+
+    def stop(self):
+        self.scale(0)
+
+
+def local_pool(n_workers, lease_seconds=sk8s.pools.lease_seconds, **kwargs):
+    # A sk8s.pools.Pool with its queue served here and its workers as
+    # threads, for tests. Keyword arguments are passed on to Pool.
+    queue = sk8s.pools.QueueServer(lease_seconds=lease_seconds).start()
+    workers = LocalWorkers(queue.url, queue.token)
+    workers.scale(n_workers)
+
+    def shutdown():
+        workers.stop()
+        queue.stop()
+
+    return sk8s.pools.Pool(queue.url, queue.token, scale=workers.scale, workers=n_workers, on_shutdown=shutdown, **kwargs)
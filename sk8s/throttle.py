@@ -0,0 +1,204 @@
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import urllib3
+from kubernetes.client.rest import ApiException
+
+import sk8s.session
+
+
+# Paces requests to the API server so that big submissions run as fast as
+# it will take them, rather than tripping its limits (API Priority and
+# Fairness rejects with 429) and failing. Requests are started at most
+# `qps` per second, with bursts of up to `burst`, and at most `concurrency`
+# at once. Concurrency adapts, AIMD style: it grows by about one for each
+# round of requests that succeeds, and halves when the server pushes back
+# (429, 5xx, or a timeout). Requests it pushed back on are retried, with
+# backoff, and idempotently: a retried create that finds its object already
+# there (because the attempt that timed out actually went through) counts as done.
+#
+# One Submitter per process (see get_submitter()) is shared by every map,
+# so they share the rate, too. Live counts are in submitter.stats:
+#
+#   sk8s.submit_stats()
+#   {'submitted': 5120, 'accepted': 5000, 'throttled': 120, ...}
+
+# Defaults, overridden by submit_qps and submit_burst in the sk8s config. A
+# qps of 0 means no rate limit.
+default_qps = 100
+default_burst = 200
+
+initial_concurrency = 8
+max_concurrency = 64
+
+max_retries = 8
+backoff_seconds = 0.5
+max_backoff_seconds = 30
+
+
+def throttled(e):
+    # Whether the API server pushed back: it's overloaded, or shedding load,
+    # or didn't answer in time. Worth retrying, more slowly.
+    if isinstance(e, ApiException):
+        return (e.status == 429) or (e.status is not None and e.status >= 500)
+    return isinstance(e, (urllib3.exceptions.HTTPError, ConnectionError, TimeoutError))
+
+
+def indeterminate(e):
+    # Whether the request may have gone through anyway: it timed out, or the
+    # connection dropped, before we heard back.
+    return not isinstance(e, ApiException)
+
+
+def retry_delay(e, attempt):
+    headers = getattr(e, "headers", None) or {}
+    try:
+        return float(headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        # Jittered, so that requests that failed together don't retry together.
+        return min(max_backoff_seconds, backoff_seconds * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        # Takes a token if there is one, and returns 0; otherwise returns how
+        # long until there will be.
+        if not self.rate:
+            return 0
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        # Blocks until a request may start.
+        while True:
+            wait = self.take()
+            if wait == 0:
+                return
+            time.sleep(wait)
+
+
+class AdaptiveConcurrency:
+    def __init__(self, initial=None, maximum=None):
+        self.maximum = maximum if maximum is not None else max_concurrency
+        self.limit = float(min(initial if initial is not None else initial_concurrency, self.maximum))
+        self.in_flight = 0
+        # Requests started before the last decrease don't cause another: one
+        # halving per round of pushback, not one per request pushed back.
+        self.decreased = time.monotonic()
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        # Blocks until there's room; returns when the request started.
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+            return time.monotonic()
+
+    def release(self, started, pushed_back=False):
+        with self.condition:
+            self.in_flight -= 1
+            if pushed_back:
+                if started >= self.decreased:
+                    self.limit = max(1.0, self.limit / 2)
+                    self.decreased = time.monotonic()
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+
+class SubmitStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counts = dict(submitted=0, accepted=0, throttled=0, retried=0, failed=0)
+
+    def count(self, **counts):
+        with self.lock:
+            for key, n in counts.items():
+                self.counts[key] += n
+
+
+class Submitter:
+    def __init__(self, qps=None, burst=None, concurrency=None, max_workers=None, retries=None):
+        self.bucket = TokenBucket(default_qps if qps is None else qps, default_burst if burst is None else burst)
+        self.concurrency = AdaptiveConcurrency(concurrency, max_workers)
+        self.retries = retries if retries is not None else max_retries
+        self.stats = SubmitStats()
+
+    def call(self, func):
+        # Makes the request func() makes, paced and retried. Returns None if
+        # it succeeded, or the exception it finally failed with.
+        maybe_done = False
+        for attempt in range(self.retries + 1):
+            self.bucket.acquire()
+            started = self.concurrency.acquire()
+            self.stats.count(submitted=1, retried=1 if attempt > 0 else 0)
+            try:
+                func()
+            except Exception as e:
+                pushed_back = throttled(e)
+                self.concurrency.release(started, pushed_back=pushed_back)
+                if isinstance(e, ApiException) and (e.status == 409) and maybe_done:
+                    # An earlier attempt went through after all.
+                    self.stats.count(accepted=1)
+                    return None
+                if (not pushed_back) or (attempt == self.retries):
+                    self.stats.count(failed=1)
+                    return e
+                self.stats.count(throttled=1)
+                maybe_done = maybe_done or indeterminate(e)
+                time.sleep(retry_delay(e, attempt))
+                continue
+            self.concurrency.release(started)
+            self.stats.count(accepted=1)
+            return None
+
+    def map(self, func, items, max_workers=None):
+        # func(item) for each item, as call() does it; returns the outcomes in order.
+        if max_workers is None:
+            max_workers = self.concurrency.maximum
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(lambda item: self.call(lambda: func(item)), items))
+
+    def snapshot(self):
+        with self.stats.lock:
+            snapshot = dict(self.stats.counts)
+        snapshot["in_flight"] = self.concurrency.in_flight
+        snapshot["concurrency"] = int(self.concurrency.limit)
+        snapshot["accepted_per_second"] = snapshot["accepted"] / max(time.time() - self.stats.started, 1e-9)
+        return snapshot
+
+
+# The process's submitters, by (qps, burst).
+_submitters = dict()
+_lock = threading.Lock()
+
+
+def get_submitter(config=None):
+    if config is None:
+        config = sk8s.session.get_session().config
+    key = (config.get("submit_qps", default_qps), config.get("submit_burst", default_burst))
+    with _lock:
+        if key not in _submitters:
+            _submitters[key] = Submitter(qps=key[0], burst=key[1])
+        return _submitters[key]
+
+
+def submit_stats(config=None):
+    return get_submitter(config).snapshot()
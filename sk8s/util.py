@@ -13,6 +13,7 @@ import time
 import importlib
 
 import sk8s
+import sk8s.session
 
 
 def run_cmd(cmd, retries=1):
@@ -56,11 +57,8 @@ def get_k8s_config():
 
 
 def get_current_namespace():
-    config = get_k8s_config()
-    if not in_pod():
-        return subprocess.run("kubectl config view --minify --output 'jsonpath={..namespace}'", shell=True, check=True, stdout=subprocess.PIPE).stdout.decode("utf-8")
-    else:
-        return subprocess.run("cat  /var/run/secrets/kubernetes.io/serviceaccount/namespace", shell=True, check=True, stdout=subprocess.PIPE).stdout.decode("utf-8")
+    # Resolved once per session (and again if the kubeconfig changes), not per call.
+    return sk8s.session.get_session().namespace
 
 
 def set_namespace(ns):
@@ -0,0 +1,183 @@
+import json
+import math
+import re
+import time
+
+from kubernetes import watch
+from kubernetes.client.rest import ApiException
+
+import sk8s.jobs
+import sk8s.kube
+import sk8s.payloads
+import sk8s.util
+
+
+# Keeps an in-memory table of job statuses current from a watch stream,
+# instead of re-listing jobs on every tick. Work (and API server load) is
+# proportional to the changes to the jobs being watched, not to the number of
+# jobs in the cluster.
+
+# Longest we hold a single watch request open; it is resumed from the last
+# resourceVersion after that.
+max_watch_seconds = 300
+
+
+def job_status(job):
+    # One row of the status table, from a Job as the API returns it (a dict).
+    metadata = job["metadata"]
+    spec = job.get("spec") or {}
+    status = job.get("status") or {}
+    conditions = status.get("conditions") or []
+    return dict(job=metadata["name"],
+                namespace=metadata.get("namespace"),
+                succeeded=status.get("succeeded") or 0,
+                failed=status.get("failed") or 0,
+                active=status.get("active") or 0,
+                completions=spec.get("completions") or 1,
+                indexed=spec.get("completionMode") == "Indexed",
+                # Complete and Failed are only set once the job's pods have all terminated.
+                finished=any(c["type"] in ("Complete", "Failed") and c["status"] == "True" for c in conditions),
+                payload=(metadata.get("labels") or {}).get(sk8s.payloads.payload_label),
+                run=(metadata.get("labels") or {}).get(sk8s.jobs.run_label))
+
+
+def selected(job, label_selector=None, field_selector=None):
+    # Whether a job (or pod), as the API returns it, matches the selectors,
+    # where the API server isn't there to do it (see sk8s.backends). Only equality selectors, and a single `key in (a,b)`, which is all sk8s uses.
+    labels = job["metadata"].get("labels") or {}
+    set_based = re.fullmatch(r"\s*(\S+)\s+in\s+\((.*)\)\s*", label_selector or "")
+    if set_based is not None:
+        key, values = set_based.group(1), [v.strip() for v in set_based.group(2).split(",")]
+        if labels.get(key) not in values:
+            return False
+        label_selector = None
+    for term in filter(None, (label_selector or "").split(",")):
+        key, value = term.split("=", 1)
+        if labels.get(key) != value:
+            return False
+    for term in filter(None, (field_selector or "").split(",")):
+        key, value = term.split("=", 1)
+        if key == "metadata.name" and job["metadata"]["name"] != value:
+            return False
+        if key == "metadata.namespace" and job["metadata"].get("namespace") != value:
+            return False
+    return True
+
+
+class JobTable:
+    def __init__(self, namespace=None, label_selector=None, field_selector=None, api=None):
+        if namespace is None:
+            namespace = sk8s.util.get_current_namespace()
+        if api is None:
+            api = sk8s.kube.batch_api()
+        self.namespace = namespace
+        self.label_selector = label_selector
+        self.field_selector = field_selector
+        self.api = api
+        self.statuses = dict()
+        self.resource_version = None
+        # Names of the jobs whose status changed (or that appeared or went
+        # away) since the caller last cleared this.
+        self.changed = set()
+
+    def selectors(self):
+        selectors = dict()
+        if self.label_selector is not None:
+            selectors["label_selector"] = self.label_selector
+        if self.field_selector is not None:
+            selectors["field_selector"] = self.field_selector
+        return selectors
+
+    def sync(self):
+        response = self.api.list_namespaced_job(namespace=self.namespace, _preload_content=False, **self.selectors())
+        jobs = json.loads(response.data)
+        self.changed.update(self.statuses)
+        self.statuses = {job["metadata"]["name"]: job_status(job) for job in jobs["items"]}
+        self.changed.update(self.statuses)
+        self.resource_version = jobs["metadata"]["resourceVersion"]
+        return self
+
+    def update(self, event):
+        job = event["raw_object"]
+        self.resource_version = job["metadata"].get("resourceVersion", self.resource_version)
+        if event["type"] == "BOOKMARK":
+            return
+        name = job["metadata"]["name"]
+        self.changed.add(name)
+        if event["type"] == "DELETED":
+            self.statuses.pop(name, None)
+        else:
+            self.statuses[name] = job_status(job)
+
+    def until(self, condition, timeout=None):
+        # Blocks until condition(self.statuses) is true, updating the table as
+        # events arrive. Returns False if the timeout expires first.
+        if self.resource_version is None:
+            self.sync()
+
+        start_time = time.time()
+        while not condition(self.statuses):
+            seconds = max_watch_seconds
+            if timeout is not None:
+                remaining = timeout - (time.time() - start_time)
+                if remaining <= 0:
+                    return False
+                seconds = min(seconds, math.ceil(remaining))
+
+            stream = watch.Watch()
+            try:
+                for event in stream.stream(self.api.list_namespaced_job,
+                                           namespace=self.namespace,
+                                           resource_version=self.resource_version,
+                                           allow_watch_bookmarks=True,
+                                           timeout_seconds=seconds,
+                                           **self.selectors()):
+                    self.update(event)
+                    if condition(self.statuses):
+                        stream.stop()
+                        break
+            except ApiException as e:
+                if e.status != 410:
+                    raise
+                # Our resourceVersion is too old to resume from; start over from a fresh list.
+                self.sync()
+
+        return True
+
+
+class LocalJobTable(JobTable):
+    # A JobTable of the local backend's jobs (see sk8s.backends), kept current
+    # by the backend rather than by a watch.
+    def __init__(self, backend, label_selector=None, field_selector=None):
+        super().__init__(backend.namespace, label_selector=label_selector, field_selector=field_selector, api=backend)
+        self.backend = backend
+        with backend.condition:
+            backend.tables.add(self)
+
+    def sync(self):
+        with self.backend.condition:
+            self.changed.update(self.statuses)
+            self.statuses = {name: job_status(job) for name, job in self.backend.jobs.items()
+                             if selected(job, self.label_selector, self.field_selector)}
+            self.changed.update(self.statuses)
+            self.resource_version = 0
+        return self
+
+    def update(self, event):
+        if selected(event["raw_object"], self.label_selector, self.field_selector):
+            super().update(event)
+
+    def until(self, condition, timeout=None):
+        if self.resource_version is None:
+            self.sync()
+
+        start_time = time.time()
+        with self.backend.condition:
+            while not condition(self.statuses):
+                remaining = None
+                if timeout is not None:
+                    remaining = timeout - (time.time() - start_time)
+                    if remaining <= 0:
+                        return False
+                self.backend.condition.wait(remaining)
+        return True
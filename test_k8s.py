@@ -19,6 +19,113 @@ def test_serialization():
     assert(result == "hey")
 
 
+@pytest.mark.local
+def test_create_jobs_reports_per_job_errors():
+    import sk8s.kube
+    import sk8s.testing
+    config = dict(sk8s.configs.default_config, service_account_name="default")
+    job_info = [sk8s.run(lambda i=i: i, config=config, name=f"job-{i}", _map_helper=True) for i in range(20)]
+    with sk8s.testing.FakeKubeApiServer(reject=lambda name: 422 if name == "job-7" else None) as server:
+        api = sk8s.kube.client.BatchV1Api(server.api_client())
+        errors = sk8s.kube.create_jobs([spec for _, spec in job_info], namespace="default", api=api)
+        assert(list(errors.keys()) == ["job-7"])
+        assert(errors["job-7"].status == 422)
+        assert(len(server.jobs) == 19)
+
+
+@pytest.mark.local
+def test_throttled_submission(monkeypatch):
+    import sk8s.kube
+    import sk8s.testing
+    import sk8s.throttle
+    from kubernetes.client.rest import ApiException
+    config = dict(sk8s.configs.default_config, service_account_name="default")
+    job_info = [sk8s.run(lambda i=i: i, config=config, name=f"job-{i}", _map_helper=True) for i in range(60)]
+    with sk8s.testing.FakeKubeApiServer(fault=sk8s.testing.rate_limit(100, 10)) as server:
+        api = sk8s.kube.client.BatchV1Api(server.api_client())
+        submitter = sk8s.throttle.Submitter(qps=0, concurrency=16)
+        errors = sk8s.kube.create_jobs([spec for _, spec in job_info], namespace="default", api=api, submitter=submitter)
+        assert(errors == {})
+        assert(len(server.jobs) == 60)
+        stats = submitter.snapshot()
+        assert(stats["accepted"] == 60 and stats["failed"] == 0)
+        assert(stats["throttled"] > 0 and stats["submitted"] == 60 + stats["retried"])
+        assert(stats["concurrency"] < 16)
+
+    # A create that timed out may have gone through; finding it there on retry is success.
+    attempts = []
+    def create():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise TimeoutError()
+        raise ApiException(status=409)
+    submitter = sk8s.throttle.Submitter(qps=0)
+    monkeypatch.setattr(sk8s.throttle, "backoff_seconds", 0.01)
+    assert(submitter.call(create) is None)
+    assert(submitter.call(lambda: (_ for _ in ()).throw(ApiException(status=409))).status == 409)
+    assert(submitter.snapshot()["accepted"] == 1)
+
+
+@pytest.mark.local
+def test_job_table_watch():
+    import threading
+    import time
+    import sk8s.kube
+    import sk8s.testing
+    import sk8s.watch
+    config = dict(sk8s.configs.default_config, service_account_name="default")
+    job_info = [sk8s.run(lambda i=i: i, config=config, name=f"job-{i}", _map_helper=True) for i in range(5)]
+    job_info[0][1]["metadata"]["labels"] = {"mine": "yes"}
+    jobs = [job for job, _ in job_info]
+    with sk8s.testing.FakeKubeApiServer() as server:
+        api = sk8s.kube.client.BatchV1Api(server.api_client())
+        sk8s.kube.create_jobs([spec for _, spec in job_info], namespace="default", api=api)
+
+        table = sk8s.watch.JobTable("default", api=api).sync()
+        all_finished = lambda statuses: all(statuses[job]["finished"] for job in jobs)
+        assert(not table.until(all_finished, timeout=1))
+
+        def finish():
+            for job in jobs:
+                time.sleep(0.05)
+                server.api.complete_job("default", job)
+        threading.Thread(target=finish).start()
+
+        start = time.time()
+        assert(table.until(all_finished, timeout=10))
+        assert(time.time() - start < 2)
+        assert(all(table.statuses[job]["succeeded"] == 1 for job in jobs))
+
+        mine = sk8s.watch.JobTable("default", label_selector="mine=yes", api=api).sync()
+        assert(list(mine.statuses) == ["job-0"])
+
+
+@pytest.mark.local
+def test_run_labels():
+    import dill
+    import yaml
+    import sk8s.kube
+    import sk8s.testing
+    import sk8s.watch
+    config = dict(sk8s.configs.default_config, service_account_name="default")
+    job_info = [sk8s.run(lambda i=i: i, config=config, run_id=run_id, task_index=i, _map_helper=True)
+                for run_id in ("runa", "runb", "runc") for i in range(3)]
+    jobs = [job for job, _ in job_info]
+    assert(jobs[0].run_id == "runa")
+    assert(dill.loads(dill.dumps(jobs[0])).run_id == "runa")
+    assert(job_info[4][1]["spec"]["template"]["metadata"]["labels"] == {"sk8s/run": "runb", "sk8s/task-index": "1"})
+
+    assert(sk8s.run_selector(jobs[:3]) == "sk8s/run=runa")
+    assert(sk8s.run_selector(jobs[:6]) == "sk8s/run in (runa,runb)")
+    assert(sk8s.run_selector(jobs[:3] + ["some-other-job"]) is None)
+
+    with sk8s.testing.FakeKubeApiServer() as server:
+        api = sk8s.kube.client.BatchV1Api(server.api_client())
+        sk8s.kube.create_jobs([spec for _, spec in job_info], namespace="default", api=api)
+        table = sk8s.watch.JobTable("default", label_selector=sk8s.run_selector(jobs[3:]), api=api).sync()
+        assert(sorted(table.statuses) == sorted(jobs[3:]))
+
+
 @pytest.mark.jobs
 def test_run_and_wait_1():
     result = sk8s.wait(sk8s.run(lambda: "Hooray"), timeout=500)
@@ -55,6 +162,863 @@ def test_starmap():
     assert(tuple(results) == (0,2,4))
 
 
+@pytest.mark.jobs
+def test_indexed_map():
+    results = sk8s.map(lambda i: i*2, range(10), mode="indexed", parallelism=4)
+    assert(tuple(results) == tuple([i*2 for i in range(10)]))
+
+    results = sk8s.starmap(lambda i,j: i+j, [(a,a) for a in range(3)], mode="indexed")
+    assert(tuple(results) == (0,2,4))
+
+
+@pytest.mark.jobs
+def test_imap():
+    import itertools
+    results = list(sk8s.imap(lambda i: i*2, range(10), max_in_flight=3))
+    assert(tuple(results) == tuple([i*2 for i in range(10)]))
+
+    results = sorted(sk8s.imap_unordered(lambda i: i*2, range(10), max_in_flight=3))
+    assert(tuple(results) == tuple([i*2 for i in range(10)]))
+
+    # Only as much of an endless iterable as we ask for:
+    results = list(itertools.islice(sk8s.imap(lambda i: i*2, itertools.count(), max_in_flight=3), 4))
+    assert(tuple(results) == (0,2,4,6))
+
+
+@pytest.mark.local
+def test_indexed_job_spec():
+    import yaml
+    config = dict(sk8s.configs.default_config, service_account_name="default")
+    spec = yaml.safe_load(sk8s.run_indexed(lambda i: i, [(i,) for i in range(5)], parallelism=2, dryrun=True, config=config))
+    assert(spec["spec"]["completionMode"] == "Indexed")
+    assert(spec["spec"]["completions"] == 5)
+    assert(spec["spec"]["parallelism"] == 2)
+
+
+@pytest.mark.local
+def test_payload_shipped_once(tmp_path, monkeypatch):
+    import yaml
+    import sk8s.payloads
+    config = dict(sk8s.configs.default_config, service_account_name="default")
+    big = list(range(10000))
+    payload = sk8s.payloads.ship(lambda i, j=1: big[i] * j, dryrun=True)
+    assert(payload.name == f"sk8s-payload-{payload.digest}")
+
+    spec = yaml.safe_load(sk8s.run(payload, 7, 3, config=config, dryrun=True))
+    assert(spec["metadata"]["labels"][sk8s.payloads.payload_label] == payload.digest)
+    assert(len(spec["spec"]["template"]["spec"]["containers"][0]["command"][2]) < len(payload.code))
+
+    # What the pod does, with the ConfigMap "mounted" at payload_path:
+    payload_path = tmp_path / "payload"
+    payload_path.write_bytes(payload.data)
+    assert(sk8s.payloads.load_task(sk8s.serialize_func((7, 3)), path=payload_path)() == 21)
+
+    monkeypatch.setenv("JOB_COMPLETION_INDEX", "1")
+    assert(sk8s.payloads.load_task(sk8s.serialize_func(((1,), (2,))), path=payload_path)() == 2)
+
+
+@pytest.mark.local
+def test_oversized_payloads(tmp_path, monkeypatch):
+    import os
+    import yaml
+    import sk8s.kube
+    import sk8s.payloads
+    import sk8s.runner
+    config = dict(sk8s.configs.default_config, service_account_name="default")
+
+    # A closure over a dataset goes in a payload, not the job spec.
+    data = list(range(100000))
+    spec = yaml.safe_load(sk8s.run(lambda: sum(data), config=config, dryrun=True))
+    assert(len(spec["spec"]["template"]["spec"]["containers"][0]["command"][2]) < sk8s.payloads.max_inline_bytes)
+    assert(sk8s.payloads.payload_label in spec["metadata"]["labels"])
+
+    # Too big for a ConfigMap, even compressed: it needs a result store.
+    noise = os.urandom(sk8s.payloads.max_configmap_bytes + 1)
+    with pytest.raises(ValueError):
+        sk8s.run(lambda: len(noise), config=config, dryrun=True)
+    monkeypatch.setattr(sk8s.runner, "volume_mount_dir", str(tmp_path))
+    config = dict(config, result_volume="shared")
+    payload = sk8s.payloads.ship(lambda i: len(noise) + i, config=config)
+    assert(payload.url == f"file://{tmp_path}/shared/sk8s-results/sk8s-payloads/{payload.digest}")
+    spec = yaml.safe_load(sk8s.run(payload, 1, config=config, dryrun=True))
+    assert(dict(name=sk8s.payloads.payload_url_env, value=payload.url) in spec["spec"]["template"]["spec"]["containers"][0]["env"])
+
+    # What the pod does:
+    monkeypatch.setenv(sk8s.payloads.payload_url_env, payload.url)
+    assert(sk8s.payloads.load_task(sk8s.serialize_func((1,)))() == len(noise) + 1)
+
+    # Test mode runs it here, without shipping anything.
+    def no_calls(*args, **kwargs):
+        raise AssertionError("test mode touched the cluster or result store")
+    monkeypatch.setattr(sk8s.payloads, "put", no_calls)
+    monkeypatch.setattr(sk8s.kube, "core_api", no_calls)
+    monkeypatch.setattr(sk8s.kube, "batch_api", no_calls)
+    assert(sk8s.run(lambda: len(noise), config=config, test=True) == len(noise))
+    assert(sk8s.run(lambda: sum(data), config=config, test=True) == sum(data))
+
+    # Chunks are packed by size.
+    chunks = sk8s.jobs.pack_chunks([(b"x" * 1000,)] * 100, size=None, max_bytes=10000)
+    assert(all(sum(len(args) for args in chunk) <= 10000 for chunk in chunks))
+    assert(sum(len(chunk) for chunk in chunks) == 100 and len(chunks) < 15)
+    assert([len(chunk) for chunk in sk8s.jobs.pack_chunks([(i,) for i in range(10)], size=4)] == [4, 4, 2])
+    assert(sk8s.runner.run_chunk(lambda a, b: a + b, sk8s.jobs.pack_chunks([(1, 2), (3, 4)])[0]) == [3, 7])
+
+
+@pytest.mark.local
+def test_cold_start(tmp_path):
+    import os
+    import subprocess
+    import sys
+    import yaml
+    heavy = ["kubernetes", "pandas", "yaml", "jinja2", "kafka"]
+    check = f"import sys; sys.stderr.write(' '.join(m for m in {heavy!r} if m in sys.modules))"
+
+    # import sk8s loads the API as it's used.
+    imported = subprocess.run([sys.executable, "-c", "import sk8s; " + check], capture_output=True, text=True, check=True).stderr
+    assert(imported == "")
+    # Names it doesn't export (as IPython looks for) don't import anything either.
+    probe = "import sk8s\nfor name in ['_repr_html_', '_ipython_display_', 'no_such_name']:\n    assert not hasattr(sk8s, name)\n"
+    imported = subprocess.run([sys.executable, "-c", probe + check], capture_output=True, text=True, check=True).stderr
+    assert(imported == "")
+
+    # A job runs its task with none of them, and without writing its config to disk.
+    config = dict(sk8s.configs.default_config, service_account_name="default")
+    spec = yaml.safe_load(sk8s.run(max, 3, 42, config=config, dryrun=True))
+    bootstrap = spec["spec"]["template"]["spec"]["containers"][0]["command"][2]
+    env = dict(os.environ, HOME=str(tmp_path))
+    job = subprocess.run([sys.executable, "-c", bootstrap + "\n" + check], capture_output=True, text=True, check=True, env=env)
+    assert(job.stdout == "42")
+    assert(job.stderr == "")
+    assert(not (tmp_path / ".sk8s").exists())
+
+
+@pytest.mark.local
+def test_session_caching(tmp_path):
+    import os
+    import sk8s.kube
+    import sk8s.testing
+    with sk8s.testing.FakeKubeApiServer() as server:
+        server.write_kubeconfig(str(tmp_path / "kubeconfig"), namespace="first")
+        sk8s.configs.save_config(dict(sk8s.configs.default_config, service_account_name="first"), str(tmp_path / "config.json"))
+
+        session = sk8s.Session(kubeconfig=str(tmp_path / "kubeconfig"), config_file=str(tmp_path / "config.json"))
+        client = session.api_client
+        config = session.config
+        assert(session.namespace == "first")
+        assert(session.api_client is client)
+        assert(session.config is config)
+        closed = []
+        close = client.close
+        client.close = lambda: (closed.append(True), close())
+
+        with session:
+            assert(sk8s.get_session() is session)
+            assert(sk8s.get_current_namespace() == "first")
+            assert(sk8s.kube.api_client() is client)
+            sk8s.run(lambda: 1, config=dict(config, service_account_name="default"), name="job-1")
+            assert(("first", "job-1") in server.jobs)
+        assert(sk8s.get_session() is not session)
+
+        # Changing either file on disk is noticed on the next call.
+        server.write_kubeconfig(str(tmp_path / "kubeconfig"), namespace="second")
+        os.utime(tmp_path / "kubeconfig", ns=(0, 0))
+        sk8s.configs.save_config(dict(sk8s.configs.default_config, service_account_name="second"), str(tmp_path / "config.json"))
+        os.utime(tmp_path / "config.json", ns=(0, 0))
+        assert(session.namespace == "second")
+        assert(session.api_client is not client)
+        assert(closed == [True])
+        assert(session.config["service_account_name"] == "second")
+
+
+@pytest.mark.local
+def test_results_fetched_as_jobs_finish(tmp_path, monkeypatch):
+    import threading
+    import time
+    import sk8s.results
+    import sk8s.testing
+    monkeypatch.setattr(sk8s.results, "backoff_seconds", 0.01)
+
+    # Every log read fails twice before it works, as from an overloaded API server.
+    attempts = dict()
+    def fault(method, path):
+        if path.endswith("/log"):
+            attempts[path] = attempts.get(path, 0) + 1
+            return {1: 429, 2: 503}.get(attempts[path])
+
+    with sk8s.testing.FakeKubeApiServer(fault=fault) as server:
+        sk8s.configs.save_config(dict(sk8s.configs.default_config, service_account_name="default"), str(tmp_path / "config.json"))
+        with sk8s.Session(kubeconfig=server.write_kubeconfig(str(tmp_path / "kubeconfig")), config_file=str(tmp_path / "config.json")):
+            jobs = sk8s.map(lambda i: i, range(10), asynchro=True)
+            jobs += sk8s.run_indexed(lambda i: i, [(i,) for i in range(3)], asynchro=True)
+
+            last_finish = []
+            def finish():
+                for i, job in enumerate(jobs[:10]):
+                    time.sleep(0.05)
+                    server.api.complete_job("default", job, results=[i * 10])
+                last_finish.append(time.time())
+                server.api.complete_job("default", jobs[10], results=[0, 1, 2])
+            threading.Thread(target=finish).start()
+
+            results = sk8s.wait(jobs, timeout=30, delete=False)
+
+    assert(results == [i * 10 for i in range(10)] + [[0, 1, 2]])
+    assert(all(n == 3 for n in attempts.values()))
+    # Most of the fetching happened while jobs were still running.
+    log_reads = [t for t, method, path in server.api.history if path.endswith("/log")]
+    assert(sum(t < last_finish[0] for t in log_reads) >= 20)
+
+
+@pytest.mark.local
+def test_indexed_job_missing_pod(tmp_path):
+    import sk8s.testing
+    with sk8s.testing.FakeKubeApiServer() as server:
+        sk8s.configs.save_config(dict(sk8s.configs.default_config, service_account_name="default"), str(tmp_path / "config.json"))
+        with sk8s.Session(kubeconfig=server.write_kubeconfig(str(tmp_path / "kubeconfig")), config_file=str(tmp_path / "config.json")):
+            job, = sk8s.run_indexed(lambda i: i, [(i,) for i in range(4)], asynchro=True)
+            server.api.complete_job("default", job, results=[0, 1, 2, 3])
+            # The pods for indexes 1 and 3 are gone, as if evicted and garbage-collected.
+            with server.api.lock:
+                for key in [key for key, pod in server.api.pods.items()
+                            if pod["metadata"]["annotations"]["batch.kubernetes.io/job-completion-index"] in ("1", "3")]:
+                    del server.api.pods[key]
+            with pytest.raises(RuntimeError, match="completion indexes 1, 3"):
+                sk8s.jobs.get_completed_pod_from_jobs([job], "default", completions={job: 4})
+            with pytest.raises(RuntimeError, match="completion indexes 1, 3"):
+                sk8s.wait(job, timeout=30, delete=False)
+
+
+@pytest.mark.local
+def test_background_cleanup(tmp_path):
+    import yaml
+    import sk8s.reaper
+    import sk8s.testing
+    config = dict(sk8s.configs.default_config, service_account_name="default")
+    spec = yaml.safe_load(sk8s.run(lambda: 1, config=config, ttlSecondsAfterFinished=600, dryrun=True))
+    assert(spec["spec"]["ttlSecondsAfterFinished"] == 600)
+    spec = yaml.safe_load(sk8s.run(lambda: 1, config=dict(config, job_ttl_seconds=60), dryrun=True))
+    assert(spec["spec"]["ttlSecondsAfterFinished"] == 60)
+
+    with sk8s.testing.FakeKubeApiServer() as server:
+        sk8s.configs.save_config(config, str(tmp_path / "config.json"))
+        with sk8s.Session(kubeconfig=server.write_kubeconfig(str(tmp_path / "kubeconfig")), config_file=str(tmp_path / "config.json")):
+            jobs = sk8s.map(lambda i: i, range(50), asynchro=True)
+            for i, job in enumerate(jobs):
+                server.api.complete_job("default", job, results=[i])
+            assert(sk8s.wait(jobs, timeout=10) == list(range(50)))
+            assert(sk8s.reaper.flush(timeout=10))
+            # The whole run, its pods and its payload, in one request each.
+            assert(len(server.jobs) == 0 and len(server.api.pods) == 0 and len(server.api.configmaps) == 0)
+            deletes = [path for t, method, path in server.api.history if method == "DELETE"]
+            assert(len([path for path in deletes if path.endswith("/jobs")]) == 1)
+
+            # Part of a run goes job by job; a job that's already gone (its TTL ran out, say) is fine.
+            jobs = sk8s.map(lambda i: i, range(4), asynchro=True)
+            for i, job in enumerate(jobs):
+                server.api.complete_job("default", job, results=[i])
+            assert(sk8s.wait(jobs[:2], timeout=10, delete=False) == [0, 1])
+            with server.api.lock:
+                server.api.delete_job("default", jobs[0])
+            sk8s.delete_jobs(jobs[:2])
+            assert(sorted(name for _, name in server.jobs) == sorted(jobs[2:]))
+
+            # Not allowed deletecollection, whole runs go job by job too.
+            server.api.fault = lambda method, path: 403 if (method == "DELETE") and path.endswith("/jobs") else None
+            jobs = sk8s.map(lambda i: i, range(3), asynchro=True)
+            for i, job in enumerate(jobs):
+                server.api.complete_job("default", job, results=[i])
+            assert(sk8s.wait(jobs, timeout=10) == [0, 1, 2])
+            assert(sk8s.reaper.flush(timeout=10))
+            assert(not any(name in jobs for _, name in server.jobs))
+
+
+@pytest.mark.local
+def test_job_futures(tmp_path):
+    import concurrent.futures
+    import threading
+    import sk8s.reaper
+    import sk8s.testing
+    with sk8s.testing.FakeKubeApiServer() as server:
+        sk8s.configs.save_config(dict(sk8s.configs.default_config, service_account_name="default"), str(tmp_path / "config.json"))
+        with sk8s.Session(kubeconfig=server.write_kubeconfig(str(tmp_path / "kubeconfig")), config_file=str(tmp_path / "config.json")):
+            futures = [sk8s.submit(lambda i=i: i) for i in range(20)]
+            assert(not any(future.done() for future in futures))
+            assert(futures[19].cancel())
+            called = []
+            futures[0].add_done_callback(lambda future: called.append(future.result()))
+
+            def finish():
+                for i, future in enumerate(futures[:19]):
+                    server.api.complete_job("default", future.job, failed=(i == 18), results=[i * 10])
+            threading.Thread(target=finish).start()
+
+            done = list(sk8s.as_completed(futures, timeout=10))
+            assert(sorted(future.job for future in done) == sorted(future.job for future in futures))
+            assert([future.result() for future in futures[:18]] == [i * 10 for i in range(18)])
+            with pytest.raises(RuntimeError):
+                futures[18].result()
+            with pytest.raises(concurrent.futures.CancelledError):
+                futures[19].result()
+            assert(called == [0])
+
+            # One watch for all of them, not one per future.
+            assert(len([path for t, method, path in server.api.history if method == "GET" and path.endswith("/jobs")]) <= 3)
+            # Succeeded and cancelled jobs are deleted; the failed one is kept.
+            assert(sk8s.reaper.flush(timeout=10))
+            assert([name for _, name in server.jobs] == [futures[18].job])
+            futures[0].watcher.close()
+
+            # Each with the config it was submitted with.
+            config = dict(sk8s.configs.default_config, service_account_name="default")
+            a = sk8s.submit(max, 1, 2, config=config)
+            b = sk8s.submit(max, 1, 2, config=dict(config, docker_image_prefix="other/"))
+            images = {name: job["spec"]["template"]["spec"]["containers"][0]["image"] for (_, name), job in server.jobs.items()}
+            assert(images[a.job] == config["docker_image_prefix"] + "jobs")
+            assert(images[b.job] == "other/jobs")
+            assert(a.watcher is not b.watcher)
+            assert(sk8s.futures.get_watcher(dict(config)) is a.watcher)
+            a.watcher.close()
+            b.watcher.close()
+
+    with sk8s.LocalBackend(max_workers=2):
+        config = dict(sk8s.configs.default_config, service_account_name="default")
+        futures = [sk8s.submit(lambda i=i: i * i, config=config) for i in range(5)]
+        assert(sorted(future.result(timeout=30) for future in sk8s.as_completed(futures)) == [0, 1, 4, 9, 16])
+
+
+@pytest.mark.local
+def test_aio(tmp_path):
+    import asyncio
+    import itertools
+    import threading
+    import time
+    import sk8s.aio
+    import sk8s.futures
+    import sk8s.reaper
+    import sk8s.testing
+    config = dict(sk8s.configs.default_config, service_account_name="default")
+
+    async def main():
+        ticks = []
+        async def tick():
+            while True:
+                ticks.append(time.time())
+                await asyncio.sleep(0.01)
+        ticker = asyncio.create_task(tick())
+
+        assert(await sk8s.aio.run(lambda: "hi", config=config) == "hi")
+        assert(await sk8s.aio.map(lambda i: i * 2, range(10), config=config) == [i * 2 for i in range(10)])
+        assert(await sk8s.aio.starmap(lambda a, b: a + b, [(1, 2), (3, 4)], config=config) == [3, 7])
+        assert([x async for x in sk8s.aio.imap(lambda i: i, range(5), config=config)] == list(range(5)))
+        assert(sorted([x async for x in sk8s.aio.imap(lambda i: i, range(5), ordered=False, config=config)]) == list(range(5)))
+        # Only as much of an endless iterable as we ask for:
+        results = sk8s.aio.imap(lambda i: i * 2, itertools.count(), max_in_flight=3, config=config)
+        assert([await results.__anext__() for _ in range(4)] == [0, 2, 4, 6])
+        await results.aclose()
+        # Jobs still running when the caller gives up waiting are cancelled, the one it waited on included.
+        results = sk8s.aio.imap(time.sleep, [1, 1], config=config)
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(results.__anext__(), 0.2)
+        # A job failing leaves the others running.
+        jobs = [await sk8s.aio.submit(lambda: 1 / 0, config=config), await sk8s.aio.submit(time.sleep, 0.3, config=config)]
+        with pytest.raises(RuntimeError):
+            await sk8s.aio.wait(jobs)
+        assert(await jobs[1] is None)
+        # The loop keeps running while the jobs do.
+        before = len(ticks)
+        await sk8s.aio.run(time.sleep, 0.5, config=config)
+        assert(len(ticks) - before > 10)
+
+        # A job that runs too long is cancelled, and deleted.
+        with pytest.raises(asyncio.TimeoutError):
+            await sk8s.aio.run(time.sleep, 3, timeout=0.5, config=config)
+        ticker.cancel()
+
+    with sk8s.LocalBackend(max_workers=2) as backend:
+        asyncio.run(main())
+        # All deleted but the failed job, which is kept to look into.
+        assert(len(backend.jobs) == 1)
+
+    # Many outstanding jobs, on a handful of threads.
+    with sk8s.testing.FakeKubeApiServer() as server:
+        sk8s.configs.save_config(dict(config, submit_qps=0), str(tmp_path / "config.json"))
+        with sk8s.Session(kubeconfig=server.write_kubeconfig(str(tmp_path / "kubeconfig")), config_file=str(tmp_path / "config.json")):
+            async def many():
+                futures = await sk8s.aio.submit_map(lambda: None, [()] * 1000)
+                threads = threading.active_count()
+                def finish():
+                    for _, job in list(server.jobs):
+                        server.api.complete_job("default", job)
+                threading.Thread(target=finish).start()
+                assert(await sk8s.aio.wait(futures, timeout=60) == [None] * 1000)
+                assert(sk8s.reaper.flush(timeout=30))
+                sk8s.futures.get_watcher().close()
+                return threads
+            assert(asyncio.run(many()) < 150)
+
+
+@pytest.mark.local
+def test_dag(tmp_path):
+    import time
+    import sk8s.reaper
+    import sk8s.testing
+    config = dict(sk8s.configs.default_config, service_account_name="default")
+
+    with sk8s.LocalBackend(max_workers=2) as backend:
+        a = sk8s.submit(lambda: 1, config=config)
+        b = sk8s.submit(lambda: 2, config=config)
+        named = sk8s.run(lambda: 10, config=config)
+        c = sk8s.run(lambda inputs: list(inputs.values()), deps=[a, b], config=config)
+        d = sk8s.run(lambda x, inputs: x + sum(list(inputs.values())[0]) + inputs[named], 100, deps=[c, named], config=config)
+        assert(sk8s.wait(d, timeout=30) == 113)
+        assert(c.result() == [1, 2])
+        assert(sk8s.wait([c, d], timeout=30) == [[1, 2], 113])
+        # A job named as a dependency is the caller's to delete.
+        assert(named in backend.jobs)
+        sk8s.delete_jobs([named], config=config)
+        assert(named not in backend.jobs)
+        # Modules the task uses but doesn't import itself.
+        assert(sk8s.run(lambda: str(fractions.Fraction(2, 4)), imports=["fractions"], asynchro=False, config=config) == "1/2")
+        # A failure stops everything downstream of it.
+        bad = sk8s.submit(lambda: 1 / 0, config=config)
+        after = sk8s.run(lambda inputs: 0, deps=bad, config=config)
+        last = sk8s.run(lambda inputs: 0, deps=[after, a], config=config)
+        with pytest.raises(RuntimeError):
+            last.result(timeout=30)
+        assert(after.job is None)
+
+    # Each task starts as soon as its own inputs are ready, not when its stage is.
+    with sk8s.testing.FakeKubeApiServer() as server:
+        sk8s.configs.save_config(config, str(tmp_path / "config.json"))
+        with sk8s.Session(kubeconfig=server.write_kubeconfig(str(tmp_path / "kubeconfig")), config_file=str(tmp_path / "config.json")):
+            a, b = sk8s.submit(lambda: 1), sk8s.submit(lambda: 2)
+            c = sk8s.run(lambda inputs: 3, deps=a)
+            d = sk8s.run(lambda inputs: 4, deps=[a, b])
+
+            def started(task):
+                deadline = time.time() + 10
+                while (task.job is None) and (time.time() < deadline):
+                    time.sleep(0.01)
+                return task.job is not None
+
+            server.api.complete_job("default", a.job, results=[1])
+            assert(started(c))
+            assert(d.job is None)
+            server.api.complete_job("default", b.job, results=[2])
+            assert(started(d))
+            server.api.complete_job("default", c.job, results=[3])
+            server.api.complete_job("default", d.job, results=[4])
+            assert(sk8s.wait([c, d], timeout=10) == [3, 4])
+            assert(sk8s.reaper.flush(timeout=10))
+            a.watcher.close()
+
+
+@pytest.mark.local
+def test_result_refs(tmp_path):
+    import dill
+    config = dict(sk8s.configs.default_config, service_account_name="default")
+    with sk8s.LocalBackend(max_workers=2):
+        upstream = sk8s.run(lambda: list(range(1000)), config=config)
+        with pytest.raises(ValueError):
+            sk8s.ref(upstream, config=config)
+
+        config["result_obs_prefix"] = f"file://{tmp_path}/results/"
+        upstream = sk8s.run(lambda: list(range(1000)), config=config)
+        ref = sk8s.ref(upstream, config=config)
+        # The job gets the reference, not the result.
+        assert(len(dill.dumps(ref)) < 200 and "sk8s.jobs" not in str(dill.dumps(ref)))
+        total = sk8s.run(lambda xs: sum(xs), ref, config=config)
+        assert(sk8s.wait(total, timeout=30) == 499500)
+        # The upstream job is left for the caller, as any job from run() is.
+        assert(sk8s.wait(upstream, timeout=30, delete=False, sk8s_config=config) == list(range(1000)))
+
+        # Futures are passed as they are, and references can be inside other arguments.
+        future = sk8s.submit(lambda: 10, config=config)
+        jobs = sk8s.map_arglists(lambda x, d: x + sum(d["y"]), [(future, {"y": [1, 2]}), (5, {"y": ref}), (1, {"y": [1]})], asynchro=True, config=config)
+        assert(sk8s.wait(jobs, timeout=30, sk8s_config=config) == [13, 499505, 2])
+
+        # A job that refers to a failed job's result isn't run.
+        bad = sk8s.run(lambda: 1 / 0, config=config)
+        after = sk8s.run(lambda x: x, sk8s.ref(bad, config=config), config=config)
+        with pytest.raises(RuntimeError):
+            after.result(timeout=30)
+        assert(after.job is None)
+
+
+@pytest.mark.local
+def test_binary_results(tmp_path, monkeypatch):
+    import contextlib
+    import io
+    import numpy as np
+    import pandas as pd
+    import sk8s.encoding
+    import sk8s.results
+    import sk8s.testing
+
+    result = dict(array=np.arange(100000, dtype=np.float32).reshape(1000, 100),
+                  frame=pd.DataFrame(dict(x=np.arange(10.0), y=list("abcdefghij"))),
+                  func=lambda x: x + 1)
+    for compression in (None, "zlib"):
+        data = sk8s.encoding.dumps(result, compression=compression)
+        decoded = sk8s.encoding.loads(bytearray(data))
+        assert((decoded["array"] == result["array"]).all())
+        assert(decoded["frame"].equals(result["frame"]))
+        assert(decoded["func"](1) == 2)
+    # Arrays are views of the fetched bytes, not copies.
+    data = bytearray(sk8s.encoding.dumps(result))
+    assert(np.shares_memory(sk8s.encoding.loads(data)["array"], np.frombuffer(data, dtype=np.uint8)))
+
+    with pytest.raises(ValueError):
+        sk8s.run(lambda: 1, config=dict(sk8s.configs.default_config, service_account_name="default", result_compression="rar"), dryrun=True)
+
+    # Through a pod log, without a result store:
+    config = dict(sk8s.configs.default_config, service_account_name="default", result_encoding="pickle", result_compression="zlib")
+    with sk8s.testing.FakeKubeApiServer() as server:
+        sk8s.configs.save_config(config, str(tmp_path / "config.json"))
+        with sk8s.Session(kubeconfig=server.write_kubeconfig(str(tmp_path / "kubeconfig")), config_file=str(tmp_path / "config.json")):
+            job = sk8s.run(lambda: None)
+            log = io.StringIO()
+            with contextlib.redirect_stdout(log):
+                sk8s.results.save_result(job, result, config)
+            server.api.complete_job("default", job, logs=[log.getvalue()])
+            # Decoded as it's read, in chunks that split base64 groups.
+            monkeypatch.setattr(sk8s.results, "read_chunk_size", 1001)
+            fetched = sk8s.wait(job, timeout=10, delete=False)
+    assert((fetched["array"] == result["array"]).all())
+    assert(fetched["array"].flags.writeable)
+
+
+@pytest.mark.local
+def test_file_result_store(tmp_path):
+    import sk8s.results
+    import sk8s.store
+    import sk8s.testing
+    prefix = f"file://{tmp_path}/results/"
+    sk8s.store.put(prefix + "a/x.json", b"1")
+    assert(bytes(sk8s.store.get(prefix + "a/x.json")) == b"1")
+    assert(list(sk8s.store.list_objects(prefix)) == [(prefix + "a/x.json", 1)])
+
+    for encoding in ("json", "pickle"):
+        config = dict(sk8s.configs.default_config, service_account_name="default", result_obs_prefix=prefix, result_encoding=encoding)
+        with sk8s.testing.FakeKubeApiServer() as server:
+            sk8s.configs.save_config(config, str(tmp_path / "config.json"))
+            with sk8s.Session(kubeconfig=server.write_kubeconfig(str(tmp_path / "kubeconfig")), config_file=str(tmp_path / "config.json")):
+                jobs = sk8s.map(lambda i: i, range(3), asynchro=True)
+                jobs += sk8s.run_indexed(lambda i: i, [(i,) for i in range(2)], asynchro=True)
+
+                # What the pods do. Their logs (from the fake) are empty.
+                for i, job in enumerate(jobs[:3]):
+                    sk8s.results.save_result(sk8s.results.result_key(job), i * 10, config)
+                    server.api.complete_job("default", job)
+                for i in range(2):
+                    sk8s.results.save_result(sk8s.results.result_key(jobs[3], i), [i], config)
+                server.api.complete_job("default", jobs[3])
+
+                assert(sk8s.wait(jobs, timeout=10, delete=False) == [0, 10, 20, [[0], [1]]])
+                # Finding the Indexed job's results by listing the run's results:
+                assert(sk8s.get_jobs_results(jobs, "default") == [0, 10, 20, [[0], [1]]])
+                # And with plain names, from the jobs' labels:
+                assert(sk8s.get_jobs_results([str(job) for job in jobs], "default") == [0, 10, 20, [[0], [1]]])
+
+
+@pytest.mark.local
+def test_volume_result_store(tmp_path, monkeypatch):
+    import numpy as np
+    import yaml
+    import sk8s.results
+    import sk8s.runner
+    import sk8s.testing
+    # Where the pods and the client would mount volumes.
+    monkeypatch.setattr(sk8s.runner, "volume_mount_dir", str(tmp_path))
+    config = dict(sk8s.configs.default_config, service_account_name="default", result_volume="shared", result_encoding="pickle")
+
+    spec = yaml.safe_load(sk8s.run(lambda: 1, config=config, dryrun=True))
+    assert(spec["spec"]["template"]["spec"]["volumes"] == [dict(name="shared", persistentVolumeClaim=dict(claimName="shared"))])
+    assert(spec["spec"]["template"]["spec"]["containers"][0]["volumeMounts"] == [dict(mountPath=f"{tmp_path}/shared", name="shared")])
+    with pytest.raises(ValueError):
+        sk8s.run(lambda: 1, config=config, volumes={"shared": "/elsewhere"}, dryrun=True)
+
+    with sk8s.testing.FakeKubeApiServer() as server:
+        sk8s.configs.save_config(config, str(tmp_path / "config.json"))
+        with sk8s.Session(kubeconfig=server.write_kubeconfig(str(tmp_path / "kubeconfig")), config_file=str(tmp_path / "config.json")):
+            # Not mounted here: binary results can't be collected.
+            with pytest.raises(RuntimeError):
+                sk8s.results.ResultCollector("default")
+            (tmp_path / "shared").mkdir()
+
+            job = sk8s.run(lambda: None)
+            # What the pod does. Its log (from the fake) is empty.
+            sk8s.results.save_result(sk8s.results.result_key(job), np.arange(1000.0), config)
+            assert((tmp_path / "shared" / "sk8s-results" / job.run_id / f"{job}.sk8s").exists())
+            server.api.complete_job("default", job)
+
+            result = sk8s.wait(job, timeout=10, delete=False)
+            assert((result == np.arange(1000.0)).all())
+            # Read from the file's memory map, and writable without touching the file.
+            result[0] = -1
+            # What a downstream job does with the upstream job's name.
+            assert(sk8s.results.load_result(job)[0] == 0)
+
+
+@pytest.mark.local
+def test_worker_pool():
+    import json
+    import time
+    import yaml
+    import sk8s.pools
+    import sk8s.services
+    import sk8s.testing
+
+    with sk8s.testing.local_pool(2, max_workers=4, tasks_per_worker=1, scale_down_seconds=0.5, autoscale_interval=0.1) as pool:
+        assert(list(pool.map(lambda x: x * x, range(50))) == [x * x for x in range(50)])
+        # The same pool, again, in chunks, and with submit.
+        assert(list(pool.map(lambda x, y: x + y, range(10), range(10), chunksize=3)) == [2 * x for x in range(10)])
+        assert(pool.submit(lambda x, y=0: x + y, 1, y=2).result() == 3)
+        with pytest.raises(ZeroDivisionError):
+            pool.submit(lambda: 1 / 0).result()
+
+        # Scaled up to the work queued, then back down once it's done.
+        futures = [pool.submit(time.sleep, 0.2) for _ in range(12)]
+        time.sleep(0.5)
+        assert(pool.workers == 4)
+        for future in futures:
+            future.result()
+        deadline = time.time() + 5
+        while (pool.workers > 1) and (time.time() < deadline):
+            time.sleep(0.1)
+        assert(pool.workers == 1)
+
+        # Tasks a map leaves unstarted are taken off the queue, not run.
+        results = pool.map(time.sleep, [0.2] * 20)
+        next(results)
+        results.close()
+        stats = json.loads(pool.queue.request("GET", "/stats")[1])
+        # (The autoscaler may have started more workers on them by then.)
+        assert(stats["pending"] == 0 and stats["running"] <= 4)
+
+        # Only the pool and its workers can use the queue.
+        with pytest.raises(RuntimeError, match="403"):
+            sk8s.pools.QueueClient(pool.url, "wrong").request("GET", "/stats")
+
+    # A task whose worker goes quiet goes to another worker.
+    queue = sk8s.pools.TaskQueue(lease_seconds=0.2)
+    queue.put_tasks([("client-0", "f", b"")])
+    assert(queue.take(0)[0] == "client-0")
+    assert(queue.take(0) is None)
+    time.sleep(0.3)
+    assert(queue.take(0)[0] == "client-0")
+    queue.finish("client-0", True, b"1")
+    queue.finish("client-0", True, b"2")
+    assert(queue.collect("client", 0) == [("client-0", True, b"1")])
+
+    # The workers' Deployment, without a Service.
+    config = dict(sk8s.configs.default_config, service_account_name="default")
+    workers = list(yaml.safe_load_all(sk8s.services.service(sk8s.pools.work, "http://q:5000", "token", name="p-workers", ports=[], expose=False,
+                                                             replicas=3, requests={"cpu": "1"}, namespace="default", config=config, dryrun=True)))
+    assert([w["kind"] for w in workers] == ["Deployment"])
+    assert(workers[0]["spec"]["replicas"] == 3)
+    assert(workers[0]["spec"]["template"]["spec"]["containers"][0]["resources"] == {"requests": {"cpu": "1"}})
+
+
+@pytest.mark.local
+def test_local_backend(tmp_path):
+    import numpy as np
+    import sk8s.backends
+    # No cluster: jobs run in local processes, through the same payloads, encoding and result store.
+    config = dict(sk8s.configs.default_config, service_account_name="default")
+    sk8s.configs.save_config(config, str(tmp_path / "config.json"))
+    with sk8s.Session(kubeconfig=str(tmp_path / "no-kubeconfig"), config_file=str(tmp_path / "config.json")):
+        with sk8s.LocalBackend(max_workers=2) as backend:
+            assert(sk8s.get_backend() is backend)
+            assert(sk8s.map(lambda x: x * x, range(10)) == [x * x for x in range(10)])
+            assert(sk8s.map(lambda x: x + 1, range(5), mode="indexed") == [1, 2, 3, 4, 5])
+            assert(list(sk8s.imap(lambda x: -x, range(7), max_in_flight=3)) == [-x for x in range(7)])
+            assert(sk8s.wait(sk8s.run(max, 3, 42)) == 42)
+            assert(sk8s.chunked_map(lambda x: x * 2, range(10), size=3) == [x * 2 for x in range(10)])
+            assert(sk8s.chunked_starmap(max, [(1, 2), (4, 3)], size=1, config=config) == [2, 4])
+            assert(sk8s.map(lambda x: x + 1, range(3), config=config) == [1, 2, 3])
+            assert(len(backend.jobs) == 0)
+            # Failed jobs are left for inspection, as in a cluster.
+            with pytest.raises(RuntimeError):
+                sk8s.map(lambda x: 1 / x, [1, 0])
+            assert(sk8s.get_job_statuses()["failed"].sum() == 1)
+            # Failed pods are retried up to the backoff limit.
+            marker = str(tmp_path / "tried")
+            def flaky(marker):
+                import os
+                if not os.path.exists(marker):
+                    open(marker, "w").close()
+                    raise RuntimeError("first try")
+                return "second try"
+            assert(sk8s.wait(sk8s.run(flaky, marker, backoffLimit=1)) == "second try")
+
+            binary = dict(config, result_encoding="pickle", result_obs_prefix=f"file://{tmp_path}/results/")
+            job = sk8s.run(np.arange, 5, config=binary)
+            assert((sk8s.wait(job, sk8s_config=binary) == np.arange(5)).all())
+        assert(sk8s.get_backend() is None)
+
+        # Or chosen in the config.
+        sk8s.configs.save_config(dict(config, backend="local", local_workers=1), str(tmp_path / "config.json"))
+        assert(sk8s.map(str, [1, 2]) == ["1", "2"])
+        assert(sk8s.get_backend() is sk8s.backends.get_backend(dict(backend="local", local_workers=1)))
+        with pytest.warns(DeprecationWarning, match="chunk_size"):
+            assert(sk8s.starmap(max, [(1, 2), (4, 3)], chunk_size=10) == [2, 4])
+        with pytest.raises(ValueError):
+            sk8s.get_backend(dict(backend="nowhere"))
+
+
+@pytest.mark.local
+def test_auto_chunks(tmp_path):
+    import time
+    # Sized to the target time, but spread over the pods, and never empty.
+    assert(sk8s.jobs.auto_chunk_size(1.0, 10, 1000, 60, 10) == 100)
+    assert(sk8s.jobs.auto_chunk_size(1.0, 10, 1000, 5, 10) == 50)
+    assert(sk8s.jobs.auto_chunk_size(0.0, 10, 1000, 5, 10) == 100)
+    assert(sk8s.jobs.auto_chunk_size(100.0, 1, 1000, 5, 10) == 1)
+
+    config = dict(sk8s.configs.default_config, service_account_name="default")
+    sk8s.configs.save_config(config, str(tmp_path / "config.json"))
+    with sk8s.Session(kubeconfig=str(tmp_path / "no-kubeconfig"), config_file=str(tmp_path / "config.json")):
+        with sk8s.LocalBackend(max_workers=4):
+            def slow(x):
+                import time
+                time.sleep(0.01)
+                return x * 2
+            results = sk8s.chunked_map(slow, range(60), size="auto", target_seconds=0.05, max_pods=4)
+            assert(results == [x * 2 for x in range(60)])
+            assert(sk8s.chunked_starmap(max, [(1, 2), (4, 3)], size="auto") == [2, 4])
+            with pytest.raises(ValueError):
+                sk8s.chunked_map(slow, range(10), size="auto", asynchro=True)
+
+
+@pytest.mark.local
+def test_multicore_chunks(tmp_path, monkeypatch):
+    import os
+    import dill
+    import sk8s.runner
+    monkeypatch.setattr(os, "sched_getaffinity", lambda pid: {0, 1, 2, 3}, raising=False)
+    monkeypatch.setattr(sk8s.runner, "cgroup_cpu_max", str(tmp_path / "cpu.max"))
+    monkeypatch.setattr(sk8s.runner, "cgroup_cfs_quota", str(tmp_path / "missing"))
+
+    # The CPUs requested, but no more than the limit or the CPUs there are.
+    (tmp_path / "cpu.max").write_text("200000 100000\n")
+    assert(sk8s.runner.chunk_processes() == 2)
+    assert(sk8s.runner.chunk_processes(8) == 2)
+    assert(sk8s.runner.chunk_processes(1.5) == 1)
+    (tmp_path / "cpu.max").write_text("max 100000\n")
+    assert(sk8s.runner.chunk_processes() == 1)
+    assert(sk8s.runner.chunk_processes(3) == 3)
+    assert(sk8s.runner.chunk_processes(16) == 4)
+    assert(sk8s.jobs.cpu_quantity("500m") == 0.5)
+    assert(sk8s.jobs.cpu_quantity(8) == 8)
+
+    # In order, and with every failure reported.
+    chunk = [dill.dumps((x,)) for x in range(20)]
+    assert(sk8s.runner.run_chunk(lambda x: x * x, chunk, cpus=3) == [x * x for x in range(20)])
+    with pytest.raises(sk8s.runner.ChunkError) as e:
+        sk8s.runner.run_chunk(lambda x: 1 / (x % 7), chunk, cpus=3)
+    assert(sorted(e.value.failures) == [0, 7, 14])
+    assert("ZeroDivisionError" in e.value.failures[7])
+
+
+@pytest.mark.local
+def test_tree_map(tmp_path):
+    import yaml
+    assert(sk8s.jobs.split(list(range(10)), 3) == [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]])
+
+    # The client submits only the top of the tree.
+    config = dict(sk8s.configs.default_config, service_account_name="default")
+    specs = sk8s.map_arglists(abs, [(i,) for i in range(100)], mode="tree", fanout=4, leaf_size=10, dryrun=True, config=config)
+    assert(len(specs) == 4)
+    assert(yaml.safe_load(specs[0])["metadata"]["name"].startswith("sk8s-submit-"))
+
+    # Submitters submitting submitters, with the local backend standing in for the cluster.
+    sk8s.configs.save_config(dict(config, backend="local", local_workers=2), str(tmp_path / "config.json"))
+    with sk8s.Session(kubeconfig=str(tmp_path / "no-kubeconfig"), config_file=str(tmp_path / "config.json")):
+        assert(sk8s.map(lambda x: [x], range(12), mode="tree", fanout=2, leaf_size=3) == [[x] for x in range(12)])
+        assert(sk8s.starmap(max, [(1, 2)], mode="tree") == [2])
+        submitters = sk8s.map(lambda x: -x, range(5), mode="tree", fanout=2, leaf_size=2, asynchro=True)
+        assert(sk8s.wait_subtrees(submitters) == [-x for x in range(5)])
+
+
+@pytest.mark.local
+def test_memo_cache():
+    import bson
+    import functools
+    import time
+    import sk8s.state
+
+    # Evicted least recently used first, by count and by bytes.
+    cache = sk8s.state.LRUCache(max_entries=3, max_bytes=1000)
+    for key in "abc":
+        cache.put(key, bson.encode({"_id": key, "val": None}))
+    cache.get("a")
+    cache.put("d", bson.encode({"_id": "d", "val": None}))
+    assert(sorted(cache.entries) == ["a", "c", "d"])
+    cache.put("e", bson.encode({"_id": "e", "val": "x" * 960}))
+    assert(list(cache.entries) == ["e"])
+    assert(cache.bytes == len(cache.entries["e"]))
+    cache.put("f", bson.encode({"_id": "f", "val": "x" * 1000}))  # too big to keep at all
+    assert(("f" not in cache) and ("e" in cache))
+
+    # Only keys asked to be cached (memoize()'s) are; others are read afresh each time.
+    class Collection:
+        # Just enough of a pymongo collection, with raw documents.
+        def __init__(self):
+            self.docs = dict()
+        def find_one(self, query):
+            raw = self.docs.get(query["_id"])
+            return None if raw is None else bson.raw_bson.RawBSONDocument(raw)
+        def replace_one(self, query, doc, upsert=False):
+            self.docs[query["_id"]] = doc.raw
+    state = sk8s.state.WorkflowState.__new__(sk8s.state.WorkflowState)
+    state.memos, state.cache, state.migrated = Collection(), sk8s.state.LRUCache(), True
+    state.teardown = lambda: None
+    state.set("shared", 1)
+    state.set("memo", 1, cache=True)
+    state.memos.docs["shared"] = bson.encode({"_id": "shared", "val": 2})
+    state.memos.docs["memo"] = bson.encode({"_id": "memo", "val": 2})
+    assert(state.get("shared") == 2 and state.get("memo", cache=True) == 1)
+    assert(list(state.cache.entries) == ["memo"])
+    state.set("memo", 3)
+    assert(state.get("memo", cache=True) == 3)
+
+    # run(f, x, state=...) and memoize_map(f, [(x,)]) memoize under the same key.
+    state = sk8s.state.WorkflowState
+    assert(state.func_2_md5(functools.partial(divmod, 7, 2)) == state.args_key(state.func_key(divmod), (7, 2)))
+    assert(state.func_2_md5(functools.partial(divmod, 7, 2)) != state.func_2_md5(functools.partial(divmod, 7, 3)))
+
+    class DictState(sk8s.state.WorkflowState):
+        # Memos in a dict, standing in for MongoDB.
+        def __init__(self):
+            self.memos = dict()
+        def get_many(self, keys, cache=False):
+            return {key: self.memos[key] for key in keys if key in self.memos}
+        def set_many(self, items, cache=False):
+            self.memos.update(items)
+        def __del__(self):
+            pass
+
+    config = dict(sk8s.configs.default_config, service_account_name="default")
+    memos = DictState()
+    with sk8s.LocalBackend(max_workers=2) as backend:
+        pair = lambda x: [x, x]
+        assert(memos.memoize_map(pair, [(5,)], config=config) == [[5, 5]])
+        assert(memos.memoize_map(abs, [(-1,), (-2,), (-1,)], config=config) == [1, 2, 1])
+        assert(len(memos.memos) == 3)
+        # Memoized calls don't run again; only the new one does.
+        memos.memos[memos.func_2_md5(functools.partial(pair, 5))] = "memoized"
+        assert(memos.memoize_map(pair, [(5,), (6,)], config=config) == ["memoized", [6, 6]])
+        # Jobs still running at the timeout are deleted.
+        with pytest.raises(TimeoutError):
+            memos.memoize_map(time.sleep, [(2,)], timeout=0.2, config=config)
+        assert(len(backend.jobs) == 0)
+        # What succeeded is memoized even if something else failed.
+        with pytest.raises(RuntimeError):
+            memos.memoize_map(lambda x: 1 / x, [(0,), (4,)], config=config)
+        assert(0.25 in memos.memos.values())
+
+
 @pytest.mark.jobs
 def test_chunked_map():
     results = sk8s.chunked_map(lambda i: i*2, range(10), size=3)